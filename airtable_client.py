@@ -0,0 +1,312 @@
+"""Client condiviso per tutte le chiamate all'API di Airtable.
+
+Usa una sola ``requests.Session`` (connessioni keep-alive in pool), applica un
+timeout a ogni chiamata e ritenta con backoff esponenziale e jitter le risposte
+429/5xx e gli errori di rete. POST e PATCH non sono idempotenti: dopo un
+timeout di lettura o un 5xx Airtable potrebbe aver già creato o modificato il
+record, quindi si ritentano solo i 429 e gli errori di connessione (richiesta
+mai partita). Tiene anche i contatori di chiamate e latenza per
+tabella e metodo, così si vede dove va il tempo speso verso Airtable.
+
+Con un ``CircuitBreaker`` le chiamate falliscono subito (``CircuitOpenError``)
+mentre Airtable è irraggiungibile, invece di accumulare timeout e retry; con
+un ``RateGovernor`` ogni tentativo aspetta il proprio turno nel budget di
+richieste al secondo condiviso dai processi.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError
+
+from airtable_query import record_id_in
+
+logger = logging.getLogger(__name__)
+
+AIRTABLE_API_URL = 'https://api.airtable.com/v0'
+
+# Codici per cui vale la pena ritentare: rate limit (5 req/s per base) ed errori lato server
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Metodi che si possono ripetere senza effetti doppi
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE'})
+
+# Airtable restituisce al massimo 100 record per pagina
+MAX_PAGE_SIZE = 100
+
+# ID per ogni formula OR(RECORD_ID()=...): tiene l'URL ben sotto il limite di Airtable
+RECORD_ID_CHUNK_SIZE = 50
+
+
+class AirtableError(Exception):
+    """Risposta di errore da Airtable durante la lettura di una tabella"""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        super().__init__(f'Errore Airtable: {response.status_code} - {response.text}')
+
+
+class CircuitOpenError(requests.RequestException):
+    """Chiamata rifiutata senza contattare Airtable perché il circuito è aperto"""
+
+    def __init__(self, table, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f'Airtable non disponibile ({table}): circuito aperto, prossima prova tra {retry_after:.0f}s')
+
+
+def request_not_sent(error):
+    """True se l'errore è arrivato prima che la richiesta partisse (connessione mai aperta)"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or isinstance(error, requests.ReadTimeout):
+        return False
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class AirtableClient:
+    """Client HTTP per una base Airtable con pool di connessioni, timeout e retry"""
+
+    def __init__(self, api_key, base_id, timeout=(3.05, 10), max_retries=4,
+                 backoff_base=0.5, backoff_max=8.0, pool_size=10, breaker=None, governor=None):
+        """
+        Args:
+            api_key: Token personale di Airtable
+            base_id: ID della base (es. 'appXXXXXXXX')
+            timeout: Timeout di default (connessione, lettura) in secondi
+            max_retries: Numero massimo di tentativi aggiuntivi per chiamata
+            backoff_base: Attesa iniziale in secondi prima del primo retry
+            backoff_max: Attesa massima in secondi tra due tentativi
+            pool_size: Numero massimo di connessioni tenute aperte verso Airtable
+            breaker: ``CircuitBreaker`` opzionale; errori di rete e 5xx lo fanno scattare
+            governor: ``RateGovernor`` opzionale che distribuisce le richieste al secondo
+        """
+        self.base_id = base_id
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.governor = governor
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        })
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def url(self, table, record_id=None):
+        """Costruisce l'URL di una tabella o di un singolo record"""
+        url = f'{AIRTABLE_API_URL}/{self.base_id}/{table}'
+        if record_id:
+            url = f'{url}/{record_id}'
+        return url
+
+    def request(self, method, table, record_id=None, params=None, json=None, timeout=None):
+        """
+        Esegue una chiamata verso Airtable ritentando 429/5xx ed errori di rete
+        (per POST e PATCH solo 429 ed errori di connessione, vedi sopra).
+
+        Args:
+            method: Metodo HTTP ('GET', 'POST', 'PATCH', 'DELETE')
+            table: Nome della tabella Airtable
+            record_id: ID del record, per le chiamate su un singolo record
+            params: Parametri della query string
+            json: Corpo JSON della richiesta
+            timeout: Timeout specifico per questa chiamata
+
+        Returns:
+            L'oggetto ``requests.Response`` dell'ultimo tentativo
+
+        Raises:
+            requests.RequestException: se anche l'ultimo tentativo fallisce per errore di rete
+            CircuitOpenError: se il circuito è aperto (anche tra un retry e l'altro)
+        """
+        url = self.url(table, record_id)
+        timeout = timeout if timeout is not None else self.timeout
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpenError(table, self.breaker.retry_after())
+            try:
+                if self.governor is not None:
+                    self.governor.acquire()
+                start = time.perf_counter()
+                response = self.session.request(method, url, params=params, json=json, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(table, method, time.perf_counter() - start, error=True, retry=attempt > 0)
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if attempt >= self.max_retries or not (idempotent or request_not_sent(e)):
+                    raise
+                logger.warning("[AIRTABLE] %s %s fallita (%s), nuovo tentativo", method, table, e)
+                self._sleep_before_retry(attempt)
+                attempt += 1
+                continue
+            except BaseException:
+                # Ogni altro errore (dal governor, dalla codifica del corpo, dai
+                # redirect, dalla lettura della risposta) chiude comunque la
+                # chiamata: altrimenti una prova a circuito semiaperto non
+                # riporterebbe mai l'esito
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                raise
+
+            elapsed = time.perf_counter() - start
+            failed = response.status_code >= 400
+            self._record(table, method, elapsed, error=failed, retry=attempt > 0)
+            if self.breaker is not None:
+                # 4xx e 429 vengono da un Airtable che risponde: solo i 5xx contano come guasto
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+            retryable = response.status_code in RETRY_STATUS_CODES if idempotent else response.status_code == 429
+            if not retryable or attempt >= self.max_retries:
+                return response
+
+            logger.warning("[AIRTABLE] %s %s ha risposto %s, nuovo tentativo",
+                           method, table, response.status_code)
+            self._sleep_before_retry(attempt, response.headers.get('Retry-After'))
+            attempt += 1
+
+    def get(self, table, record_id=None, params=None, **kwargs):
+        return self.request('GET', table, record_id=record_id, params=params, **kwargs)
+
+    def post(self, table, json, **kwargs):
+        return self.request('POST', table, json=json, **kwargs)
+
+    def patch(self, table, record_id, json, **kwargs):
+        return self.request('PATCH', table, record_id=record_id, json=json, **kwargs)
+
+    def delete(self, table, record_id, **kwargs):
+        return self.request('DELETE', table, record_id=record_id, **kwargs)
+
+    def iter_pages(self, table, params=None, page_size=MAX_PAGE_SIZE):
+        """
+        Scorre una tabella pagina per pagina seguendo l'``offset`` di Airtable.
+
+        Le pagine successive vengono richieste solo quando servono, quindi chi
+        chiama può fermarsi prima della fine senza scaricare l'intera tabella.
+
+        Args:
+            table: Nome della tabella Airtable
+            params: Parametri della query (filterByFormula, sort, fields, ...)
+            page_size: Numero di record per pagina (massimo 100)
+
+        Yields:
+            La lista dei record di ogni pagina
+
+        Raises:
+            AirtableError: se Airtable risponde con un errore
+        """
+        params = dict(params or {})
+        params['pageSize'] = min(page_size, MAX_PAGE_SIZE)
+        while True:
+            response = self.get(table, params=params)
+            if response.status_code != 200:
+                raise AirtableError(response)
+            data = response.json()
+            yield data.get('records', [])
+            offset = data.get('offset')
+            if not offset:
+                return
+            params['offset'] = offset
+
+    def iter_records(self, table, params=None, page_size=MAX_PAGE_SIZE):
+        """Come iter_pages, ma restituisce i record uno alla volta"""
+        for page in self.iter_pages(table, params=params, page_size=page_size):
+            yield from page
+
+    def get_all(self, table, params=None):
+        """Scarica tutti i record di una tabella (tutte le pagine) in una lista"""
+        return list(self.iter_records(table, params=params))
+
+    def get_records(self, table, record_ids, params=None, chunk_size=RECORD_ID_CHUNK_SIZE):
+        """
+        Recupera più record per ID con il minor numero possibile di richieste.
+
+        Gli ID (duplicati e vuoti esclusi) vengono raggruppati a blocchi in
+        formule OR(RECORD_ID()=...), quindi N record costano circa
+        N / chunk_size chiamate invece di N.
+
+        Args:
+            table: Nome della tabella Airtable
+            record_ids: ID dei record da recuperare
+            params: Altri parametri della query (es. fields[])
+            chunk_size: Numero di ID per richiesta
+
+        Returns:
+            Dizionario {id: record}; gli ID non trovati non compaiono
+
+        Raises:
+            AirtableError: se Airtable risponde con un errore
+        """
+        ids = list(dict.fromkeys(record_id for record_id in record_ids if record_id))
+        records = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk_params = dict(params or {})
+            chunk_params['filterByFormula'] = record_id_in(ids[start:start + chunk_size])
+            for record in self.iter_records(table, params=chunk_params):
+                records[record['id']] = record
+        return records
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        """Attende prima del prossimo tentativo (backoff esponenziale con full jitter)"""
+        if retry_after:
+            try:
+                time.sleep(min(float(retry_after), self.backoff_max))
+                return
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def _record(self, table, method, elapsed, error=False, retry=False):
+        """Aggiorna i contatori per la coppia (tabella, metodo)"""
+        key = (table, method)
+        with self._stats_lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    'calls': 0, 'errors': 0, 'retries': 0,
+                    'total_time': 0.0, 'max_time': 0.0
+                }
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            if elapsed > stats['max_time']:
+                stats['max_time'] = elapsed
+            if error:
+                stats['errors'] += 1
+            if retry:
+                stats['retries'] += 1
+
+    def get_stats(self):
+        """Restituisce una copia dei contatori con la latenza media per tabella e metodo"""
+        with self._stats_lock:
+            snapshot = {key: dict(value) for key, value in self._stats.items()}
+        result = []
+        for (table, method), stats in sorted(snapshot.items()):
+            stats['table'] = table
+            stats['method'] = method
+            stats['avg_time'] = stats['total_time'] / stats['calls'] if stats['calls'] else 0.0
+            result.append(stats)
+        return result
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
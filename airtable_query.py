@@ -0,0 +1,138 @@
+"""Costruzione dei parametri di query per l'API di Airtable.
+
+Genera ``filterByFormula``, ``sort``, ``maxRecords`` e ``fields[]`` con i
+valori già escapati, così i filtri vengono eseguiti lato Airtable invece di
+scaricare l'intera tabella e filtrarla in Python, e arrivano solo i campi usati.
+
+Esempio:
+    params = build_params(
+        formula=and_(eq('Email', email), linked_contains('Consumazione Record ID', cons_id)),
+        sort=['-Ora inizio'],
+        max_records=50,
+        fields=['Volume (g)', 'BAC Temporaneo']
+    )
+"""
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Union
+
+Value = Union[str, int, float, bool]
+
+
+def escape_string(value: str) -> str:
+    """Escapa una stringa da usare come letterale tra apici singoli in una formula"""
+    return str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+def literal(value: Value) -> str:
+    """Converte un valore Python nel letterale corrispondente della formula"""
+    if isinstance(value, bool):
+        return 'TRUE()' if value else 'FALSE()'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return f"'{escape_string(value)}'"
+
+
+def field(name: str) -> str:
+    """Riferimento a un campo: {Nome campo}"""
+    if '{' in name or '}' in name:
+        raise ValueError(f"Nome di campo non valido per una formula: {name!r}")
+    return '{' + name + '}'
+
+
+def eq(field_name: str, value: Value) -> str:
+    """{Campo} = valore"""
+    return f"{field(field_name)}={literal(value)}"
+
+
+def linked_contains(field_name: str, record_id: str) -> str:
+    """
+    Vero se il campo collegato (lista di ID) contiene esattamente ``record_id``.
+
+    La lista viene unita con ARRAYJOIN e delimitata da virgole su entrambi i
+    lati, così 'recA' non trova anche 'recAB'. Attenzione: nelle formule un
+    campo collegato vale i campi primari dei record collegati, non i loro ID:
+    per cercare un ID si usa un campo lookup che riporta RECORD_ID() del
+    record collegato (vedi ``LINKED_ID_FIELDS`` in app.py).
+    """
+    return (f"FIND(',' & {literal(record_id)} & ',', "
+            f"',' & ARRAYJOIN({field(field_name)}, ',') & ',')")
+
+
+def record_id_in(record_ids: Iterable[str]) -> str:
+    """Vero se RECORD_ID() è uno degli ID indicati"""
+    conditions = [f"RECORD_ID()={literal(record_id)}" for record_id in record_ids]
+    if not conditions:
+        return 'FALSE()'
+    return or_(*conditions)
+
+
+def same_day(field_name: str, day: str, timezone: str = 'Europe/Rome') -> str:
+    """Vero se la data del campo, nel fuso orario indicato, è il giorno 'YYYY-MM-DD'"""
+    return (f"DATETIME_FORMAT(SET_TIMEZONE({field(field_name)}, {literal(timezone)}), "
+            f"'YYYY-MM-DD')={literal(day)}")
+
+
+def modified_since(timestamp: datetime) -> str:
+    """Vero se il record è stato modificato (o creato) dopo ``timestamp`` (naive = UTC)"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (f"IS_AFTER(LAST_MODIFIED_TIME(), "
+            f"DATETIME_PARSE({literal(timestamp.strftime('%Y-%m-%dT%H:%M:%S.000Z'))}))")
+
+
+def and_(*conditions: str) -> str:
+    conditions = [c for c in conditions if c]
+    if len(conditions) == 1:
+        return conditions[0]
+    return f"AND({', '.join(conditions)})"
+
+
+def or_(*conditions: str) -> str:
+    conditions = [c for c in conditions if c]
+    if len(conditions) == 1:
+        return conditions[0]
+    return f"OR({', '.join(conditions)})"
+
+
+def build_params(
+    formula: Optional[str] = None,
+    sort: Optional[Iterable[str]] = None,
+    max_records: Optional[int] = None,
+    fields: Optional[Iterable[str]] = None
+) -> Dict[str, Union[str, int, List[str]]]:
+    """
+    Costruisce i parametri della query string per una lettura da Airtable.
+
+    Args:
+        formula: Formula per filterByFormula
+        sort: Campi di ordinamento; il prefisso '-' indica ordine decrescente
+        max_records: Numero massimo di record restituiti in totale
+        fields: Campi da restituire (proiezione); None per tutti
+
+    Returns:
+        Dizionario da passare come ``params`` al client
+    """
+    params = {}
+    if formula:
+        params['filterByFormula'] = formula
+    for i, name in enumerate(sort or []):
+        direction = 'desc' if name.startswith('-') else 'asc'
+        params[f'sort[{i}][field]'] = name.lstrip('-')
+        params[f'sort[{i}][direction]'] = direction
+    if max_records is not None:
+        params['maxRecords'] = int(max_records)
+    if fields is not None:
+        params['fields[]'] = list(fields)
+    return params
+
+
+def project(record: Optional[dict], fields: Optional[Iterable[str]]) -> Optional[dict]:
+    """
+    Copia del record con i soli campi indicati, per le letture che Airtable non
+    permette di proiettare (GET di un singolo record)
+    """
+    if not record or fields is None:
+        return record
+    wanted = set(fields)
+    return {**record, 'fields': {k: v for k, v in record.get('fields', {}).items() if k in wanted}}
@@ -1,7 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, has_request_context, Response
 import hashlib, os
+import json
 from datetime import datetime, timedelta
-import requests
+import threading
 import time
 from algoritmo import (
     calcola_tasso_alcolemico_widmark, 
@@ -10,13 +11,41 @@ from algoritmo import (
     calcola_alcol_metabolizzato
 )
 import pytz  # Aggiungiamo pytz per gestire i fusi orari
+from airtable_client import AirtableClient, AirtableError, CircuitOpenError
+from circuit_breaker import CircuitBreaker, CLOSED
+from rate_governor import RateGovernor, CRITICAL, ANALYTICS, priority, set_lane, reset_lane
+import airtable_query as aq
+from cache import IdentityMap, TTLCache
+from reference_index import BarIndex, DrinkIndex
+from models import db
+import mirror
+from journal import WriteJournal, is_local_id
+from fanout import FanOut
+from metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from log_setup import configure_logging, sampled_logger
+from sip_detector import SipEngine, SIP
+from signal_filter import SignalFilter
+from weight_store import WeightStore
+from shared_slots import SharedSlots, SlotTableFull
+from recording import Recorder
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from devices import (DeviceRegistry, DEFAULT_DEVICE_ID, DEFAULT_BUFFER_SIZE, normalize_device_id,
+                     decode_binary_batch, decode_json_batch, MAX_BATCH_SAMPLES, BINARY_SAMPLE_SIZE)
+from flask_migrate import Migrate
+import click
+import requests
+import tempfile
 from functools import wraps
 import logging
 
-# Configurazione del logger
-logging.basicConfig(level=logging.INFO)
+# Configurazione del logger: coda asincrona, livelli per modulo (LOG_LEVELS) e formato (LOG_FORMAT)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# Le letture della bilancia arrivano più volte al secondo: se ne logga una ogni ARDUINO_LOG_EVERY
+arduino_logger = sampled_logger('app.arduino', int(os.environ.get('ARDUINO_LOG_EVERY', '50')))
+
 # Definiamo il fuso orario italiano
 TIMEZONE = pytz.timezone('Europe/Rome')
 
@@ -141,6 +170,16 @@ class SessionManager:
         """Ottiene l'ID del drink selezionato"""
         return session.get('selected_drink_id')
         
+    @staticmethod
+    def set_device_id(device_id):
+        """Salva l'ID del sottobicchiere collegato all'utente"""
+        session['device_id'] = device_id
+        
+    @staticmethod
+    def get_device_id():
+        """Ottiene l'ID del sottobicchiere collegato all'utente"""
+        return session.get('device_id')
+        
     @staticmethod
     def get_sorsi_from_session(consumazione_id):
         """Ottiene i sorsi di una consumazione dalla sessione"""
@@ -193,20 +232,14 @@ def verify_password(stored_hash, provided_password):
         hash_bytes = hashlib.pbkdf2_hmac('sha256', provided_password.encode(), salt, 100000)
         calculated_digest = hash_bytes.hex()
         
-        # Log per debug
-        logger.info(f"[VERIFY] Salt estratto: {salt_hex}")
-        logger.info(f"[VERIFY] Hash memorizzato: {stored_digest}")
-        logger.info(f"[VERIFY] Hash calcolato: {calculated_digest}")
-        
         # Confronta i due hash
         return calculated_digest == stored_digest
     except Exception as e:
-        logger.error(f"[VERIFY] Errore nella verifica: {e}")
+        logger.error("[VERIFY] Errore nella verifica: %s", e)
         return False
         
 import os
 from datetime import datetime, timedelta
-import requests
 import time
 from algoritmo import (
     calcola_tasso_alcolemico_widmark, 
@@ -222,128 +255,658 @@ app.secret_key = os.environ.get('SECRET_KEY', 'super-segreta')
 # Definiamo il fuso orario italiano
 TIMEZONE = pytz.timezone('Europe/Rome')
 
-# Global variables for Arduino data
-dato_da_arduino = None
-timestamp_dato = None
+# === Metriche ===
+# Contatori per thread, senza lock sui percorsi caldi; le statistiche già
+# tenute da client Airtable, cache e journal vengono lette solo da /metrics
+metrics = MetricsRegistry('safesip')
+http_requests = metrics.counter('http_requests_total', 'Richieste HTTP servite', ['route', 'method', 'status'])
+http_latency = metrics.histogram('http_request_duration_seconds', 'Durata delle richieste HTTP', ['route', 'method'])
+arduino_readings = metrics.counter('arduino_readings_total', 'Letture di peso ricevute da Arduino', ['method'])
+sip_latency = metrics.histogram('sip_registration_duration_seconds', 'Durata della registrazione di un sorso')
+
+# Consumazioni attive viste da questo worker: ID -> ultima attività (creazione o sorso)
+active_consumptions = {}
+ACTIVE_CONSUMPTION_WINDOW = 3600
+
+def consumption_activity(consumazione_id):
+    active_consumptions[consumazione_id] = time.monotonic()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        http_requests.inc(route, request.method, str(response.status_code))
+        http_latency.observe(time.perf_counter() - start, route, request.method)
+    return response
+
+@metrics.collector
+def upstream_metrics():
+    """Chiamate ad Airtable, cache, circuito, code del rate limit e journal, letti al momento"""
+    families = []
+    airtable_stats = airtable.get_stats()
+    for name, key, documentation in (
+        ('airtable_requests_total', 'calls', 'Chiamate ad Airtable (tentativi inclusi)'),
+        ('airtable_errors_total', 'errors', 'Chiamate ad Airtable fallite (errore di rete o HTTP >= 400)'),
+        ('airtable_retries_total', 'retries', 'Tentativi ripetuti verso Airtable'),
+        ('airtable_request_duration_seconds_total', 'total_time', 'Tempo totale speso nelle chiamate ad Airtable'),
+    ):
+        families.append((f'safesip_{name}', 'counter', documentation,
+                         [({'table': s['table'], 'method': s['method']}, s[key]) for s in airtable_stats]))
+    families.append(('safesip_airtable_request_duration_max_seconds', 'gauge', 'Chiamata ad Airtable più lenta',
+                     [({'table': s['table'], 'method': s['method']}, s['max_time']) for s in airtable_stats]))
+
+    cache_stats = reference_cache.get_stats()
+    families.append(('safesip_cache_lookups_total', 'counter', 'Letture dalla cache di Bar e Drinks per esito', [
+        ({'cache': 'reference', 'result': 'hit'}, cache_stats['hits']),
+        ({'cache': 'reference', 'result': 'stale'}, cache_stats['stale_hits']),
+        ({'cache': 'reference', 'result': 'miss'}, cache_stats['misses']),
+    ]))
+    families.append(('safesip_cache_hit_ratio', 'gauge', 'Quota di letture servite dalla cache (anche scadute)',
+                     [({'cache': 'reference'}, cache_stats['hit_ratio'])]))
+    families.append(('safesip_cache_entries', 'gauge', 'Voci in cache', [({'cache': 'reference'}, cache_stats['size'])]))
+    families.append(('safesip_cache_refresh_errors_total', 'counter', 'Ricariche in background fallite',
+                     [({'cache': 'reference'}, cache_stats['refresh_errors'])]))
+
+    breaker_stats = airtable_breaker.get_stats()
+    families.append(('safesip_airtable_circuit_state', 'gauge', 'Stato del circuito verso Airtable (1 = stato attuale)',
+                     [({'state': state}, int(breaker_stats['state'] == state)) for state in ('closed', 'open', 'half_open')]))
+    families.append(('safesip_airtable_circuit_rejected_total', 'counter', 'Chiamate rifiutate a circuito aperto',
+                     [({}, breaker_stats['rejected'])]))
+
+    if airtable_governor:
+        governor_stats = airtable_governor.get_stats()
+        lanes = governor_stats['lanes'].items()
+        families.append(('safesip_airtable_rate_tokens', 'gauge', 'Token disponibili nel bucket condiviso',
+                         [({}, governor_stats['tokens'])]))
+        families.append(('safesip_airtable_rate_acquired_total', 'counter', 'Token presi per corsia',
+                         [({'lane': lane}, stats['acquired']) for lane, stats in lanes]))
+        families.append(('safesip_airtable_rate_wait_seconds_total', 'counter', 'Tempo passato in attesa di un token',
+                         [({'lane': lane}, stats['total_wait']) for lane, stats in lanes]))
+        families.append(('safesip_airtable_rate_waiting', 'gauge', 'Chiamate in coda per un token',
+                         [({'lane': lane}, stats['waiting']) for lane, stats in lanes]))
+
+    if write_journal:
+        journal_stats = write_journal.get_stats()
+        families.append(('safesip_journal_pending', 'gauge', 'Scritture in attesa di invio ad Airtable',
+                         [({}, journal_stats['pending'])]))
+        families.append(('safesip_journal_flushed_total', 'counter', 'Scritture inviate ad Airtable',
+                         [({}, journal_stats['flushed'])]))
+        families.append(('safesip_journal_dropped_total', 'counter', 'Scritture scartate dopo troppi rifiuti',
+                         [({}, journal_stats['dropped'])]))
+
+    now = time.monotonic()
+    for consumazione_id, seen in list(active_consumptions.items()):
+        if now - seen > ACTIVE_CONSUMPTION_WINDOW:
+            active_consumptions.pop(consumazione_id, None)
+    families.append(('safesip_active_consumptions', 'gauge',
+                     'Consumazioni aperte con attività nell\'ultima ora in questo worker',
+                     [({}, len(active_consumptions))]))
+
+    device_stats = devices.get_stats()
+    families.append(('safesip_devices', 'gauge', 'Sottobicchieri noti a questo worker',
+                     [({'state': 'bound'}, device_stats['bound']),
+                      ({'state': 'total'}, device_stats['devices'])]))
+    families.append(('safesip_sse_streams', 'gauge', 'Stream SSE aperti in questo worker',
+                     [({}, sse_streams['active'])]))
+    families.append(('safesip_sse_rejected_total', 'counter', 'Stream SSE rifiutati con 503 perché al limite',
+                     [({}, sse_streams['rejected'])]))
+    return families
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype=None, content_type=METRICS_CONTENT_TYPE)
+
+# Letture dei sottobicchieri, per dispositivo: ognuno tiene le ultime
+# DEVICE_BUFFER_SIZE letture in un buffer circolare (almeno un lotto intero)
+devices = DeviceRegistry(capacity=int(os.environ.get('DEVICE_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)))
+
+# Letture restituite al massimo da /get_arduino_data
+ARDUINO_SAMPLES_LIMIT = 50
+
+# === Riconoscimento dei sorsi lato server ===
+# Con SERVER_SIP_DETECTION=1 i sorsi vengono riconosciuti dalle letture dei
+# sottobicchieri collegati a una consumazione e registrati dal server; le
+# pagine di monitoraggio smettono di registrarli dal browser. Collegamenti,
+# bevitori e stato del riconoscimento vivono nella memoria del processo:
+# va attivato solo con un unico worker, altrimenti le letture che arrivano a
+# un worker diverso da quello del collegamento vanno perse senza errori.
+# Di default i sorsi restano registrati dal browser.
+SERVER_SIP_DETECTION = os.environ.get('SERVER_SIP_DETECTION', '0') == '1'
+
+# Utente di ogni consumazione collegata a un sottobicchiere (vedi drinker_from_session)
+drinkers = {}
+
+sip_events = metrics.counter('sip_events_total', 'Eventi riconosciuti dalle letture dei sottobicchieri', ['kind'])
+
+# Un solo thread: i sorsi vengono registrati nell'ordine in cui sono stati riconosciuti
+sip_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sip')
+
+def _register_detected_sip(consumazione_id, event):
+    bevitore = drinkers.get(consumazione_id)
+    if bevitore is None:
+        return
+    try:
+        with app.app_context(), priority(CRITICAL):
+            sorso = registra_sorso(consumazione_id, round(event.grams, 1), bevitore=bevitore,
+                                   ora_inizio=datetime.fromtimestamp(event.started_at, TIMEZONE),
+                                   ora_fine=datetime.fromtimestamp(event.ended_at, TIMEZONE))
+    except Exception:
+        logger.exception("Errore nella registrazione del sorso rilevato", extra={'consumazione_id': consumazione_id})
+        return
+    if isinstance(sorso, dict) and 'error' in sorso:
+        logger.warning("Sorso rilevato non registrato: %s", sorso['error'], extra={'consumazione_id': consumazione_id})
+
+def on_sip_event(device_id, consumazione_id, event):
+    sip_events.inc(event.kind)
+    logger.info("Evento dal sottobicchiere: %s", event.kind, extra={
+        'device_id': device_id, 'consumazione_id': consumazione_id, 'grammi': round(event.grams, 1)
+    })
+    if event.kind == SIP:
+        sip_executor.submit(_register_detected_sip, consumazione_id, event)
+
+SIGNAL_FILTER_OPTIONS = {
+    'median_window': int(os.environ.get('SIGNAL_MEDIAN_WINDOW', '5')),
+    'ema_alpha': float(os.environ.get('SIGNAL_EMA_ALPHA', '0.5')),
+    'outlier_k': float(os.environ.get('SIGNAL_OUTLIER_K', '3')),
+}
+SIGNAL_FILTER = os.environ.get('SIGNAL_FILTER', '1') == '1'
+if SIGNAL_FILTER:
+    # Parametri non validi fermano l'avvio invece del primo lotto di ogni dispositivo
+    SignalFilter(**SIGNAL_FILTER_OPTIONS)
+
+def make_signal_filter():
+    """Filtro del rumore della bilancia per un dispositivo (SIGNAL_FILTER=0 lo disattiva)"""
+    return SignalFilter(**SIGNAL_FILTER_OPTIONS)
+
+sip_engine = SipEngine(
+    devices, on_sip_event,
+    filter_factory=make_signal_filter if SIGNAL_FILTER else None,
+    min_sip=float(os.environ.get('SIP_MIN_GRAMS', '5'))
+)
+
+def process_readings(device_id):
+    """Da chiamare dopo aver registrato letture: le passa al riconoscimento dei sorsi"""
+    if SERVER_SIP_DETECTION:
+        sip_engine.process(device_id)
+
+# === Storico delle letture ===
+# Tutte le letture finiscono anche in file colonnari per dispositivo e giorno
+# (6 byte a lettura); WEIGHT_HISTORY=0 lo disattiva
+weight_history = None
+if os.environ.get('WEIGHT_HISTORY', '1') == '1':
+    weight_history = WeightStore(os.environ.get('WEIGHT_HISTORY_DIR', os.path.join(app.root_path, 'history')))
+
+# Risoluzioni dei riepiloghi dello storico, in secondi
+HISTORY_ROLLUPS = (1, 60)
+
+# Registrazione delle letture accettate (ordinate e senza doppioni), da
+# riprodurre con replay.py (INGEST_RECORD=percorso del file; disattivata se vuoto)
+ingest_recorder = Recorder(os.environ['INGEST_RECORD']) if os.environ.get('INGEST_RECORD') else None
+
+def ingest_readings(device_id, timestamps, grams):
+    """
+    Via comune per le letture in arrivo: buffer del dispositivo, storico,
+    registrazione e riconoscimento dei sorsi. Restituisce (letture accettate, cursore)
+    """
+    timestamps, grams, cursor = devices.accept_batch(device_id, timestamps, grams)
+    accepted = len(timestamps)
+    if accepted:
+        if ingest_recorder is not None:
+            try:
+                ingest_recorder.append(device_id, timestamps, grams)
+            except OSError as e:
+                logger.error("[REPLAY] Lotto di %s non registrato: %s", device_id, e)
+        if shared_readings is not None:
+            try:
+                shared_readings.write(device_id, cursor, devices.latest(device_id)[1], readings=accepted)
+            except SlotTableFull as e:
+                logger.warning("[DEVICES] %s", e)
+        if weight_history is not None:
+            try:
+                weight_history.append(device_id, timestamps, grams)
+            except OSError as e:
+                logger.error("[STORICO] Letture di %s non salvate: %s", device_id, e)
+        process_readings(device_id)
+    return accepted, cursor
+
+def ingest_reading(device_id, peso):
+    """Una sola lettura, con l'istante di arrivo"""
+    return ingest_readings(device_id, array('d', [time.time()]), array('d', [peso]))
+
+# Ultima lettura di ogni dispositivo condivisa tra i worker: chi riceve la
+# lettura la scrive, tutti la leggono senza lock (DEVICE_SLOTS=0 la disattiva)
+shared_readings = None
+if os.environ.get('DEVICE_SLOTS', '1') == '1':
+    shared_readings = SharedSlots(
+        os.environ.get('DEVICE_SLOTS_FILE', os.path.join(
+            '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'safesip-devices.slots')),
+        slots=int(os.environ.get('DEVICE_SLOTS_SIZE', '4096'))
+    )
+
+def latest_reading(device_id):
+    """Ultima lettura del dispositivo ricevuta da qualunque worker: (istante, grammi) o None"""
+    latest = devices.latest(device_id)
+    if shared_readings is not None:
+        shared = shared_readings.read(device_id)
+        if shared is not None and (latest is None or shared[0] > latest[0]):
+            return shared
+    return latest
+
+def bound_device_id():
+    """Dispositivo da cui leggere per l'utente corrente: quello della consumazione, poi quello scelto"""
+    consumption_data = SessionManager.get_consumption_data()
+    return consumption_data.get('device_id') or SessionManager.get_device_id() or DEFAULT_DEVICE_ID
 
 # Endpoint semplificato per ricevere dati di peso da Arduino/script esterni
 # Manteniamo il vecchio endpoint GET per retrocompatibilità
 @app.route('/arduino_peso/<float:peso>', methods=['GET'])
 def arduino_peso_direct_get(peso):
-    """Endpoint che aggiorna direttamente le variabili globali per il peso (metodo GET)"""
-    global dato_da_arduino, timestamp_dato
+    """Endpoint che registra una lettura di peso (metodo GET, dispositivo in ?device=)"""
+    try:
+        device_id = normalize_device_id(request.args.get('device'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     
-    # Aggiorna le variabili globali
-    dato_da_arduino = peso
-    timestamp_dato = time.time()
+    ingest_reading(device_id, peso)
+    arduino_readings.inc('GET')
     
-    print(f"[ARDUINO-GET] Peso aggiornato a {peso}g")
+    arduino_logger.debug("[ARDUINO-GET] Peso aggiornato a %sg", peso, extra={'device_id': device_id})
     
     # Restituisci una conferma
     return jsonify({
         "status": "ok",
-        "peso": peso
+        "peso": peso,
+        "device_id": device_id
     })
 
 # Endpoint POST per ricevere dati di peso (più adatto per invio dati)
 @app.route('/arduino_peso', methods=['POST'])
 def arduino_peso_direct_post():
-    """Endpoint che riceve il peso via POST e aggiorna le variabili globali"""
-    global dato_da_arduino, timestamp_dato
-    
+    """Endpoint che riceve il peso (e l'eventuale device_id) via POST e lo registra"""
     try:
         # Accetta sia JSON che form data
         if request.is_json:
             data = request.get_json()
-            peso = float(data.get('peso', 0))
         else:
-            peso = float(request.form.get('peso', 0))
+            data = request.form
+        peso = float(data.get('peso', 0))
+        device_id = normalize_device_id(data.get('device_id'))
         
-        # Aggiorna le variabili globali
-        dato_da_arduino = peso
-        timestamp_dato = time.time()
+        ingest_reading(device_id, peso)
+        arduino_readings.inc('POST')
         
-        print(f"[ARDUINO-POST] Peso aggiornato a {peso}g")
+        arduino_logger.debug("[ARDUINO-POST] Peso aggiornato a %sg", peso, extra={'device_id': device_id})
         
         # Restituisci una conferma
         return jsonify({
             "status": "ok",
-            "peso": peso
+            "peso": peso,
+            "device_id": device_id
         })
     except Exception as e:
-        print(f"[ARDUINO-ERROR] {str(e)}")
+        arduino_logger.warning("[ARDUINO-ERROR] %s", e)
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 400
 
+# Endpoint a lotti: molte letture per richiesta invece di una richiesta per lettura
+@app.route('/arduino_batch', methods=['POST'])
+def arduino_batch():
+    """
+    Riceve un lotto di letture con il loro istante.
+
+    Formati accettati:
+    - JSON: ``{"device_id": "...", "samples": [[istante, grammi], ...]}``
+      oppure direttamente la lista di coppie
+    - ``application/octet-stream``: campioni da 16 byte, due double little-endian
+      (istante Unix in secondi, grammi); il dispositivo va in ``?device=`` o
+      nell'header ``X-Device-Id``
+
+    La risposta contiene ``cursor``, l'istante dell'ultima lettura tenuta: il
+    dispositivo può scartare i campioni fino a quell'istante, e reinviare un
+    lotto già ricevuto non produce doppioni.
+    """
+    if request.content_length and request.content_length > MAX_BATCH_SAMPLES * BINARY_SAMPLE_SIZE * 4:
+        return jsonify({"status": "error", "message": "Lotto troppo grande"}), 413
+    try:
+        if request.is_json:
+            data = request.get_json()
+            if isinstance(data, dict):
+                device_id = data.get('device_id') or request.args.get('device')
+                samples = data.get('samples')
+            else:
+                device_id = request.args.get('device')
+                samples = data
+            timestamps, grams = decode_json_batch(samples)
+        else:
+            device_id = request.args.get('device') or request.headers.get('X-Device-Id')
+            timestamps, grams = decode_binary_batch(request.get_data(cache=False))
+        device_id = normalize_device_id(device_id)
+    except ValueError as e:
+        arduino_logger.warning("[ARDUINO-BATCH] Lotto rifiutato: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    accepted, cursor = ingest_readings(device_id, timestamps, grams)
+    arduino_readings.inc('BATCH', amount=accepted)
+    
+    arduino_logger.debug("[ARDUINO-BATCH] %s campioni ricevuti, %s nuovi", len(timestamps), accepted,
+                         extra={'device_id': device_id})
+    
+    return jsonify({
+        "status": "ok",
+        "device_id": device_id,
+        "received": len(timestamps),
+        "accepted": accepted,
+        "cursor": cursor
+    })
+
 
 # === Airtable API ===
 AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY', 'patMvTkVAFXuBTZK0.73601aeaf05c4ffb8fc1109ffc1a7aa3d8e8bf740f094bb6f980c23aecbefeb5')
 BASE_ID = 'appQZSlkfRWqALhaG'
 
-def get_airtable_headers():
-    return {
-        'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+# Dopo errori consecutivi il circuito si apre: le chiamate falliscono subito e
+# le viste servono quello che hanno in cache finché una prova non riesce
+airtable_breaker = CircuitBreaker(
+    'Airtable',
+    failure_threshold=int(os.environ.get('AIRTABLE_BREAKER_THRESHOLD', '5')),
+    reset_timeout=float(os.environ.get('AIRTABLE_BREAKER_RESET', '30'))
+)
+
+# Budget di richieste al secondo verso la base, condiviso da tutti i worker
+# tramite un file su tmpfs; AIRTABLE_RATE=0 lo disattiva
+airtable_rate = float(os.environ.get('AIRTABLE_RATE', '5'))
+airtable_governor = None
+if airtable_rate > 0:
+    airtable_governor = RateGovernor(
+        os.environ.get('AIRTABLE_RATE_FILE', os.path.join(
+            '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), f'safesip-{BASE_ID}.rate')),
+        rate=airtable_rate,
+        burst=int(os.environ.get('AIRTABLE_BURST', '5'))
+    )
+
+# Corsia di priorità delle chiamate ad Airtable per endpoint; le altre rotte
+# (bar, drink, utenti) usano quella dei dati di riferimento
+ENDPOINT_LANES = {
+    'registra_sorso_ajax': CRITICAL,
+    'check_active_consumption': CRITICAL,
+    'finish_consumption': CRITICAL,
+    'create_consumption': CRITICAL,
+    'monitora_drink': CRITICAL,
+    'world': ANALYTICS,
+    'statistica': ANALYTICS,
+    'drink_master': ANALYTICS,
+    'game': ANALYTICS,
+    'debug_all_tables': ANALYTICS,
+    'debug_drinks': ANALYTICS,
+    'debug_airtable': ANALYTICS,
+}
+
+@app.before_request
+def set_airtable_lane():
+    lane = ENDPOINT_LANES.get(request.endpoint)
+    if lane:
+        g.airtable_lane_token = set_lane(lane)
+
+@app.teardown_request
+def reset_airtable_lane(exc):
+    token = g.pop('airtable_lane_token', None)
+    if token is not None:
+        reset_lane(token)
+
+# Client condiviso: pool di connessioni, timeout e retry su 429/5xx per tutte le chiamate
+airtable = AirtableClient(AIRTABLE_API_KEY, BASE_ID, breaker=airtable_breaker, governor=airtable_governor)
+
+# Campi richiesti ad Airtable (fields[]) per ciascuna tabella: solo quelli che
+# l'app usa davvero, così risposte e cache restano leggere. Airtable risponde
+# 422 se un nome non esiste, quindi qui vanno solo campi scritti dall'app.
+BAR_FIELDS = ['Name', 'Città', 'Indirizzo']
+DRINK_FIELDS = ['Name', 'Gradazione', 'Ingredienti', 'Alcolico (bool)', 'Speciale (bool)', 'Bar']
+USER_FIELDS = ['Email', 'Peso', 'Genere']
+CONSUMAZIONE_FIELDS = ['User', 'Drink', 'Bar', 'Peso (g)', 'Tasso Calcolato (g/L)', 'Stomaco', 'Risultato', 'Completato']
+SORSO_FIELDS = ['Consumazioni Id', 'Volume (g)', 'Email', 'BAC Temporaneo', 'Ora inizio', 'Ora fine']
+GAME_DATA_FIELDS = [
+    'User', 'Level', 'Points', 'XP', 'Safe Driver Progress', 'Mix Master Progress',
+    'Time Keeper Progress', 'Daily Challenge Completed', 'Last Daily Reset', 'Last Updated'
+]
+REFERENCE_FIELDS = {'Bar': BAR_FIELDS, 'Drinks': DRINK_FIELDS}
+
+# Letture indipendenti eseguite in parallelo; il limite di thread è il massimo
+# di chiamate contemporanee del processo, il ritmo lo decide airtable_governor.
+# I thread condividono l'identity map della richiesta che li lancia
+fanout = FanOut(max_workers=int(os.environ.get('AIRTABLE_FANOUT_WORKERS', '4')),
+                shared_g=lambda: {'identity_map': request_reads()})
+
+# Età (in secondi) della voce scaduta più vecchia servita alla richiesta. Sta
+# nell'environ e non su g perché i thread del fan-out hanno un g tutto loro
+STALE_AGE_KEY = 'safesip.stale_age'
+
+def _served_stale(key, age):
+    if has_request_context():
+        request.environ[STALE_AGE_KEY] = max(age, request.environ.get(STALE_AGE_KEY, 0))
+
+# Cache di Bar e Drinks: cambiano solo con register_partner, registra_drink e link_drinks_to_bar,
+# che la invalidano esplicitamente; il TTL copre le modifiche fatte direttamente su Airtable.
+# Scaduto il TTL, per REFERENCE_STALE_TTL secondi si serve l'ultimo valore e lo si ricarica in background
+reference_cache = TTLCache(
+    ttl=300, max_size=512,
+    stale_ttl=int(os.environ.get('REFERENCE_STALE_TTL', '3600')),
+    on_stale=_served_stale
+)
+
+@app.after_request
+def add_staleness_headers(response):
+    """Segnala nella risposta se sono stati serviti dati scaduti o se Airtable è irraggiungibile"""
+    age = request.environ.get(STALE_AGE_KEY)
+    if age is not None:
+        response.headers['X-Cache'] = 'STALE'
+        response.headers['Age'] = str(int(age))
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    state = airtable_breaker.state
+    if state != CLOSED:
+        response.headers['X-Upstream-Circuit'] = state
+    return response
+
+@app.errorhandler(CircuitOpenError)
+def upstream_unavailable(e):
+    """Circuito aperto e nessun dato in cache: si risponde subito 503 invece di restare appesi"""
+    logger.warning("[CIRCUIT] %s: %s", request.path, e)
+    retry_after = str(max(1, int(e.retry_after)))
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        response = jsonify({'success': False, 'error': 'Servizio temporaneamente non disponibile'})
+    else:
+        response = app.response_class('Servizio temporaneamente non disponibile, riprova tra poco.', mimetype='text/plain')
+    response.status_code = 503
+    response.headers['Retry-After'] = retry_after
+    return response
+
+# === Mirror locale (SQL) ===
+# Copia locale delle tabelle Airtable usata dalle viste pesanti; si popola con
+# `flask mirror-refresh`, si aggiorna con `flask mirror-sync` (es. da cron)
+# e si attiva con USE_LOCAL_MIRROR=1
+database_url = os.environ.get('DATABASE_URL', 'sqlite:///mirror.db')
+if database_url.startswith('postgres://'):
+    database_url = database_url.replace('postgres://', 'postgresql://', 1)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+app.config['USE_LOCAL_MIRROR'] = os.environ.get('USE_LOCAL_MIRROR', '0') == '1'
+db.init_app(app)
+migrate = Migrate(app, db)
+
+def mirror_enabled():
+    return app.config.get('USE_LOCAL_MIRROR', False)
+
+def request_reads():
+    """Identity map delle letture della richiesta corrente (None fuori da una richiesta)"""
+    if not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+def read_once(key, loader):
+    """Esegue la lettura ``loader`` al massimo una volta per richiesta; la chiave inizia con la tabella"""
+    reads = request_reads()
+    return reads.get_or_load(key, loader) if reads is not None else loader()
+
+# Nelle formule un campo collegato vale i campi primari dei record collegati,
+# non i loro ID: FIND('rec…', ARRAYJOIN({User})) non trova niente. Il filtro
+# usa invece un campo lookup accanto a ogni collegamento, che riporta il campo
+# formula RECORD_ID() del record collegato. Se la base non ha il campo Airtable
+# rifiuta la formula (422): da lì in poi la coppia tabella/campi si filtra in
+# Python, scaricando la tabella
+LINKED_ID_FIELDS = {
+    ('Consumazioni', 'User'): 'User Record ID',
+    ('Consumazioni', 'Bar'): 'Bar Record ID',
+    ('Sorsi', 'Consumazioni Id'): 'Consumazione Record ID',
+    ('GameData', 'User'): 'User Record ID',
+}
+linked_filter_missing = set()
+
+def load_linked(table, links, fields=None, sort=None, max_records=None):
+    """
+    Record di ``table`` i cui campi collegati contengono gli ID indicati
+    (``links`` = {campo: record_id}), filtrati da Airtable sui campi di
+    LINKED_ID_FIELDS e ricontrollati in Python
+
+    Raises:
+        AirtableError: se Airtable risponde con un errore
+    """
+    key = (table, tuple(sorted(links)))
+
+    def matches(record):
+        record_fields = record.get('fields', {})
+        return all(record_id in record_fields.get(name, []) for name, record_id in links.items())
+
+    id_fields = {name: LINKED_ID_FIELDS.get((table, name)) for name in links}
+    if all(id_fields.values()) and key not in linked_filter_missing:
+        formula = aq.and_(*(aq.linked_contains(id_fields[name], record_id) for name, record_id in links.items()))
+        params = aq.build_params(formula=formula, sort=sort, max_records=max_records, fields=fields)
+        try:
+            return [record for record in airtable.iter_records(table, params=params) if matches(record)]
+        except AirtableError as e:
+            if e.status_code != 422:
+                raise
+            linked_filter_missing.add(key)
+            logger.error("[AIRTABLE] %s non ha i campi %s con gli ID collegati: filtro in Python (%s)",
+                         table, ', '.join(sorted(id_fields.values())), e)
+
+    params = aq.build_params(sort=sort, fields=fields)
+    records = [record for record in airtable.iter_records(table, params=params) if matches(record)]
+    return records[:max_records] if max_records else records
+
+def record_written(table, records):
+    """
+    Da chiamare dopo una scrittura riuscita su Airtable: scarta le letture della
+    tabella fatte in questa richiesta e riporta i record nel mirror (senza
+    bloccare la richiesta se il mirror fallisce)
+    """
+    reads = request_reads()
+    if reads is not None:
+        reads.invalidate(table)
+    if not mirror_enabled() or not records:
+        return
+    try:
+        mirror.upsert_records(table, records)
+    except Exception as e:
+        db.session.rollback()
+        logger.error("[MIRROR] Errore nell'aggiornamento di %s: %s", table, e)
+
+# === Journal write-behind ===
+# I sorsi e gli aggiornamenti delle consumazioni vengono confermati subito e
+# inviati ad Airtable in background; WRITE_BEHIND=0 torna alle scritture
+# sincrone. Le consumazioni nuove si creano in modo sincrono: il journal e gli
+# ID provvisori sono del singolo worker, mentre l'ID della consumazione finisce
+# in sessione e deve valere per tutti
+def _journal_flushed(table, records):
+    with app.app_context():
+        record_written(table, records)
+
+write_journal = None
+if os.environ.get('WRITE_BEHIND', '1') == '1':
+    write_journal = WriteJournal(
+        airtable,
+        os.environ.get('WRITE_JOURNAL_DIR', os.path.join(app.root_path, 'journal')),
+        on_flushed=_journal_flushed,
+        # Campo di testo di Sorsi e Consumazioni con l'ID provvisorio del
+        # record: senza, una creazione dall'esito incerto non viene reinviata
+        id_field=os.environ.get('WRITE_JOURNAL_ID_FIELD') or None
+    ).start()
+
+def merge_pending(records, pending):
+    """Aggiunge in coda ai record letti quelli ancora nel journal, che sono sempre i più recenti"""
+    if not pending:
+        return records
+    ids = {record['id'] for record in records}
+    return records + [record for record in pending if record['id'] not in ids]
+
+def init_db():
+    """Crea le tabelle del mirror e le popola da Airtable"""
+    db.create_all()
+    return mirror.refresh_all(airtable)
+
+@app.cli.command('mirror-refresh')
+def mirror_refresh_command():
+    """Ricarica il mirror locale da Airtable"""
+    with priority(ANALYTICS):
+        counts = init_db()
+    for table, count in counts.items():
+        click.echo(f"{table}: {count} record")
+
+@app.cli.command('mirror-sync')
+@click.option('--reconcile/--no-reconcile', default=None,
+              help='Forza o salta il controllo dei record eliminati')
+def mirror_sync_command(reconcile):
+    """Scarica da Airtable solo i record modificati dall'ultima sincronizzazione"""
+    db.create_all()
+    with priority(ANALYTICS):
+        results = mirror.sync_all(airtable, reconcile=reconcile)
+    for table, result in results.items():
+        click.echo(f"{table} ({result['mode']}): {result['upserted']} aggiornati, {result['deleted']} eliminati")
+
+@app.cli.command('history-rollup')
+@click.option('--days', default=2, show_default=True, help='Giorni (fino a oggi) da riepilogare')
+@click.option('--keep-raw', default=None, type=int, help='Elimina i dati grezzi più vecchi di questi giorni')
+def history_rollup_command(days, keep_raw):
+    """Calcola i riepiloghi dello storico delle letture (da lanciare periodicamente)"""
+    if weight_history is None:
+        raise click.ClickException('Storico delle letture disattivato (WEIGHT_HISTORY=0)')
+    today = datetime.now(pytz.utc).date()
+    done = weight_history.rollup_all(HISTORY_ROLLUPS, since=today - timedelta(days=days - 1))
+    click.echo(f"Riepiloghi aggiornati per {done} giorni/dispositivo")
+    if keep_raw is not None:
+        removed = weight_history.prune(today - timedelta(days=keep_raw))
+        click.echo(f"Dati grezzi eliminati per {removed} giorni/dispositivo")
+
+def get_bar_index():
+    """Indice dei bar (per ID e per città), ricostruito a ogni ricarica della cache"""
+    return reference_cache.get_or_load(
+        ('Bar',), lambda: BarIndex(airtable.get_all('Bar', params=aq.build_params(fields=BAR_FIELDS))))
 
 def get_bars(city=None):
-    logger.info(f"Richiesta get_bars con parametro city: {city}")
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
-    response = requests.get(url, headers=get_airtable_headers())
-    
-    # Log della risposta completa per debug
-    logger.info(f"Risposta completa da Airtable: {response.text[:200]}...")
-    
-    bars = response.json()['records']
-    logger.info(f"Recuperati {len(bars)} bar totali da Airtable")
-    
-    # Log dettagliato della struttura dati dei bar
-    if len(bars) > 0:
-        logger.info(f"STRUTTURA DEI DATI - Esempio di bar: {bars[0]}")
-        logger.info(f"CAMPI DISPONIBILI: {list(bars[0]['fields'].keys())}")
+    index = get_bar_index()
+    bars = index.bars
     
     if city:
-        # Filtra i bar per città
-        logger.info(f"Filtraggio bar per città: {city}")
-        # Log delle città disponibili per debug
-        available_cities = set(bar['fields'].get('Città', '') for bar in bars if 'Città' in bar['fields'])
-        logger.info(f"Città disponibili nei dati: {available_cities}")
-        
-        # Log dei primi 5 bar e delle loro città per debug
-        for i, bar in enumerate(bars[:5]):
-            logger.info(f"Bar {i+1}: ID={bar['id']}, Città={bar['fields'].get('Città', 'N/A')}")
-            logger.info(f"TUTTI I CAMPI del Bar {i+1}: {bar['fields']}")
-        
-        
-        # Rendi il filtraggio insensibile alle maiuscole/minuscole
-        city_lower = city.lower() if city else ''
-        filtered_bars = []
-        for bar in bars:
-            bar_city = bar['fields'].get('Città', '')
-            if bar_city and bar_city.lower() == city_lower:
-                filtered_bars.append(bar)
-                logger.info(f"Match trovato: Bar '{bar['fields'].get('Nome', 'N/A')}' in città '{bar_city}'")
-        
-        logger.info(f"Bar filtrati per {city}: {len(filtered_bars)}")
+        # Filtra i bar per città (insensibile alle maiuscole/minuscole) usando l'indice
+        filtered_bars = index.in_city(city)
+        logger.debug("Bar filtrati per %s: %s su %s", city, len(filtered_bars), len(bars))
         return filtered_bars
     return bars
 
 def get_cities():
     """Ottiene l'elenco delle città dai bar disponibili"""
-    bars = get_bars()
-    # Estrai tutte le città uniche
-    cities = set(bar['fields'].get('Città', '') for bar in bars if 'Città' in bar['fields'])
-    # Rimuovi città vuote
-    cities = [city for city in cities if city]
-    # Ordina le città
-    return sorted(cities)
+    # Città uniche, non vuote e già ordinate dall'indice
+    return list(get_bar_index().cities)
 
-def get_drinks(bar_id=None):
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
-    response = requests.get(url, headers=get_airtable_headers())
-    drinks = response.json()['records']
+def _load_drinks():
+    """Scarica la tabella Drinks da Airtable e ne costruisce l'indice (usata per riempire la cache)"""
+    drinks = airtable.get_all('Drinks', params=aq.build_params(fields=DRINK_FIELDS))
     
     # Processa i drink per assicurarsi che il campo Speciale sia sempre presente
     for drink in drinks:
@@ -351,19 +914,33 @@ def get_drinks(bar_id=None):
             # Se il campo Speciale non esiste, impostalo a False
             if 'Speciale' not in drink['fields']:
                 drink['fields']['Speciale'] = False
+    return DrinkIndex(drinks)
+
+def get_drink_index():
+    """Indice dei drink (per ID e per bar), ricostruito a ogni ricarica della cache"""
+    return reference_cache.get_or_load(('Drinks',), _load_drinks)
+
+def get_drinks(bar_id=None):
+    index = get_drink_index()
     
     if bar_id:
-        filtered_drinks = [d for d in drinks if bar_id in d['fields'].get('Bar', [])]
-        return filtered_drinks
-    return drinks
+        return index.for_bar(bar_id)
+    return index.drinks
 
-def get_drink_by_id(drink_id):
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks/{drink_id}'
-    response = requests.get(url, headers=get_airtable_headers())
+def _load_drink(drink_id):
+    response = airtable.get('Drinks', drink_id)
     if response.status_code == 200:
-        return response.json()
+        return aq.project(response.json(), DRINK_FIELDS)
     return None
 
+def get_drink_by_id(drink_id):
+    # Se l'indice dei drink è già in cache basta un accesso al dizionario
+    index = reference_cache.get(('Drinks',), allow_stale=True)
+    drink = index.get(drink_id) if index else None
+    if drink:
+        return drink
+    return reference_cache.get_or_load(('Drinks', drink_id), lambda: _load_drink(drink_id))
+
 # Cache per gli utenti, con chiave = email
 user_cache = {}
 
@@ -371,16 +948,13 @@ def get_user_by_email(email):
     """Recupera un utente dall'API di Airtable o dalla cache"""
     # Controlla se l'utente è già nella cache
     if email in user_cache:
-        print(f"DEBUG: Utente {email} recuperato dalla cache")
+        logger.debug("Utente %s recuperato dalla cache", email)
         return user_cache[email]
     
     # Altrimenti fa la richiesta all'API
-    print(f"DEBUG: Utente {email} richiesto ad Airtable")
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Users'
-    params = {
-        'filterByFormula': f"{{Email}}='{email}'"
-    }
-    response = requests.get(url, headers=get_airtable_headers(), params=params)
+    logger.debug("Utente %s richiesto ad Airtable", email)
+    params = aq.build_params(formula=aq.eq('Email', email), max_records=1, fields=USER_FIELDS)
+    response = airtable.get('Users', params=params)
     records = response.json().get('records', [])
     
     user = records[0] if records else None
@@ -392,11 +966,8 @@ def get_user_by_email(email):
     return user
 
 def create_user(email, password_hash, peso_kg, genere):
-    logger.info(f"[CREATE_USER] Lunghezza hash password da salvare: {len(password_hash)} per email: {email}")
-    logger.info(f"[CREATE_USER] Hash password da salvare: {password_hash}")
     if len(password_hash) < 100:
-        logger.error(f"[CREATE_USER] ATTENZIONE: hash password troppo corto per email: {email} - Hash: {password_hash}")
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Users'
+        logger.error("[CREATE_USER] ATTENZIONE: hash password troppo corto (%s caratteri) per email: %s", len(password_hash), email)
     data = {
         'records': [{
             'fields': {
@@ -407,16 +978,15 @@ def create_user(email, password_hash, peso_kg, genere):
             }
         }]
     }
-    response = requests.post(url, headers=get_airtable_headers(), json=data)
+    response = airtable.post('Users', data)
     response_json = response.json()
-    print(f"AIRTABLE CREATE USER STATUS CODE: {response.status_code}")
-    print(f"AIRTABLE CREATE USER RESPONSE: {response_json}")
+    logger.debug("[CREATE_USER] Airtable ha risposto %s", response.status_code)
     
     if response.status_code != 200 or 'records' not in response_json:
         # Gestione più robusta dell'errore
         error_message = response_json.get('error', {}).get('message', 'Errore sconosciuto da Airtable')
         detailed_error = response_json.get('error', {}).get('type', '')
-        print(f"Errore durante la creazione dell'utente in Airtable: {error_message} (Tipo: {detailed_error})")
+        logger.error("Errore durante la creazione dell'utente in Airtable: %s (Tipo: %s)", error_message, detailed_error)
         # Potresti voler sollevare un'eccezione personalizzata o restituire None/un messaggio d'errore specifico
         # Per ora, per coerenza con il traceback, se manca 'records' continuerà a dare KeyError,
         # ma avremo il log dell'errore.
@@ -425,6 +995,7 @@ def create_user(email, password_hash, peso_kg, genere):
         # return None # O sollevare un'eccezione
         pass # Lascia che il KeyError avvenga dopo il log, per ora, per mantenere il comportamento del traceback originale
 
+    record_written('Users', response_json['records'])
     return response_json['records'][0]
 
 def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pieno_bool, timestamp_consumazione=None):
@@ -434,7 +1005,7 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
     # 1. Recupera dati utente (peso, genere)
     user_data = get_user_by_id(user_id)
     if not user_data or 'fields' not in user_data:
-        print(f"Errore: Utente {user_id} non trovato o dati incompleti.")
+        logger.error("Errore: Utente %s non trovato o dati incompleti.", user_id)
         return None
     
     user_fields = user_data['fields']
@@ -442,25 +1013,25 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
     genere_utente = user_fields.get('Genere')
 
     if peso_utente_kg is None or genere_utente is None:
-        print(f"Errore: Peso o Genere mancanti per l'utente {user_id}.")
+        logger.error("Errore: Peso o Genere mancanti per l'utente %s.", user_id)
         return None
 
     # 2. Recupera dati drink (gradazione, alcolico)
     drink_data = get_drink_by_id(drink_id)
     if not drink_data or 'fields' not in drink_data:
-        print(f"Errore: Drink {drink_id} non trovato o dati incompleti.")
+        logger.error("Errore: Drink %s non trovato o dati incompleti.", drink_id)
         return None
 
     drink_fields = drink_data['fields']
-    print(f"DEBUG SIMULA: Dati del drink recuperati da Airtable: {drink_fields}")
+    logger.debug("[SIMULA] Dati del drink recuperati da Airtable: %s", drink_fields)
     
     gradazione_drink = drink_fields.get('Gradazione')
     valore_alcolico_da_airtable = drink_fields.get('Alcolico (bool)')
     is_alcolico = True if valore_alcolico_da_airtable == '1' else False
     
-    print(f"DEBUG SIMULA: gradazione_drink={gradazione_drink}, tipo={type(gradazione_drink)}")
-    print(f"DEBUG SIMULA: valore_alcolico_da_airtable={valore_alcolico_da_airtable}, tipo={type(valore_alcolico_da_airtable)}")
-    print(f"DEBUG SIMULA: is_alcolico={is_alcolico}, tipo={type(is_alcolico)}")
+    logger.debug("[SIMULA] gradazione_drink=%s, tipo=%s", gradazione_drink, type(gradazione_drink))
+    logger.debug("[SIMULA] valore_alcolico_da_airtable=%s, tipo=%s", valore_alcolico_da_airtable, type(valore_alcolico_da_airtable))
+    logger.debug("[SIMULA] is_alcolico=%s, tipo=%s", is_alcolico, type(is_alcolico))
 
     tasso_calcolato = 0.0
     esito_calcolo = 'Negativo'
@@ -473,7 +1044,7 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
         
         genere_str = str(genere_utente).lower()
         if genere_str not in ['uomo', 'donna']:
-            print(f"Errore: Genere non valido '{genere_str}' per l'utente {user_id}.")
+            logger.error("Errore: Genere non valido '%s' per l'utente %s.", genere_str, user_id)
             return None 
 
         stomaco_per_algoritmo = stomaco_str.lower()
@@ -501,7 +1072,6 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
         esito_calcolo = 'Negativo'
 
     # 4. Salva in Airtable
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Consumazioni'
     data_to_save = {
         'records': [{
             'fields': {
@@ -515,13 +1085,13 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
             }
         }]
     }
-    response = requests.post(url, headers=get_airtable_headers(), json=data_to_save)
+    response = airtable.post('Consumazioni', data_to_save)
     response_data = response.json()
     
     if response.status_code != 200 or 'records' not in response_data:
-        print(f"Errore Airtable durante la creazione della consumazione: {response.status_code}")
-        print(f"Risposta: {response_data}")
+        logger.error("Errore Airtable durante la creazione della consumazione: %s - %s", response.status_code, response_data)
         return None
+    record_written('Consumazioni', response_data['records'])
 
     # 5. Aggiorna i dati di gioco
     game_data = get_game_data(user_id)
@@ -559,64 +1129,113 @@ def create_consumazione(user_id, drink_id, bar_id, peso_cocktail_g, stomaco_pien
     return response_data['records'][0]
 
 def get_user_consumazioni(user_id=None, bar_id=None):
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Consumazioni'
-    
+    """Consumazioni filtrate per utente e/o bar, incluse quelle ancora nel journal"""
+    consumazioni = read_once(('Consumazioni', 'query', user_id, bar_id),
+                             lambda: _load_user_consumazioni(user_id, bar_id))
+    if not write_journal:
+        return consumazioni
+    
+    pending = [
+        c for c in write_journal.pending_records('Consumazioni')
+        if (not user_id or user_id in c['fields'].get('User', []))
+        and (not bar_id or bar_id in c['fields'].get('Bar', []))
+    ]
+    consumazioni = [write_journal.apply_pending('Consumazioni', c) for c in consumazioni]
+    return merge_pending(consumazioni, pending)
+
+def _load_user_consumazioni(user_id=None, bar_id=None):
     # Debug print to understand the input
-    print(f'DEBUG: get_user_consumazioni called with user_id={user_id}, bar_id={bar_id}')
+    logger.debug('get_user_consumazioni called with user_id=%s, bar_id=%s', user_id, bar_id)
     
-    # Get all records and filter manually in Python
-    # This is more reliable than using Airtable formulas for array fields
-    response = requests.get(url, headers=get_airtable_headers())
+    if mirror_enabled():
+        return mirror.get_user_consumazioni(user_id, bar_id)
     
-    if response.status_code != 200:
-        print(f'ERROR: Failed to fetch consumazioni. Status code: {response.status_code}')
+    links = {}
+    if user_id:
+        links['User'] = user_id
+    if bar_id:
+        links['Bar'] = bar_id
+    try:
+        if not links:
+            return airtable.get_all('Consumazioni', params=aq.build_params(fields=CONSUMAZIONE_FIELDS))
+        # Filtro lato Airtable sugli ID dei record collegati (vedi load_linked)
+        filtered_records = load_linked('Consumazioni', links, fields=CONSUMAZIONE_FIELDS)
+    except AirtableError as e:
+        logger.error('Failed to fetch consumazioni. Status code: %s', e.status_code)
         return []
-    
-    all_records = response.json().get('records', [])
-    print(f'DEBUG: Retrieved {len(all_records)} total records')
-    
-    # If no filters, return all records
-    if not user_id and not bar_id:
-        return all_records
-    
-    # Manual filtering in Python
-    filtered_records = []
-    for record in all_records:
-        fields = record.get('fields', {})
-        users = fields.get('User', [])
-        bars = fields.get('Bar', [])
-        
-        # Apply filters based on parameters
-        if user_id and bar_id:
-            if user_id in users and bar_id in bars:
-                filtered_records.append(record)
-        elif user_id:
-            if user_id in users:
-                filtered_records.append(record)
-        elif bar_id:
-            if bar_id in bars:
-                filtered_records.append(record)
-    
-    print(f'DEBUG: Filtered to {len(filtered_records)} records for user_id={user_id}, bar_id={bar_id}')
+
+    logger.debug('Filtered to %s records for user_id=%s, bar_id=%s', len(filtered_records), user_id, bar_id)
     return filtered_records
 
 def get_bar_by_id(bar_id):
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Bar/{bar_id}'
-    response = requests.get(url, headers=get_airtable_headers())
-    return response.json()
+    index = reference_cache.get(('Bar',), allow_stale=True)
+    if index and index.get(bar_id):
+        return index.get(bar_id)
+    try:
+        return reference_cache.get_or_load(('Bar', bar_id), lambda: _load_bar(bar_id))
+    except requests.RequestException as e:
+        # Usata anche da base.html: senza Airtable la pagina va mostrata lo stesso
+        logger.warning("Bar %s non disponibile: %s", bar_id, e)
+        return None
+
+def _load_bar(bar_id):
+    response = airtable.get('Bar', bar_id)
+    if response.status_code == 200:
+        return aq.project(response.json(), BAR_FIELDS)
+    return None
 
 def get_user_by_id(user_id):
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Users/{user_id}'
-    response = requests.get(url, headers=get_airtable_headers())
+    return read_once(('Users', user_id), lambda: _load_user(user_id))
+
+def _load_user(user_id):
+    response = airtable.get('Users', user_id)
     if response.status_code == 200:
-        return response.json()
+        return aq.project(response.json(), USER_FIELDS)
     return None
 
+def _get_reference_records(table, index, record_ids):
+    """Risolve più ID di Bar/Drinks dall'indice in cache, leggendo in blocco solo quelli mancanti"""
+    records = {}
+    missing = []
+    for record_id in dict.fromkeys(record_id for record_id in record_ids if record_id):
+        record = index.get(record_id) or reference_cache.get((table, record_id), allow_stale=True)
+        if record:
+            records[record_id] = record
+        else:
+            missing.append(record_id)
+    
+    if missing:
+        try:
+            params = aq.build_params(fields=REFERENCE_FIELDS[table])
+            for record_id, record in airtable.get_records(table, missing, params=params).items():
+                reference_cache.set((table, record_id), record)
+                records[record_id] = record
+        except (AirtableError, requests.RequestException) as e:
+            logger.error("Errore nel recupero in blocco da %s: %s", table, e)
+    return records
+
+def get_drinks_by_ids(drink_ids):
+    """Recupera più drink per ID: {id: record}"""
+    return _get_reference_records('Drinks', get_drink_index(), drink_ids)
+
+def get_bars_by_ids(bar_ids):
+    """Recupera più bar per ID: {id: record}"""
+    return _get_reference_records('Bar', get_bar_index(), bar_ids)
+
+def get_users_by_ids(user_ids, fields=USER_FIELDS):
+    """Recupera più utenti per ID con richieste OR(RECORD_ID()=...) a blocchi: {id: record}"""
+    try:
+        return airtable.get_records('Users', user_ids, params=aq.build_params(fields=fields))
+    except AirtableError as e:
+        logger.error("Errore nel recupero in blocco degli utenti: %s", e)
+        return {}
+
 # === CONTEXT PROCESSORS ===
 @app.context_processor
 def utility_processor():
     return {
-        'get_bar_by_id': get_bar_by_id
+        'get_bar_by_id': get_bar_by_id,
+        'server_sip_detection': SERVER_SIP_DETECTION
     }
 
 # === ROTTE ===
@@ -633,10 +1252,10 @@ def register():
         peso_kg_str = request.form.get('peso_kg') # Recupera peso
         genere = request.form.get('genere')      # Recupera genere
 
-        logger.info(f"[REGISTER] Tentativo di registrazione per email: {email}")
+        logger.info("[REGISTER] Tentativo di registrazione per email: %s", email)
 
         if not peso_kg_str or not genere:
-            logger.warning(f"[REGISTER] Peso o genere mancanti per email: {email}")
+            logger.warning("[REGISTER] Peso o genere mancanti per email: %s", email)
             flash('Peso e Genere sono campi obbligatori.')
             return redirect(url_for('register'))
         
@@ -645,29 +1264,28 @@ def register():
             if peso_kg <= 0:
                 raise ValueError("Il peso deve essere positivo.")
         except ValueError as e:
-            logger.warning(f"[REGISTER] Peso non valido per email: {email} - Errore: {e}")
+            logger.warning("[REGISTER] Peso non valido per email: %s - Errore: %s", email, e)
             flash(f'Valore del peso non valido: {e}')
             return redirect(url_for('register'))
 
         if get_user_by_email(email):
-            logger.warning(f"[REGISTER] Email già registrata: {email}")
+            logger.warning("[REGISTER] Email già registrata: %s", email)
             flash('Email già registrata.')
             return redirect(url_for('register'))
 
         try:
             # Usa il nuovo sistema di hashing semplice
             secure_hash = hash_password(password)
-            logger.info(f"[REGISTER] Hash password generato con successo per email: {email}")
-            logger.info(f"[REGISTER] Lunghezza hash generato: {len(secure_hash)} - Hash: {secure_hash}")
+            logger.info("[REGISTER] Hash password generato con successo per email: %s", email)
             
             # Crea l'utente nel database
             create_user(email, secure_hash, peso_kg, genere)
-            logger.info(f"[REGISTER] Utente creato con successo: {email}")
+            logger.info("[REGISTER] Utente creato con successo: %s", email)
             
             flash('Registrazione avvenuta con successo! Effettua il login.')
             return redirect(url_for('login'))
         except Exception as e:
-            logger.error(f"[REGISTER] Errore nella registrazione per email: {email} - Errore: {e}")
+            logger.error("[REGISTER] Errore nella registrazione per email: %s - Errore: %s", email, e)
             flash('Errore interno nella registrazione. Contatta il supporto.')
             return redirect(url_for('register'))
             
@@ -680,37 +1298,36 @@ def debug_all_tables():
     
     for table_name in tables:
         try:
-            # Attempt to get records from this table
-            url = f'https://api.airtable.com/v0/{BASE_ID}/{table_name}'
-            headers = get_airtable_headers()
-            response = requests.get(url, headers=headers)
+            # A full sample record for the structure; the count only needs the ids,
+            # so every other page is fetched with a single light field
+            response = airtable.get(table_name, params=aq.build_params(max_records=1))
+            if response.status_code != 200:
+                raise AirtableError(response)
+            records = response.json().get('records', [])
             
-            if response.status_code == 200:
-                data = response.json()
-                records = data.get('records', [])
+            if records:
+                # Get the first record as a sample
+                sample_record = records[0]
+                field_names = list(sample_record.get('fields', {}).keys())
+                id_params = aq.build_params(fields=[mirror.KEY_FIELDS[table_name]])
                 
-                if records:
-                    # Get the first record as a sample
-                    sample_record = records[0]
-                    field_names = list(sample_record.get('fields', {}).keys())
-                    
-                    # Save table info
-                    result[table_name] = {
-                        'record_count': len(records),
-                        'field_names': field_names,
-                        'sample_record': sample_record
-                    }
-                else:
-                    result[table_name] = {
-                        'status': 'empty',
-                        'message': 'No records found in table'
-                    }
+                # Save table info
+                result[table_name] = {
+                    'record_count': sum(len(page) for page in airtable.iter_pages(table_name, params=id_params)),
+                    'field_names': field_names,
+                    'sample_record': sample_record
+                }
             else:
                 result[table_name] = {
-                    'status': 'error',
-                    'message': f'API error: {response.status_code}',
-                    'details': response.text if response.text else 'No details available'
+                    'status': 'empty',
+                    'message': 'No records found in table'
                 }
+        except AirtableError as e:
+            result[table_name] = {
+                'status': 'error',
+                'message': f'API error: {e.status_code}',
+                'details': str(e)
+            }
         except Exception as e:
             result[table_name] = {
                 'status': 'exception',
@@ -722,38 +1339,31 @@ def debug_all_tables():
 @app.route('/debug_drinks', methods=['GET'])
 def debug_drinks():
     """Temporary route to debug Drinks table"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
-    headers = get_airtable_headers()
-    response = requests.get(url, headers=headers)
+    try:
+        records = airtable.get_all('Drinks', params=aq.build_params(fields=DRINK_FIELDS))
+    except AirtableError as e:
+        return jsonify({'success': False, 'error': f'API error: {e.status_code}'})
     
-    if response.status_code == 200:
-        data = response.json()
-        records = data.get('records', [])
+    # Check if we have records
+    if records:
+        # Get all fields from the first record
+        sample_record = records[0]
+        field_names = list(sample_record.get('fields', {}).keys())
         
-        # Check if we have records
-        if records:
-            # Get all fields from the first record
-            sample_record = records[0]
-            field_names = list(sample_record.get('fields', {}).keys())
-            
-            # Return all drinks and their details
-            return jsonify({
-                'success': True,
-                'drink_count': len(records),
-                'field_names': field_names,
-                'drinks': records
-            })
-        else:
-            return jsonify({'success': False, 'error': 'No drinks found in Airtable'})
+        # Return all drinks and their details
+        return jsonify({
+            'success': True,
+            'drink_count': len(records),
+            'field_names': field_names,
+            'drinks': records
+        })
     else:
-        return jsonify({'success': False, 'error': f'API error: {response.status_code}'})
+        return jsonify({'success': False, 'error': 'No drinks found in Airtable'})
 
 @app.route('/debug_airtable', methods=['GET'])
 def debug_airtable():
     """Temporary route to debug Airtable field names"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Consumazioni'
-    headers = get_airtable_headers()
-    response = requests.get(url, headers=headers)
+    response = airtable.get('Consumazioni', params=aq.build_params(max_records=1))
     
     if response.status_code == 200:
         data = response.json()
@@ -774,61 +1384,70 @@ def debug_airtable():
     else:
         return jsonify({'success': False, 'error': f'API error: {response.status_code}'})
 
+@app.route('/debug_airtable_stats', methods=['GET'])
+def debug_airtable_stats():
+    """Contatori di chiamate e latenza verso Airtable, stato del circuito e delle code, statistiche della cache e del journal"""
+    return jsonify({
+        'airtable': airtable.get_stats(),
+        'reference_cache': reference_cache.get_stats(),
+        'circuit_breaker': airtable_breaker.get_stats(),
+        'rate_governor': airtable_governor.get_stats() if airtable_governor else None,
+        'write_journal': write_journal.get_stats() if write_journal else None,
+        'devices': devices.get_stats(),
+        'shared_readings': shared_readings.get_stats() if shared_readings else None
+    })
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
         user_type = request.form.get('user_type', 'utente')
-        logger.info(f"[LOGIN] Tentativo di login per email: {email} come {user_type}")
+        logger.info("[LOGIN] Tentativo di login per email: %s come %s", email, user_type)
 
         # Seleziona la tabella appropriata in base al tipo di utente
         table_name = 'Users' if user_type == 'utente' else 'Locali'
-        url = f'https://api.airtable.com/v0/{BASE_ID}/{table_name}'
-        headers = get_airtable_headers()
-        params = {
-            'filterByFormula': f"{{Email}}='{email}'"
-        }
+        params = aq.build_params(formula=aq.eq('Email', email), max_records=1, fields=['Email', 'Password'])
         
-        logger.info(f"[LOGIN] Ricerca in tabella: {table_name}")
-        response = requests.get(url, headers=headers, params=params)
+        logger.debug("[LOGIN] Ricerca in tabella: %s", table_name)
+        response = airtable.get(table_name, params=params)
         
         if response.status_code == 200:
             records = response.json().get('records', [])
             user = records[0] if records else None
-            logger.info(f"[LOGIN] Record trovato: {user is not None}")
+            logger.debug("[LOGIN] Record trovato: %s", user is not None)
         else:
             user = None
-            logger.error(f"[LOGIN] Errore nella richiesta Airtable: {response.status_code}")
+            logger.error("[LOGIN] Errore nella richiesta Airtable: %s", response.status_code)
 
         result = False
         if user:
             try:
                 stored_password = user['fields'].get('Password')
-                logger.info(f"[LOGIN] Password memorizzata trovata: {stored_password is not None}")
+                logger.debug("[LOGIN] Password memorizzata trovata: %s", stored_password is not None)
                 
                 # Per i locali, la password è salvata come hash SHA-256
                 if user_type == 'locale':
                     hashed_input = hashlib.sha256(password.encode()).hexdigest()
                     result = stored_password == hashed_input
-                    logger.info(f"[LOGIN] Verifica hash per locale: {result}")
+                    logger.debug("[LOGIN] Verifica hash per locale: %s", result)
                 else:
                     # Per gli utenti normali, usa il sistema PBKDF2
                     result = verify_password(stored_password, password)
-                    logger.info(f"[LOGIN] Verifica hash per utente: {result}")
+                    logger.debug("[LOGIN] Verifica hash per utente: %s", result)
             except Exception as e:
-                logger.error(f"[LOGIN] Errore nella verifica dell'hash per email {email}: {e}")
+                logger.error("[LOGIN] Errore nella verifica dell'hash per email %s: %s", email, e)
                 result = False
         else:
-            logger.warning(f"[LOGIN] {user_type.capitalize()} non trovato per email: {email}")
+            logger.warning("[LOGIN] %s non trovato per email: %s", user_type.capitalize(), email)
 
         if result:
             SessionManager.init_session(user['id'], email)
             session['user_type'] = user_type
-            logger.info(f"[LOGIN] Login riuscito per {user_type} con email: {email}")
+            logger.info("[LOGIN] Login riuscito per %s con email: %s", user_type, email)
             return redirect(url_for('home'))
         else:
-            logger.warning(f"[LOGIN] Login fallito per {user_type} con email: {email}")
+            logger.warning("[LOGIN] Login fallito per %s con email: %s", user_type, email)
             flash('Credenziali errate')
             return redirect(url_for('login'))
 
@@ -868,10 +1487,21 @@ def world():
     try:
         user_id = SessionManager.get_user_id()
         
-        # Statistiche globali del sistema
-        all_consumazioni = get_all_consumazioni()
-        all_bars = get_bars()
-        all_drinks = get_drinks()
+        if mirror_enabled():
+            # Statistiche calcolate con query aggregate sul mirror locale
+            return render_template('world.html', **mirror.world_stats(user_id))
+        
+        # Statistiche globali del sistema: le quattro letture sono indipendenti
+        loaded = fanout.run({
+            'consumazioni': lambda: get_all_consumazioni(fields=['User', 'Drink', 'Bar']),
+            'bar_index': get_bar_index,
+            'drink_index': get_drink_index,
+            'users': lambda: airtable.get_all('Users', params=aq.build_params(fields=['Email'])),
+        })
+        all_consumazioni = loaded['consumazioni']
+        bar_index = loaded['bar_index']
+        drink_index = loaded['drink_index']
+        all_bars = bar_index.bars
         
         # Calcola statistiche globali
         totale_consumazioni = len(all_consumazioni)
@@ -880,13 +1510,7 @@ def world():
         # Stima il numero di sorsi (senza richiamare i sorsi reali)
         totale_sorsi = totale_consumazioni * 5
         
-        # Otteniamo prima tutti gli utenti in una sola chiamata
-        url = f'https://api.airtable.com/v0/{BASE_ID}/Users'
-        response = requests.get(url, headers=get_airtable_headers())
-        all_users = {}
-        if response.status_code == 200:
-            for user in response.json().get('records', []):
-                all_users[user['id']] = user
+        all_users = {user['id']: user for user in loaded['users']}
         
         # Top users (classifica globale)
         user_counts = {}
@@ -910,7 +1534,7 @@ def world():
         for cons in all_consumazioni:
             if 'Drink' in cons['fields'] and cons['fields']['Drink']:
                 drink_id = cons['fields']['Drink'][0]
-                drink = next((d for d in all_drinks if d['id'] == drink_id), None)
+                drink = drink_index.get(drink_id)
                 drink_name = 'N/D'
                 if drink and 'fields' in drink and 'Name' in drink['fields']:
                     drink_name = drink['fields']['Name']
@@ -926,7 +1550,7 @@ def world():
         for cons in all_consumazioni:
             if 'Bar' in cons['fields'] and cons['fields']['Bar']:
                 bar_id = cons['fields']['Bar'][0]
-                bar = next((b for b in all_bars if b['id'] == bar_id), None)
+                bar = bar_index.get(bar_id)
                 bar_name = 'N/D'
                 if bar and 'fields' in bar and 'Name' in bar['fields']:
                     bar_name = bar['fields']['Name']
@@ -947,10 +1571,9 @@ def world():
         
         # Calcolo statistiche personali
         if num_consumazioni_utente > 0:
-            # Recupera tutti i sorsi dell'utente
+            # Recupera tutti i sorsi dell'utente, una consumazione per thread
             all_sorsi = []
-            for consumazione in raw_consumazioni_utente:
-                sorsi = get_sorsi_by_consumazione(consumazione['id'])
+            for sorsi in fanout.map(get_sorsi_by_consumazione, [c['id'] for c in raw_consumazioni_utente]):
                 all_sorsi.extend(sorsi)
             
             # Calcola il BAC medio e la percentuale di positivi dai sorsi
@@ -971,7 +1594,7 @@ def world():
             for cons in raw_consumazioni_utente:
                 if 'Drink' in cons['fields'] and cons['fields']['Drink']:
                     drink_id = cons['fields']['Drink'][0]
-                    drink = next((d for d in all_drinks if d['id'] == drink_id), None)
+                    drink = drink_index.get(drink_id)
                     drink_name = 'N/D'
                     if drink and 'fields' in drink and 'Name' in drink['fields']:
                         drink_name = drink['fields']['Name']
@@ -980,7 +1603,7 @@ def world():
             if drink_counts_utente:
                 drink_preferito_utente = max(drink_counts_utente.items(), key=lambda x: x[1])[0]
     except Exception as e:
-        print(f"Errore in World: {str(e)}")
+        logger.error("Errore in World: %s", e)
         flash('Si è verificato un errore nel caricamento delle statistiche globali.', 'error')
     
     return render_template('world.html',
@@ -995,28 +1618,162 @@ def world():
                           perc_esiti_positivi_utente=perc_esiti_positivi_utente,
                           drink_preferito_utente=drink_preferito_utente)
 
-def get_all_consumazioni():
+def get_all_consumazioni(fields=CONSUMAZIONE_FIELDS):
     """Recupera tutte le consumazioni dal sistema"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Consumazioni'
-    response = requests.get(url, headers=get_airtable_headers())
-    
-    if response.status_code == 200:
-        return response.json().get('records', [])
-    
-    print(f"ERRORE GET_ALL_CONSUMAZIONI: {response.status_code}")
-    return []
+    try:
+        return airtable.get_all('Consumazioni', params=aq.build_params(fields=fields))
+    except AirtableError as e:
+        logger.error("Errore in get_all_consumazioni: %s", e.status_code)
+        return []
 
 
 @app.route('/get_arduino_data')
 @login_required
 def get_arduino_data():
-    """Ottiene l'ultimo dato inviato da Arduino"""
-    global dato_da_arduino, timestamp_dato
+    """Ultimo dato e letture recenti del sottobicchiere collegato all'utente (?since= per le sole nuove)"""
+    device_id = bound_device_id()
+    since = request.args.get('since', type=float)
+    latest = latest_reading(device_id)
     
     return jsonify({
-        'peso': dato_da_arduino,
-        'timestamp': timestamp_dato
+        'device_id': device_id,
+        'peso': latest[1] if latest else None,
+        'timestamp': latest[0] if latest else None,
+        'samples': devices.samples(device_id, since=since, limit=ARDUINO_SAMPLES_LIMIT),
+        'stato': sip_engine.state(device_id)
+    })
+
+# Ogni quanto lo stream manda un commento per tenere aperta la connessione
+SSE_HEARTBEAT = 15
+# Ogni quanto lo stream controlla le letture ricevute dagli altri worker
+SSE_SHARED_POLL = 0.5
+# Durata massima di uno stream: poi il browser si riconnette da solo (con
+# Last-Event-ID) e il thread del worker torna libero. È breve come un long
+# polling così anche un worker sync non resta occupato a lungo; con i worker
+# gthread di gunicorn.conf.py si può allungare
+SSE_MAX_DURATION = int(os.environ.get('SSE_MAX_DURATION', '25'))
+# Stream aperti al massimo in un worker: ognuno tiene occupato un thread, e
+# senza un limite gli stream si prenderebbero tutti i thread lasciando in coda
+# le altre richieste. Deve restare sotto i thread del worker (gunicorn.conf.py)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '8'))
+# Dopo quanti millisecondi il browser riprova quando il limite è raggiunto
+SSE_BUSY_RETRY = 5000
+
+sse_streams = {'active': 0, 'rejected': 0}
+sse_streams_lock = threading.Lock()
+
+def acquire_sse_stream():
+    """Prende un posto per uno stream in questo worker; False se sono tutti occupati"""
+    with sse_streams_lock:
+        if sse_streams['active'] >= SSE_MAX_STREAMS:
+            sse_streams['rejected'] += 1
+            return False
+        sse_streams['active'] += 1
+        return True
+
+def release_sse_stream():
+    with sse_streams_lock:
+        sse_streams['active'] -= 1
+
+def sse_event(event, data, event_id=None):
+    """Un evento nel formato text/event-stream"""
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/stream_arduino_data')
+@login_required
+def stream_arduino_data():
+    """
+    Server-Sent Events con le letture del sottobicchiere collegato all'utente.
+
+    Manda un evento ``peso`` (stessi campi di /get_arduino_data) solo quando
+    arrivano letture nuove e un heartbeat ogni SSE_HEARTBEAT secondi. Le
+    letture ricevute da questo worker svegliano subito lo stream; quelle
+    ricevute dagli altri si vedono nella tabella condivisa entro
+    SSE_SHARED_POLL secondi (solo l'ultima, senza le precedenti). L'id di
+    ogni evento è l'istante dell'ultima lettura: riconnettendosi il browser lo
+    rimanda in Last-Event-ID e riceve solo quello che si è perso.
+
+    Oltre SSE_MAX_STREAMS stream aperti nel worker risponde 503, con
+    Retry-After e un campo ``retry:`` per il browser.
+    """
+    device_id = bound_device_id()
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = float(since) if since else None
+    except ValueError:
+        since = None
+    
+    def events(since):
+        yield 'retry: 2000\n\n'
+        yield sse_event('device', {'device_id': device_id})
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        poll = SSE_SHARED_POLL if shared_readings is not None else SSE_HEARTBEAT
+        last_sent = time.monotonic()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            samples = devices.wait_for(device_id, since=since, timeout=min(poll, remaining),
+                                       limit=ARDUINO_SAMPLES_LIMIT)
+            if not samples:
+                latest = latest_reading(device_id)
+                if latest is not None and (since is None or latest[0] > since):
+                    samples = [latest]
+            if samples:
+                last_sent = time.monotonic()
+                since, peso = samples[-1]
+                yield sse_event('peso', {
+                    'device_id': device_id,
+                    'peso': peso,
+                    'timestamp': since,
+                    'samples': samples,
+                    'stato': sip_engine.state(device_id)
+                }, event_id=repr(since))
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT:
+                last_sent = time.monotonic()
+                yield ': heartbeat\n\n'
+    
+    if not acquire_sse_stream():
+        logger.warning("[SSE] %d stream già aperti in questo worker, richiesta rifiutata", SSE_MAX_STREAMS)
+        return Response(f'retry: {SSE_BUSY_RETRY}\n\n', status=503, mimetype='text/event-stream', headers={
+            'Retry-After': str(SSE_BUSY_RETRY // 1000),
+            'Cache-Control': 'no-cache'
+        })
+    response = Response(events(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
+    # Il server chiude la risposta anche se il client se ne va prima del
+    # primo evento (il generatore non parte e il suo finally non girerebbe)
+    response.call_on_close(release_sse_stream)
+    return response
+
+@app.route('/bind_device', methods=['POST'])
+@login_required
+def bind_device():
+    """Collega un sottobicchiere all'utente e alla sua consumazione attiva"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        device_id = normalize_device_id(data.get('device_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    SessionManager.set_device_id(device_id)
+    consumption_data = SessionManager.get_consumption_data()
+    consumazione_id = SessionManager.get_active_consumption()
+    if consumazione_id:
+        devices.bind(device_id, consumazione_id)
+        drinkers[consumazione_id] = drinker_from_session()
+        sip_engine.start(device_id, consumazione_id)
+        if consumption_data and consumption_data.get('id') == consumazione_id:
+            consumption_data['device_id'] = device_id
+            SessionManager.set_consumption_data(consumption_data)
+    
+    return jsonify({'success': True, 'device_id': device_id, 'consumazione_id': consumazione_id})
 
 @app.route('/simulatore')
 @login_required
@@ -1027,45 +1784,46 @@ def simulatore():
 @app.route('/test-arduino')
 @login_required
 def test_arduino():
-    global dato_da_arduino, timestamp_dato
+    latest = latest_reading(bound_device_id())
     
-    if dato_da_arduino is None:
+    if latest is None:
         return render_template('test_arduino.html', 
                              dato=None, 
                              tempo_trascorso=None)
     
-    tempo_trascorso = time.time() - timestamp_dato
+    timestamp, peso = latest
+    tempo_trascorso = time.time() - timestamp
     return render_template('test_arduino.html', 
-                         dato=dato_da_arduino, 
+                         dato=peso, 
                          tempo_trascorso=round(tempo_trascorso, 2))
 
 @app.route('/registra_sorso_ajax/<consumazione_id>', methods=['POST'])
 @login_required
 def registra_sorso_ajax(consumazione_id):
     """Endpoint per registrare un sorso via AJAX"""
-    print(f"DEBUG - Ricevuta richiesta per registrare sorso per consumazione {consumazione_id}")
+    logger.debug("Ricevuta richiesta per registrare sorso per consumazione %s", consumazione_id)
     
     try:
         data = request.get_json()
         volume = float(data.get('volume', 0))
-        print(f"DEBUG - Volume ricevuto: {volume}g")
+        logger.debug("Volume ricevuto: %sg", volume)
         
         if volume <= 0:
-            print("DEBUG - Volume non valido")
+            logger.debug("Volume non valido")
             return jsonify({'success': False, 'error': 'Volume non valido'})
         
         # Registra il sorso
-        print(f"DEBUG - Chiamata a registra_sorso con consumazione_id={consumazione_id}, volume={volume}")
+        logger.debug("Chiamata a registra_sorso con consumazione_id=%s, volume=%s", consumazione_id, volume)
         sorso = registra_sorso(consumazione_id, volume)
         
         if isinstance(sorso, dict) and 'error' in sorso:
-            print(f"DEBUG - Errore nella registrazione del sorso: {sorso['error']}")
+            logger.warning("Sorso non registrato per consumazione %s: %s", consumazione_id, sorso['error'])
             return jsonify({'success': False, 'error': sorso['error']})
         
         # Recupera la lista aggiornata dei sorsi
-        print("DEBUG - Recupero lista aggiornata dei sorsi")
+        logger.debug("Recupero lista aggiornata dei sorsi")
         sorsi = get_sorsi_by_consumazione(consumazione_id)
-        print(f"DEBUG - Trovati {len(sorsi)} sorsi")
+        logger.debug("Trovati %s sorsi", len(sorsi))
         
         # Aggiorna i dati nella sessione
         consumption_data = SessionManager.get_consumption_data()
@@ -1083,7 +1841,7 @@ def registra_sorso_ajax(consumazione_id):
         bac_value = float(sorso['fields'].get('BAC Temporaneo', 0))
         ora_attuale = datetime.now(TIMEZONE)
         SessionManager.set_bac_data(bac_value, ora_attuale.isoformat())
-        print(f"DEBUG - BAC {bac_value} salvato nella sessione con timestamp {ora_attuale.isoformat()}")
+        logger.debug("BAC %s salvato nella sessione con timestamp %s", bac_value, ora_attuale.isoformat())
         
         return jsonify({
             'success': True,
@@ -1094,7 +1852,7 @@ def registra_sorso_ajax(consumazione_id):
         })
         
     except Exception as e:
-        print(f"DEBUG - Errore durante la registrazione del sorso: {str(e)}")
+        logger.error("Errore durante la registrazione del sorso: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/check_active_consumption')
@@ -1158,6 +1916,11 @@ def finish_consumption():
         if consumazione['fields'].get('User', []) and consumazione['fields']['User'][0] != SessionManager.get_user_id():
             return jsonify({'success': False, 'error': 'Consumazione non appartenente all\'utente'})
         
+        bevitore = drinkers.pop(consumption_id, None)
+        if bevitore and bevitore['bac_data'].get('timestamp'):
+            # Il BAC dei sorsi registrati dal server torna nella sessione
+            SessionManager.set_bac_data(bevitore['bac_data']['bac'], bevitore['bac_data']['timestamp'])
+        
         # Calcola il peso già consumato
         peso_iniziale = float(consumazione['fields'].get('Peso (g)', 0))
         sorsi = get_sorsi_by_consumazione(consumption_id)
@@ -1171,20 +1934,22 @@ def finish_consumption():
                 registra_sorso(consumption_id, volume_finale)
         
         # Marca la consumazione come completata
-        url = f"https://api.airtable.com/v0/{BASE_ID}/Consumazioni/{consumption_id}"
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
         data = {
             'fields': {'Completato': 'Completato'}
         }
-        response = requests.patch(url, json=data, headers=headers)
-        if response.status_code >= 400:
-            raise Exception(f"Errore Airtable: {response.status_code} - {response.text}")
+        if write_journal:
+            # Inviato dopo i sorsi della stessa consumazione ancora in coda
+            write_journal.append_update('Consumazioni', consumption_id, data['fields'])
+        else:
+            response = airtable.patch('Consumazioni', consumption_id, data)
+            if response.status_code >= 400:
+                raise Exception(f"Errore Airtable: {response.status_code} - {response.text}")
+            record_written('Consumazioni', [response.json()])
         
         # Rimuovi l'ID della consumazione attiva dalla sessione
         SessionManager.set_active_consumption(None)
+        active_consumptions.pop(consumption_id, None)
+        devices.unbind_consumazione(consumption_id)
         
         return jsonify({'success': True})
     
@@ -1202,10 +1967,10 @@ def api_get_cities():
 @login_required
 def get_bars_by_city(city):
     """Endpoint API per ottenere i bar in una specifica città"""
-    logger.info(f"Richiesta bar per città: {city}")
+    logger.debug("Richiesta bar per città: %s", city)
         
     bars = get_bars(city)
-    logger.info(f"Trovati {len(bars)} bar per la città {city}")
+    logger.debug("Trovati %s bar per la città %s", len(bars), city)
     
     formatted_bars = [{
         'id': bar['id'],
@@ -1213,7 +1978,6 @@ def get_bars_by_city(city):
     } for bar in bars]
     
     response = {'bars': formatted_bars}
-    logger.info(f"Risposta: {response}")
     return jsonify(response)
 
 @app.route('/nuovo_drink', methods=['GET', 'POST'])
@@ -1269,10 +2033,10 @@ def nuovo_drink():
     if request.method == 'POST' and 'city' in request.form:
         selected_city = request.form.get('city')
         if selected_city:
-            logger.info(f"Città selezionata: {selected_city}")
+            logger.info("Città selezionata: %s", selected_city)
             # Filtra i bar per la città selezionata
             bars = get_bars(selected_city)
-            logger.info(f"Trovati {len(bars)} bar per {selected_city}")
+            logger.debug("Trovati %s bar per %s", len(bars), selected_city)
     
     # Gestione della selezione del bar
     if request.method == 'POST' and 'bar_id' in request.form and request.form.get('bar_id'):
@@ -1283,19 +2047,13 @@ def nuovo_drink():
             bars = get_bars(selected_city)
         
         if selected_bar_id:
-            logger.info(f"Bar selezionato: {selected_bar_id}")
+            logger.info("Bar selezionato: %s", selected_bar_id)
             # Salva il bar selezionato nella sessione
             SessionManager.set_bar_id(selected_bar_id)
             
-            # Ottieni tutti i drink prima del filtraggio
-            all_drinks = get_drinks()
-            # Filtra i drink per questo bar
-            drinks = []
-            for drink in all_drinks:
-                bar_list_drink = drink['fields'].get('Bar', [])
-                if selected_bar_id in bar_list_drink:
-                    drinks.append(drink)
-            logger.info(f"Trovati {len(drinks)} drink per il bar {selected_bar_id}")
+            # Drink di questo bar dall'indice bar -> drink
+            drinks = get_drinks(selected_bar_id)
+            logger.debug("Trovati %s drink per il bar %s", len(drinks), selected_bar_id)
     
     # Gestione del form quando viene inviato
     if request.method == 'POST' and 'drink_id' in request.form and request.form.get('drink_id'):
@@ -1304,7 +2062,7 @@ def nuovo_drink():
         bar_id = request.form.get('bar_id')
         stomaco = request.form.get('stomaco')
         
-        logger.info(f"Drink ID: {drink_id}, Bar ID: {bar_id}, Stomaco: {stomaco}")
+        logger.info("Drink ID: %s, Bar ID: %s, Stomaco: %s", drink_id, bar_id, stomaco)
         
         if not drink_id or not bar_id:
             flash('Seleziona un drink e un bar prima di iniziare', 'danger')
@@ -1313,7 +2071,7 @@ def nuovo_drink():
             # Salva il drink_id e lo stato dello stomaco nella sessione
             SessionManager.set_selected_drink_id(drink_id)
             SessionManager.set_stomaco_state(stomaco)
-            logger.info(f"Avvio monitoraggio per drink_id: {drink_id}, bar_id: {bar_id}, stomaco: {stomaco}")
+            logger.info("Avvio monitoraggio per drink_id: %s, bar_id: %s, stomaco: %s", drink_id, bar_id, stomaco)
             # Reindirizza alla pagina di monitoraggio
             return redirect(url_for('monitora_drink', drink_id=drink_id, bar_id=bar_id))
     
@@ -1339,7 +2097,7 @@ def monitora_drink():
     drink_id = request.args.get('drink_id')
     bar_id = request.args.get('bar_id')
     
-    logger.info(f"Richiesta monitora_drink con drink_id={drink_id}, bar_id={bar_id}")
+    logger.info("Richiesta monitora_drink con drink_id=%s, bar_id=%s", drink_id, bar_id)
     
     # Se non ci sono parametri ma c'è una consumazione attiva, usa i suoi dati
     if consumazione_attiva:
@@ -1359,7 +2117,9 @@ def monitora_drink():
                 consumazione_id=consumazione_id,
                 peso_iniziale=consumption_data['peso_iniziale'],
                 volume_consumato=consumption_data['volume_consumato'],
-                sorsi=consumption_data['sorsi']
+                sorsi=consumption_data['sorsi'],
+                device_id=bound_device_id(),
+                known_devices=devices.device_ids()
             )
     
     # Verifica che ci sia un drink_id valido
@@ -1383,28 +2143,21 @@ def monitora_drink():
         bar_id=bar_id,
         drink_selezionato=drink_selezionato,
         bar_selezionato=bar_selezionato,
-        consumazione_id=consumazione_id
+        consumazione_id=consumazione_id,
+        device_id=bound_device_id(),
+        known_devices=devices.device_ids()
     )
 
 @app.route('/get_drinks_by_bar/<bar_id>', methods=['GET'])
 @login_required
 def get_drinks_by_bar(bar_id):
     # Endpoint API per ottenere i drink disponibili per un bar specifico
-    print(f"DEBUG: Ricevuta richiesta per drink del bar ID: {bar_id}")
-    
-    # Ottieni tutti i drink prima del filtraggio
-    all_drinks = get_drinks()
-    print(f"DEBUG: Trovati {len(all_drinks)} drink totali")
+    logger.debug("Ricevuta richiesta per drink del bar ID: %s", bar_id)
     
-    # Filtra manualmente i drink per questo bar
-    bar_drinks = []
-    for drink in all_drinks:
-        bar_list = drink['fields'].get('Bar', [])
-        print(f"DEBUG: Drink {drink['id']} - Bar list: {bar_list}")
-        if bar_id in bar_list:
-            bar_drinks.append(drink)
+    # Drink di questo bar dall'indice bar -> drink
+    bar_drinks = get_drinks(bar_id)
     
-    print(f"DEBUG: Filtrati {len(bar_drinks)} drink per il bar {bar_id}")
+    logger.debug("Filtrati %s drink per il bar %s", len(bar_drinks), bar_id)
     
     # Formatta i dati per l'API
     formatted_drinks = [{
@@ -1450,6 +2203,11 @@ def create_consumption():
         if not bar_id:
             return jsonify({'success': False, 'error': 'Bar non selezionato'})
         
+        try:
+            device_id = normalize_device_id(data.get('device_id') or SessionManager.get_device_id())
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)})
+        
         # Recupera i dati dell'utente e del drink
         user_id = SessionManager.get_user_id()
         drink = get_drink_by_id(drink_id)
@@ -1475,11 +2233,6 @@ def create_consumption():
         bac = (grammi_alcol / (peso_utente * 1000 * r)) * 100
         
         # Crea la consumazione usando requests invece di Airtable
-        url = f"https://api.airtable.com/v0/{BASE_ID}/Consumazioni"
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
             
         # Prepara i dati includendo lo stato dello stomaco
         data = {
@@ -1493,15 +2246,24 @@ def create_consumption():
                 'Stomaco': stomaco.capitalize()  # Capitalizza la prima lettera
             }
         }
-        response = requests.post(url, json=data, headers=headers)
+        # Creata subito su Airtable, non nel journal: l'ID va in sessione e deve
+        # essere valido per ogni worker (il journal è del singolo processo)
+        response = airtable.post('Consumazioni', data)
         
         if response.status_code >= 400:
             raise Exception(f"Errore Airtable: {response.status_code} - {response.text}")
             
         consumazione = response.json()
+        record_written('Consumazioni', [consumazione])
         
         # Salva l'ID della consumazione attiva nella sessione
         SessionManager.set_active_consumption(consumazione['id'])
+        consumption_activity(consumazione['id'])
+        
+        # Le letture del sottobicchiere scelto vanno a questa consumazione
+        devices.bind(device_id, consumazione['id'])
+        drinkers[consumazione['id']] = drinker_from_session()
+        sip_engine.start(device_id, consumazione['id'])
         
         # Salva i dati della consumazione nella sessione
         consumption_data = {
@@ -1512,7 +2274,8 @@ def create_consumption():
             'volume_consumato': 0,
             'sorsi': [],
             'bac': bac,
-            'stomaco': stomaco
+            'stomaco': stomaco,
+            'device_id': device_id
         }
         SessionManager.set_consumption_data(consumption_data)
         
@@ -1537,6 +2300,23 @@ def drink_master():
     # Recupera tutte le consumazioni dell'utente
     consumazioni = get_user_consumazioni(user_id)
     
+    # Drink, bar e sorsi dipendono solo dalle consumazioni: letture in parallelo.
+    # Drink e bar collegati arrivano in blocco, invece di una chiamata per consumazione
+    calls = {
+        'drinks': lambda: get_drinks_by_ids(c['fields'].get('Drink', [''])[0] for c in consumazioni if 'Drink' in c['fields']),
+        'bars': lambda: get_bars_by_ids(c['fields'].get('Bar', [''])[0] for c in consumazioni if 'Bar' in c['fields']),
+        'sorsi_recenti': lambda: get_sorsi_giornalieri(user_email),
+    }
+    if mirror_enabled():
+        # Con il mirror attivo i sorsi di tutte le consumazioni arrivano da una sola query
+        calls['sorsi'] = lambda: mirror.get_sorsi_by_consumazioni(c['id'] for c in consumazioni)
+    else:
+        for c in consumazioni:
+            calls[('sorsi', c['id'])] = lambda consumazione_id=c['id']: get_sorsi_by_consumazione(consumazione_id)
+    loaded = fanout.run(calls)
+    drinks_by_id = loaded['drinks']
+    bars_by_id = loaded['bars']
+    
     # Per ogni consumazione, recupera i sorsi
     consumazioni_complete = []
     for consumazione in consumazioni:
@@ -1544,15 +2324,21 @@ def drink_master():
         
         # Recupera i dettagli della consumazione
         drink_id = consumazione['fields'].get('Drink', [''])[0] if 'Drink' in consumazione['fields'] else ''
-        drink = get_drink_by_id(drink_id) if drink_id else None
+        drink = drinks_by_id.get(drink_id) if drink_id else None
         drink_name = drink['fields'].get('Name', 'Sconosciuto') if drink else 'Sconosciuto'
         
         bar_id = consumazione['fields'].get('Bar', [''])[0] if 'Bar' in consumazione['fields'] else ''
-        bar = get_bar_by_id(bar_id) if bar_id else None
+        bar = bars_by_id.get(bar_id) if bar_id else None
         bar_name = bar['fields'].get('Name', 'Sconosciuto') if bar else 'Sconosciuto'
         
         # Recupera i sorsi per questa consumazione
-        sorsi = get_sorsi_by_consumazione(consumazione_id)
+        if 'sorsi' in loaded:
+            sorsi = loaded['sorsi'].get(consumazione_id, [])
+            if write_journal:
+                sorsi = merge_pending(sorsi, write_journal.pending_records('Sorsi', 'Consumazioni Id', consumazione_id))
+            sorsi = sorsi or SessionManager.get_sorsi_from_session(consumazione_id)
+        else:
+            sorsi = loaded[('sorsi', consumazione_id)]
         
         # Calcola il volume totale consumato
         volume_iniziale = float(consumazione['fields'].get('Peso (g)', 0))
@@ -1609,14 +2395,13 @@ def drink_master():
     bac_dalla_sessione = bac_data['bac']
     ultima_ora = bac_data['timestamp']
     
-    print(f"DEBUG: BAC dalla sessione: {bac_dalla_sessione}, ultimo aggiornamento: {ultima_ora}")
+    logger.debug("BAC dalla sessione: %s, ultimo aggiornamento: %s", bac_dalla_sessione, ultima_ora)
     
-    # Recupera tutti i sorsi delle ultime 24 ore per ricalcolare il BAC cumulativo
-    email_utente = SessionManager.get_user_email()
-    sorsi_recenti = get_sorsi_giornalieri(email_utente)
+    # Sorsi della giornata (già letti sopra) per ricalcolare il BAC cumulativo
+    sorsi_recenti = loaded['sorsi_recenti']
     
     if sorsi_recenti:
-        print(f"DEBUG: Trovati {len(sorsi_recenti)} sorsi recenti per l'utente")
+        logger.debug("Trovati %s sorsi recenti per l'utente", len(sorsi_recenti))
         
         # Ordina i sorsi per timestamp crescente
         sorsi_recenti.sort(key=lambda x: x['fields'].get('Ora inizio', '') if 'fields' in x and 'Ora inizio' in x['fields'] else '')
@@ -1635,11 +2420,11 @@ def drink_master():
                 
                 # Applica la metabolizzazione dell'alcol
                 if tempo_trascorso > 0:
-                    print(f"DEBUG: Ricalcolo BAC. Valore dall'ultimo sorso: {bac_corrente}, tempo trascorso: {tempo_trascorso} ore")
+                    logger.debug("Ricalcolo BAC. Valore dall'ultimo sorso: %s, tempo trascorso: %s ore", bac_corrente, tempo_trascorso)
                     bac_corrente = calcola_alcol_metabolizzato(bac_corrente, tempo_trascorso)
-                    print(f"DEBUG: BAC ricalcolato dopo metabolizzazione: {bac_corrente}")
+                    logger.debug("BAC ricalcolato dopo metabolizzazione: %s", bac_corrente)
             except Exception as e:
-                print(f"Errore nel ricalcolo del BAC dall'ultimo sorso: {str(e)}")
+                logger.error("Errore nel ricalcolo del BAC dall'ultimo sorso: %s", e)
                 # In caso di errore, usa il BAC dalla sessione
                 bac_corrente = bac_dalla_sessione
     else:
@@ -1655,16 +2440,16 @@ def drink_master():
                 
                 # Applica la metabolizzazione dell'alcol
                 if tempo_trascorso > 0:
-                    print(f"DEBUG: Ricalcolo BAC dalla sessione. Valore precedente: {bac_corrente}, tempo trascorso: {tempo_trascorso} ore")
+                    logger.debug("Ricalcolo BAC dalla sessione. Valore precedente: %s, tempo trascorso: %s ore", bac_corrente, tempo_trascorso)
                     bac_corrente = calcola_alcol_metabolizzato(bac_corrente, tempo_trascorso)
-                    print(f"DEBUG: BAC ricalcolato dalla sessione: {bac_corrente}")
+                    logger.debug("BAC ricalcolato dalla sessione: %s", bac_corrente)
             except Exception as e:
-                print(f"Errore nel ricalcolo del BAC dalla sessione: {str(e)}")
+                logger.error("Errore nel ricalcolo del BAC dalla sessione: %s", e)
     
     # Aggiorna il valore in sessione
     ora_attuale = datetime.now(TIMEZONE)
     SessionManager.set_bac_data(bac_corrente, ora_attuale.isoformat())
-    print(f"DEBUG: BAC finale {bac_corrente} salvato nella sessione con timestamp {ora_attuale.isoformat()}")
+    logger.debug("BAC finale %s salvato nella sessione con timestamp %s", bac_corrente, ora_attuale.isoformat())
     
     interpretazione_bac = interpreta_tasso_alcolemico(bac_corrente)
     
@@ -1674,6 +2459,26 @@ def drink_master():
                            bac_corrente=bac_corrente,
                            interpretazione_bac=interpretazione_bac)
 
+def _latest_game_data_from_airtable():
+    """Latest GameData fields per user and the matching user records, read from Airtable"""
+    latest_fields = {}
+    params = aq.build_params(fields=GAME_DATA_FIELDS)
+    for data in airtable.iter_records('GameData', params=params):
+        fields = data['fields']
+        user_id = fields.get('User', [''])[0]
+        if user_id:
+            # Get timestamp of this entry
+            last_updated = fields.get('Last Updated')
+            if not last_updated:
+                continue
+                
+            # If we haven't seen this user before or this is a newer entry
+            if user_id not in latest_fields or last_updated > latest_fields[user_id].get('Last Updated'):
+                latest_fields[user_id] = fields
+    
+    # Fetch all leaderboard users at once instead of one request per GameData row
+    return latest_fields, get_users_by_ids(latest_fields.keys())
+
 @app.route('/game')
 @login_required
 def game():
@@ -1691,44 +2496,36 @@ def game():
     # Check and reset daily challenge if needed
     check_and_reset_daily_challenge(game_data)
     
-    # Get all game data for leaderboard
-    url = f'https://api.airtable.com/v0/{BASE_ID}/GameData'
-    response = requests.get(url, headers=get_airtable_headers())
-    all_game_data = response.json().get('records', [])
+    if mirror_enabled():
+        # Latest entry per user, top 10 by points, computed by the local mirror
+        top_rows = mirror.leaderboard(limit=10)
+        latest_fields = {user['id']: data['fields'] for data, user in top_rows}
+        users_by_id = {user['id']: user for data, user in top_rows}
+    else:
+        latest_fields, users_by_id = _latest_game_data_from_airtable()
     
-    # Process leaderboard data - keep only latest entry per user
     user_latest_data = {}
-    for data in all_game_data:
-        fields = data['fields']
-        user_id = fields.get('User', [''])[0]
-        if user_id:
-            # Get timestamp of this entry
-            last_updated = fields.get('Last Updated')
-            if not last_updated:
-                continue
-                
-            # If we haven't seen this user before or this is a newer entry
-            if user_id not in user_latest_data or last_updated > user_latest_data[user_id]['timestamp']:
-                user_data = get_user_by_id(user_id)
-                if user_data and 'fields' in user_data:
-                    # Calculate completed achievements
-                    achievements_completed = 0
-                    if fields.get('Safe Driver Progress', 0) >= 5:
-                        achievements_completed += 1
-                    if fields.get('Mix Master Progress', 0) >= 10:
-                        achievements_completed += 1
-                    if fields.get('Time Keeper Progress', 0) >= 20:
-                        achievements_completed += 1
-                    
-                    user_latest_data[user_id] = {
-                        'email': user_data['fields'].get('Email', 'Unknown'),
-                        'level': fields.get('Level', 1),
-                        'points': fields.get('Points', 0),
-                        'achievements_completed': achievements_completed,
-                        'total_achievements': 3,  # Total number of achievements
-                        'timestamp': last_updated,
-                        'is_current_user': user_id == SessionManager.get_user_id()  # Flag per l'utente corrente
-                    }
+    for user_id, fields in latest_fields.items():
+        user_data = users_by_id.get(user_id)
+        if user_data and 'fields' in user_data:
+            # Calculate completed achievements
+            achievements_completed = 0
+            if fields.get('Safe Driver Progress', 0) >= 5:
+                achievements_completed += 1
+            if fields.get('Mix Master Progress', 0) >= 10:
+                achievements_completed += 1
+            if fields.get('Time Keeper Progress', 0) >= 20:
+                achievements_completed += 1
+            
+            user_latest_data[user_id] = {
+                'email': user_data['fields'].get('Email', 'Unknown'),
+                'level': fields.get('Level', 1),
+                'points': fields.get('Points', 0),
+                'achievements_completed': achievements_completed,
+                'total_achievements': 3,  # Total number of achievements
+                'timestamp': fields.get('Last Updated'),
+                'is_current_user': user_id == SessionManager.get_user_id()  # Flag per l'utente corrente
+            }
     
     # Convert to list and sort by points
     leaderboard = list(user_latest_data.values())
@@ -1768,10 +2565,27 @@ def game():
 
 def get_consumazione_by_id(consumazione_id):
     """Recupera una consumazione specifica da Airtable"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Consumazioni/{consumazione_id}'
-    response = requests.get(url, headers=get_airtable_headers())
+    if write_journal:
+        # Consumazione ancora nel journal, oppure già inviata con un ID provvisorio
+        pending = write_journal.get_pending('Consumazioni', consumazione_id)
+        if pending:
+            return pending
+        consumazione_id = write_journal.resolve(consumazione_id)
+    
+    consumazione = read_once(('Consumazioni', consumazione_id), lambda: _load_consumazione(consumazione_id))
+    
+    if write_journal:
+        consumazione = write_journal.apply_pending('Consumazioni', consumazione)
+    return consumazione
+
+def _load_consumazione(consumazione_id):
+    if mirror_enabled():
+        consumazione = mirror.get_record('Consumazioni', consumazione_id)
+        if consumazione:
+            return consumazione
+    response = airtable.get('Consumazioni', consumazione_id)
     if response.status_code == 200:
-        return response.json()
+        return aq.project(response.json(), CONSUMAZIONE_FIELDS)
     return None
 
 def get_consumazioni_by_user(user_id):
@@ -1780,43 +2594,64 @@ def get_consumazioni_by_user(user_id):
 
 def get_sorsi_by_consumazione(consumazione_id):
     # Recupera sia i sorsi dal database che quelli in sessione (come backup)
-    sorsi_da_db = get_sorsi_by_consumazione_from_airtable(consumazione_id)
-    sorsi_da_sessione = SessionManager.get_sorsi_from_session(consumazione_id)
+    record_id = write_journal.resolve(consumazione_id) if write_journal else consumazione_id
+    if is_local_id(record_id):
+        # La consumazione non è ancora su Airtable: i suoi sorsi sono solo nel journal
+        sorsi_da_db = []
+    else:
+        load = mirror.get_sorsi_by_consumazione if mirror_enabled() else get_sorsi_by_consumazione_from_airtable
+        sorsi_da_db = read_once(('Sorsi', 'consumazione', record_id), lambda: load(record_id))
+    if write_journal:
+        sorsi_da_db = merge_pending(sorsi_da_db, write_journal.pending_records('Sorsi', 'Consumazioni Id', record_id))
+    # Fuori da una richiesta (sorsi riconosciuti dal server) non c'è sessione
+    sorsi_da_sessione = SessionManager.get_sorsi_from_session(consumazione_id) if has_request_context() else []
     
     # Se troviamo sorsi nel database, usiamo quelli
     if sorsi_da_db:
-        print(f'DEBUG - Usando {len(sorsi_da_db)} sorsi da Airtable per consumazione {consumazione_id}')
+        logger.debug('Usando %s sorsi da Airtable per consumazione %s', len(sorsi_da_db), consumazione_id)
         return sorsi_da_db
     # Altrimenti usiamo quelli in sessione (backup)
     elif sorsi_da_sessione:
-        print(f'DEBUG - Usando {len(sorsi_da_sessione)} sorsi da sessione per consumazione {consumazione_id}')
+        logger.debug('Usando %s sorsi da sessione per consumazione %s', len(sorsi_da_sessione), consumazione_id)
         return sorsi_da_sessione
     # Se non ci sono sorsi né in DB né in sessione
     else:
-        print(f'DEBUG - Nessun sorso trovato per consumazione {consumazione_id}')
+        logger.debug('Nessun sorso trovato per consumazione %s', consumazione_id)
         return []
 
 def get_sorsi_by_consumazione_from_airtable(consumazione_id):
     """Recupera i sorsi da Airtable"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Sorsi'
-    response = requests.get(url, headers=get_airtable_headers())
-    
-    if response.status_code == 200:
-        # Filtra i sorsi nel codice Python
-        all_records = response.json().get('records', [])
-        filtered_records = []
-        
-        for record in all_records:
-            # Se il record ha 'Consumazioni Id' e contiene il consumazione_id
-            if 'Consumazioni Id' in record.get('fields', {}) and consumazione_id in record['fields']['Consumazioni Id']:
-                filtered_records.append(record)
-        
-        print(f'DEBUG - Trovati {len(filtered_records)} sorsi in Airtable per consumazione {consumazione_id}')
+    try:
+        filtered_records = load_linked('Sorsi', {'Consumazioni Id': consumazione_id},
+                                       fields=SORSO_FIELDS, sort=['Ora inizio'])
+        logger.debug('Trovati %s sorsi in Airtable per consumazione %s', len(filtered_records), consumazione_id)
         return filtered_records
-    return []
+    except AirtableError:
+        return []
 
-def registra_sorso(consumazione_id, volume):
-    """Registra un nuovo sorso per una consumazione"""
+def drinker_from_session():
+    """Dati dell'utente corrente che servono a registrare un sorso fuori dalla sua richiesta"""
+    return {
+        'user_id': SessionManager.get_user_id(),
+        'email': SessionManager.get_user_email(),
+        'stomaco': SessionManager.get_stomaco_state(),
+        'bac_data': SessionManager.get_bac_data()
+    }
+
+@sip_latency.time()
+def registra_sorso(consumazione_id, volume, bevitore=None, ora_inizio=None, ora_fine=None):
+    """
+    Registra un nuovo sorso per una consumazione
+    
+    Senza ``bevitore`` l'utente è quello della sessione. Il riconoscimento dei
+    sorsi lato server passa invece i dati salvati quando il sottobicchiere è
+    stato collegato (vedi ``drinker_from_session``) e gli istanti del sorso;
+    il BAC aggiornato finisce in ``bevitore['bac_data']`` invece che in sessione.
+    """
+    consumption_activity(consumazione_id)
+    in_session = bevitore is None
+    if in_session:
+        bevitore = drinker_from_session()
     try:
         # Recupera la consumazione
         consumazione = get_consumazione_by_id(consumazione_id)
@@ -1824,7 +2659,7 @@ def registra_sorso(consumazione_id, volume):
             return {'error': 'Consumazione non trovata'}
             
         # Verifica che la consumazione appartenga all'utente corrente
-        if consumazione['fields'].get('User', []) and consumazione['fields']['User'][0] != SessionManager.get_user_id():
+        if consumazione['fields'].get('User', []) and consumazione['fields']['User'][0] != bevitore['user_id']:
             return {'error': 'Consumazione non appartenente all\'utente'}
             
         # Calcola il BAC temporaneo
@@ -1837,14 +2672,14 @@ def registra_sorso(consumazione_id, volume):
             return {'error': 'Volume superiore a quello disponibile'}
             
         # Recupera i dati dell'utente
-        user_id = SessionManager.get_user_id()
+        user_id = bevitore['user_id']
         user_data = get_user_by_id(user_id)
         if not user_data or 'fields' not in user_data:
             return {'error': 'Dati utente non trovati'}
             
         peso_utente = float(user_data['fields'].get('Peso', 0))
         genere = user_data['fields'].get('Genere', '').lower()
-        email_utente = SessionManager.get_user_email()
+        email_utente = bevitore['email']
         
         # Recupera i dati del drink
         drink_id = consumazione['fields'].get('Drink', [''])[0]
@@ -1856,8 +2691,8 @@ def registra_sorso(consumazione_id, volume):
         
         # Prepara la lista delle bevande per il calcolo del BAC
         ora_attuale = datetime.now(TIMEZONE)
-        ora_inizio = ora_attuale - timedelta(minutes=1)  # 1 minuto fa
-        ora_fine = ora_attuale
+        ora_fine = ora_fine or ora_attuale
+        ora_inizio = ora_inizio or ora_fine - timedelta(minutes=1)  # 1 minuto prima
         
         # Prepara la lista di tutte le bevande (sorsi precedenti + nuovo sorso)
         lista_bevande = []
@@ -1882,11 +2717,11 @@ def registra_sorso(consumazione_id, volume):
                             'ora_fine': ora_fine_str
                         })
                     except Exception as e:
-                        print(f"Errore nella conversione del timestamp per il sorso: {str(e)}")
+                        logger.error("Errore nella conversione del timestamp per il sorso: %s", e)
                         continue
     
         # Ottieni il BAC residuo dalle consumazioni precedenti
-        bac_data = SessionManager.get_bac_data()
+        bac_data = bevitore['bac_data']
         bac_residuo = 0.0
         ultima_ora = None
         
@@ -1902,11 +2737,11 @@ def registra_sorso(consumazione_id, volume):
                     
                     # Applica la metabolizzazione dell'alcol
                     if tempo_trascorso > 0:
-                        print(f"DEBUG - BAC residuo prima della metabolizzazione: {bac_residuo}, tempo trascorso: {tempo_trascorso} ore")
+                        logger.debug("BAC residuo prima della metabolizzazione: %s, tempo trascorso: %s ore", bac_residuo, tempo_trascorso)
                         bac_residuo = calcola_alcol_metabolizzato(bac_residuo, tempo_trascorso)
-                        print(f"DEBUG - BAC residuo dopo la metabolizzazione: {bac_residuo}")
+                        logger.debug("BAC residuo dopo la metabolizzazione: %s", bac_residuo)
                 except Exception as e:
-                    print(f"Errore nel calcolo del BAC residuo: {str(e)}")
+                    logger.error("Errore nel calcolo del BAC residuo: %s", e)
         
         # Aggiungi il nuovo sorso
         lista_bevande.append({
@@ -1916,23 +2751,22 @@ def registra_sorso(consumazione_id, volume):
             'ora_fine': ora_fine.strftime('%H:%M')
         })
         
-        print(f"DEBUG - Lista bevande per calcolo BAC: {lista_bevande}")
-        print(f"DEBUG - BAC residuo considerato: {bac_residuo}")
+        logger.debug("Lista bevande per calcolo BAC: %s", lista_bevande)
+        logger.debug("BAC residuo considerato: %s", bac_residuo)
         
         # Calcola il BAC cumulativo considerando tutti i sorsi
         risultato_bac = calcola_bac_cumulativo(
             peso=peso_utente,
             genere=genere,
             lista_bevande=lista_bevande,
-            stomaco=SessionManager.get_stomaco_state()
+            stomaco=bevitore['stomaco']
         )
         
         # Aggiungi il BAC residuo al risultato
         bac_totale = risultato_bac['bac_finale'] + bac_residuo
-        print(f"DEBUG - BAC calcolato: {bac_totale} (di cui {bac_residuo} residuo)")
+        logger.debug("BAC calcolato: %s (di cui %s residuo)", bac_totale, bac_residuo)
         
         # Crea il sorso in Airtable
-        url = f'https://api.airtable.com/v0/{BASE_ID}/Sorsi'
         data = {
             'records': [{
                 'fields': {
@@ -1946,48 +2780,75 @@ def registra_sorso(consumazione_id, volume):
             }]
         }
         
-        print(f"DEBUG - Dati da inviare ad Airtable: {data}")  # Debug print
-        
-        response = requests.post(url, headers=get_airtable_headers(), json=data)
-        
-        if response.status_code != 200:
-            print(f"DEBUG - Errore Airtable: {response.status_code}")
-            print(f"DEBUG - Risposta Airtable: {response.text}")  # Debug print
-            return {'error': f'Errore Airtable: {response.status_code} - {response.text}'}
+        if write_journal:
+            # Confermato subito: l'invio ad Airtable avviene in background
+            sorso = write_journal.append_create('Sorsi', data['records'][0]['fields'], key=consumazione_id)
+        else:
+            response = airtable.post('Sorsi', data)
             
-        sorso = response.json()['records'][0]
+            if response.status_code != 200:
+                logger.error("Errore Airtable nella registrazione del sorso: %s - %s", response.status_code, response.text)
+                return {'error': f'Errore Airtable: {response.status_code} - {response.text}'}
+                
+            sorso = response.json()['records'][0]
+            record_written('Sorsi', [sorso])
         
-        # Aggiorna il BAC nella sessione
-        SessionManager.set_bac_data(bac_totale, ora_attuale.isoformat())
+        logger.info("Sorso registrato", extra={
+            'consumazione_id': consumazione_id, 'sorso_id': sorso['id'],
+            'volume': float(volume), 'bac': round(bac_totale, 3)
+        })
         
-        # Salva anche in sessione come backup
-        SessionManager.save_sorso_to_session(consumazione_id, sorso)
+        if in_session:
+            # Aggiorna il BAC nella sessione
+            SessionManager.set_bac_data(bac_totale, ora_attuale.isoformat())
+            
+            # Salva anche in sessione come backup
+            SessionManager.save_sorso_to_session(consumazione_id, sorso)
+        else:
+            bevitore['bac_data'] = {'bac': bac_totale, 'timestamp': ora_attuale.isoformat()}
         
         return sorso
         
     except Exception as e:
-        print(f"Errore durante la registrazione del sorso: {str(e)}")
+        logger.error("Errore durante la registrazione del sorso: %s", e)
         return {'error': str(e)}
 
 def get_sorsi_giornalieri(email, consumazione_id=None):
     """Recupera tutti i sorsi dell'utente per la giornata corrente ordinati per data"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Sorsi'
-    params = {
-        'filterByFormula': f"{{Email}}='{email}'",
-    }
+    sorsi = read_once(('Sorsi', 'giornalieri', email), lambda: _load_sorsi_giornalieri(email))
+    if write_journal:
+        oggi = datetime.now(TIMEZONE).date()
+        pending = [
+            s for s in write_journal.pending_records('Sorsi')
+            if s['fields'].get('Email') == email
+            and datetime.fromisoformat(s['fields']['Ora inizio']).astimezone(TIMEZONE).date() == oggi
+        ]
+        sorsi = merge_pending(sorsi, pending)
+    return sorsi
+
+def _load_sorsi_giornalieri(email):
+    oggi = datetime.now(TIMEZONE).date()
+    
+    if mirror_enabled():
+        # Limiti della giornata locale convertiti in UTC, come le colonne del mirror
+        inizio = TIMEZONE.localize(datetime.combine(oggi, datetime.min.time()))
+        fine = TIMEZONE.localize(datetime.combine(oggi + timedelta(days=1), datetime.min.time()))
+        return mirror.get_sorsi_giornalieri(
+            email,
+            inizio.astimezone(pytz.utc).replace(tzinfo=None),
+            fine.astimezone(pytz.utc).replace(tzinfo=None)
+        )
+    
+    params = aq.build_params(
+        formula=aq.and_(aq.eq('Email', email), aq.same_day('Ora inizio', oggi.isoformat(), TIMEZONE.zone)),
+        sort=['Ora inizio'],
+        fields=SORSO_FIELDS
+    )
     
     try:
-        response = requests.get(url, headers=get_airtable_headers(), params=params)
-        response.raise_for_status()
-        
-        data = response.json()
-        if 'records' not in data:
-            return []
-            
-        oggi = datetime.now(TIMEZONE).date()
         sorsi_filtrati = []
         
-        for sorso in data['records']:
+        for sorso in airtable.iter_records('Sorsi', params=params):
             if 'fields' in sorso and 'Ora inizio' in sorso['fields']:
                 timestamp = datetime.fromisoformat(sorso['fields']['Ora inizio'].replace('Z', '+00:00'))
                 timestamp = timestamp.astimezone(TIMEZONE)
@@ -1999,20 +2860,19 @@ def get_sorsi_giornalieri(email, consumazione_id=None):
         return sorsi_filtrati
         
     except Exception as e:
-        print(f"Errore nel recupero dei sorsi giornalieri: {str(e)}")
+        logger.error("Errore nel recupero dei sorsi giornalieri: %s", e)
         return []
 
 def get_game_data(user_id):
     """Recupera i dati di gioco dell'utente da Airtable"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/GameData'
-    params = {
-        'filterByFormula': f"{{User}}='{user_id}'"
-    }
-    response = requests.get(url, headers=get_airtable_headers(), params=params)
-    if response.status_code == 200:
-        records = response.json().get('records', [])
-        return records[0] if records else None
-    return None
+    return read_once(('GameData', 'user', user_id), lambda: _load_game_data(user_id))
+
+def _load_game_data(user_id):
+    try:
+        records = load_linked('GameData', {'User': user_id}, fields=GAME_DATA_FIELDS, max_records=1)
+    except AirtableError:
+        return None
+    return records[0] if records else None
 
 def create_game_data(user_id):
     """Crea un nuovo record di dati di gioco per l'utente basato sulla sua storia"""
@@ -2050,7 +2910,6 @@ def create_game_data(user_id):
     initial_level = 1 + (initial_points // 100)  # Ogni 100 punti = 1 livello
     
     # Crea il record in Airtable
-    url = f'https://api.airtable.com/v0/{BASE_ID}/GameData'
     data = {
         'records': [{
             'fields': {
@@ -2067,23 +2926,26 @@ def create_game_data(user_id):
             }
         }]
     }
-    response = requests.post(url, headers=get_airtable_headers(), json=data)
+    response = airtable.post('GameData', data)
     if response.status_code == 200:
-        return response.json()['records'][0]
+        records = response.json()['records']
+        record_written('GameData', records)
+        return records[0]
     return None
 
 def update_game_data(game_data_id, updates):
     """Aggiorna i dati di gioco dell'utente"""
-    url = f'https://api.airtable.com/v0/{BASE_ID}/GameData/{game_data_id}'
     data = {
         'fields': {
             **updates,
             'Last Updated': datetime.now(TIMEZONE).isoformat()
         }
     }
-    response = requests.patch(url, headers=get_airtable_headers(), json=data)
+    response = airtable.patch('GameData', game_data_id, data)
     if response.status_code == 200:
-        return response.json()
+        game_data = response.json()
+        record_written('GameData', [game_data])
+        return game_data
     return None
 
 def check_and_reset_daily_challenge(game_data):
@@ -2166,7 +3028,7 @@ def register_partner():
         address = request.form['address']
         city = request.form['city']
 
-        logger.info(f"[REGISTER_PARTNER] Tentativo di registrazione per: {bar_name} ({email})")
+        logger.info("[REGISTER_PARTNER] Tentativo di registrazione per: %s (%s)", bar_name, email)
 
         # Validate password
         if len(password) < 8:
@@ -2178,16 +3040,14 @@ def register_partner():
             return redirect(url_for('partner'))
 
         # Check if email already exists
-        url = f'https://api.airtable.com/v0/{BASE_ID}/Locali'
-        headers = get_airtable_headers()
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            existing_bars = response.json().get('records', [])
-            for bar in existing_bars:
+        try:
+            params = aq.build_params(formula=aq.eq('Email', email), max_records=1, fields=['Email'])
+            for bar in airtable.iter_records('Locali', params=params):
                 if bar['fields'].get('Email') == email:
                     flash('Email già registrata')
                     return redirect(url_for('partner'))
+        except AirtableError as e:
+            logger.error("[REGISTER_PARTNER] Errore nel controllo dell'email: %s", e)
 
         # Hash the password
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
@@ -2204,11 +3064,10 @@ def register_partner():
         }
 
         # Add to Locali table
-        response = requests.post(url, headers=headers, json=new_bar)
+        response = airtable.post('Locali', new_bar)
         
         if response.status_code == 200:
             # Now create the corresponding Bar record with only necessary fields
-            bar_url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
             new_bar_record = {
                 'fields': {
                     'Name': bar_name,
@@ -2218,9 +3077,11 @@ def register_partner():
             }
             
             # Add to Bar table
-            bar_response = requests.post(bar_url, headers=headers, json=new_bar_record)
+            bar_response = airtable.post('Bar', new_bar_record)
+            reference_cache.invalidate('Bar')
             
             if bar_response.status_code == 200:
+                record_written('Bar', [bar_response.json()])
                 flash('Registrazione completata con successo! Puoi effettuare il login con le tue credenziali.')
                 return redirect(url_for('home'))
             else:
@@ -2231,7 +3092,7 @@ def register_partner():
             return redirect(url_for('partner'))
 
     except Exception as e:
-        logger.error(f"[REGISTER_PARTNER] Errore durante la registrazione del bar: {str(e)}")
+        logger.error("[REGISTER_PARTNER] Errore durante la registrazione del bar: %s", e)
         flash('Si è verificato un errore durante la registrazione. Riprova più tardi.')
         return redirect(url_for('partner'))
 
@@ -2252,14 +3113,13 @@ def registra_drink():
             alcolico = 'alcolico' in request.form
             speciale = 'speciale' in request.form
             
-            logger.info(f"[REGISTRA_DRINK] Tentativo di registrazione drink: {nome}")
+            logger.info("[REGISTRA_DRINK] Tentativo di registrazione drink: %s", nome)
             
             # Ottieni il record del locale
-            locale_url = f'https://api.airtable.com/v0/{BASE_ID}/Locali/{session["user"]}'
-            locale_response = requests.get(locale_url, headers=get_airtable_headers())
+            locale_response = airtable.get('Locali', session["user"])
             
             if locale_response.status_code != 200:
-                logger.error(f"[REGISTRA_DRINK] Errore nel recupero del locale: {locale_response.status_code}")
+                logger.error("[REGISTRA_DRINK] Errore nel recupero del locale: %s", locale_response.status_code)
                 flash('Errore durante la registrazione del drink', 'danger')
                 return redirect(url_for('registra_drink'))
             
@@ -2267,19 +3127,17 @@ def registra_drink():
             locale_name = locale_data['fields'].get('Name')
             
             # Cerca il bar corrispondente usando il nome
-            bar_url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
-            bar_params = {'filterByFormula': f"{{Name}}='{locale_name}'"}
-            bar_response = requests.get(bar_url, headers=get_airtable_headers(), params=bar_params)
+            bar_params = aq.build_params(formula=aq.eq('Name', locale_name), max_records=1, fields=['Name'])
+            bar_response = airtable.get('Bar', params=bar_params)
             
             if bar_response.status_code != 200 or not bar_response.json().get('records'):
-                logger.error(f"[REGISTRA_DRINK] Errore nel recupero del bar: {bar_response.status_code}")
+                logger.error("[REGISTRA_DRINK] Errore nel recupero del bar: %s", bar_response.status_code)
                 flash('Errore durante la registrazione del drink', 'danger')
                 return redirect(url_for('registra_drink'))
             
             bar_id = bar_response.json()['records'][0]['id']
             
             # Crea il nuovo drink in Airtable
-            url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
             data = {
                 'records': [{
                     'fields': {
@@ -2293,57 +3151,48 @@ def registra_drink():
                 }]
             }
             
-            logger.info(f"[REGISTRA_DRINK] Dati da inviare ad Airtable: {data}")
+            logger.debug("[REGISTRA_DRINK] Dati da inviare ad Airtable: %s", data)
             
-            response = requests.post(url, headers=get_airtable_headers(), json=data)
+            response = airtable.post('Drinks', data)
+            reference_cache.invalidate('Drinks')
             
             if response.status_code == 200:
-                logger.info(f"[REGISTRA_DRINK] Drink registrato con successo: {nome}")
+                record_written('Drinks', response.json()['records'])
+                logger.info("[REGISTRA_DRINK] Drink registrato con successo: %s", nome)
                 flash('Drink registrato con successo!', 'success')
             else:
-                logger.error(f"[REGISTRA_DRINK] Errore Airtable: {response.status_code} - {response.text}")
+                logger.error("[REGISTRA_DRINK] Errore Airtable: %s - %s", response.status_code, response.text)
                 flash('Errore durante la registrazione del drink', 'danger')
                 
         except Exception as e:
-            logger.error(f"[REGISTRA_DRINK] Errore: {str(e)}")
+            logger.error("[REGISTRA_DRINK] Errore: %s", e)
             flash('Si è verificato un errore durante la registrazione', 'danger')
     
     # Recupera il nome del locale loggato
-    locale_url = f'https://api.airtable.com/v0/{BASE_ID}/Locali/{session["user"]}'
-    locale_response = requests.get(locale_url, headers=get_airtable_headers())
+    locale_response = airtable.get('Locali', session["user"])
     locale_data = locale_response.json()
     locale_name = locale_data['fields'].get('Name')
     
     # Cerca il bar corrispondente usando il nome
-    bar_url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
-    bar_params = {'filterByFormula': f"{{Name}}='{locale_name}'"}
-    bar_response = requests.get(bar_url, headers=get_airtable_headers(), params=bar_params)
+    bar_params = aq.build_params(formula=aq.eq('Name', locale_name), max_records=1, fields=['Name'])
+    bar_response = airtable.get('Bar', params=bar_params)
     
     if bar_response.status_code == 200 and bar_response.json().get('records'):
         bar_id = bar_response.json()['records'][0]['id']
         
-        # Recupera tutti i drink associati a questo bar
-        drinks_url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
-        drinks_response = requests.get(drinks_url, headers=get_airtable_headers())
-        
-        if drinks_response.status_code == 200:
-            all_drinks = drinks_response.json().get('records', [])
-            # Filtra i drink per questo bar
-            drinks = [drink for drink in all_drinks if bar_id in drink['fields'].get('Bar', [])]
-        else:
-            drinks = []
+        # Recupera tutti i drink associati a questo bar dall'indice bar -> drink
+        drinks = get_drinks(bar_id)
     else:
+        bar_id = None
         drinks = []
     
     # Recupera tutti i drink non speciali
-    url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
-    response = requests.get(url, headers=get_airtable_headers())
-    all_drinks = response.json().get('records', [])
+    all_drinks = get_drinks()
     non_special_drinks = [drink for drink in all_drinks if drink['fields'].get('Speciale (bool)') == '0']
     
-    # Marca i drink già collegati al bar
-    for drink in non_special_drinks:
-        drink['is_linked'] = bar_id in drink['fields'].get('Bar', [])
+    # Marca i drink già collegati al bar (su una copia: i record in cache sono condivisi)
+    linked_ids = {drink['id'] for drink in drinks}
+    non_special_drinks = [dict(drink, is_linked=drink['id'] in linked_ids) for drink in non_special_drinks]
     
     return render_template('registra_drink.html', drinks=drinks, non_special_drinks=non_special_drinks)
 
@@ -2367,15 +3216,13 @@ def link_drinks_to_bar():
         selected_drinks = request.json.get('drink_ids', [])
         
         # Recupera il nome del locale loggato
-        locale_url = f'https://api.airtable.com/v0/{BASE_ID}/Locali/{session["user"]}'
-        locale_response = requests.get(locale_url, headers=get_airtable_headers())
+        locale_response = airtable.get('Locali', session["user"])
         locale_data = locale_response.json()
         locale_name = locale_data['fields'].get('Name')
         
         # Cerca il bar corrispondente usando il nome
-        bar_url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
-        bar_params = {'filterByFormula': f"{{Name}}='{locale_name}'"}
-        bar_response = requests.get(bar_url, headers=get_airtable_headers(), params=bar_params)
+        bar_params = aq.build_params(formula=aq.eq('Name', locale_name), max_records=1, fields=['Name'])
+        bar_response = airtable.get('Bar', params=bar_params)
         
         if bar_response.status_code != 200 or not bar_response.json().get('records'):
             return jsonify({'success': False, 'error': 'Bar non trovato'}), 404
@@ -2383,9 +3230,7 @@ def link_drinks_to_bar():
         bar_id = bar_response.json()['records'][0]['id']
         
         # Recupera tutti i drink non speciali
-        drinks_url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks'
-        drinks_response = requests.get(drinks_url, headers=get_airtable_headers())
-        all_drinks = drinks_response.json().get('records', [])
+        all_drinks = airtable.iter_records('Drinks', params=aq.build_params(fields=['Speciale (bool)', 'Bar']))
         non_special_drinks = [drink for drink in all_drinks if drink['fields'].get('Speciale (bool)') == '0']
         
         # Per ogni drink non speciale
@@ -2402,11 +3247,13 @@ def link_drinks_to_bar():
                         'Bar': current_bars
                     }
                 }
-                update_url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks/{drink_id}'
-                update_response = requests.patch(update_url, headers=get_airtable_headers(), json=update_data)
+                update_response = airtable.patch('Drinks', drink_id, update_data)
+                reference_cache.invalidate('Drinks')
                 
-                if update_response.status_code != 200:
-                    logger.error(f"Errore nell'aggiunta del bar al drink {drink_id}: {update_response.text}")
+                if update_response.status_code == 200:
+                    record_written('Drinks', [update_response.json()])
+                else:
+                    logger.error("Errore nell'aggiunta del bar al drink %s: %s", drink_id, update_response.text)
             
             # Se il drink non è tra quelli selezionati ed è collegato al bar
             elif drink_id not in selected_drinks and bar_id in current_bars:
@@ -2417,16 +3264,18 @@ def link_drinks_to_bar():
                         'Bar': current_bars
                     }
                 }
-                update_url = f'https://api.airtable.com/v0/{BASE_ID}/Drinks/{drink_id}'
-                update_response = requests.patch(update_url, headers=get_airtable_headers(), json=update_data)
+                update_response = airtable.patch('Drinks', drink_id, update_data)
+                reference_cache.invalidate('Drinks')
                 
-                if update_response.status_code != 200:
-                    logger.error(f"Errore nella rimozione del bar dal drink {drink_id}: {update_response.text}")
+                if update_response.status_code == 200:
+                    record_written('Drinks', [update_response.json()])
+                else:
+                    logger.error("Errore nella rimozione del bar dal drink %s: %s", drink_id, update_response.text)
         
         return jsonify({'success': True, 'message': 'Drink aggiornati con successo'})
         
     except Exception as e:
-        logger.error(f"Errore nell'aggiornamento dei drink: {str(e)}")
+        logger.error("Errore nell'aggiornamento dei drink: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/statistica')
@@ -2440,15 +3289,13 @@ def statistica():
     
     try:
         # Recupera il nome del locale loggato
-        locale_url = f'https://api.airtable.com/v0/{BASE_ID}/Locali/{session["user"]}'
-        locale_response = requests.get(locale_url, headers=get_airtable_headers())
+        locale_response = airtable.get('Locali', session["user"])
         locale_data = locale_response.json()
         locale_name = locale_data['fields'].get('Name')
         
         # Cerca il bar corrispondente usando il nome
-        bar_url = f'https://api.airtable.com/v0/{BASE_ID}/Bar'
-        bar_params = {'filterByFormula': f"{{Name}}='{locale_name}'"}
-        bar_response = requests.get(bar_url, headers=get_airtable_headers(), params=bar_params)
+        bar_params = aq.build_params(formula=aq.eq('Name', locale_name), max_records=1, fields=['Name'])
+        bar_response = airtable.get('Bar', params=bar_params)
         
         if bar_response.status_code != 200 or not bar_response.json().get('records'):
             flash('Errore nel recupero dei dati del bar', 'danger')
@@ -2456,48 +3303,24 @@ def statistica():
         
         bar_id = bar_response.json()['records'][0]['id']
         
-        # Recupera tutte le consumazioni per questo bar
-        consumazioni = get_user_consumazioni(bar_id=bar_id)
-        
-        # Inizializza le variabili per le statistiche
-        totale_consumazioni = len(consumazioni)
-        drink_stats = {}
-        bac_values = []
-        totale_sorsi = 0
+        # Fasce per il grafico della distribuzione BAC
+        bac_ranges = [(0, 0.2), (0.2, 0.4), (0.4, 0.6), (0.6, 0.8), (0.8, 1.0), (1.0, float('inf'))]
+        bac_labels = ['0-0.2', '0.2-0.4', '0.4-0.6', '0.6-0.8', '0.8-1.0', '>1.0']
         
-        # Analizza ogni consumazione
-        for cons in consumazioni:
-            drink_id = cons['fields'].get('Drink', [''])[0]
-            if drink_id:
-                drink = get_drink_by_id(drink_id)
-                if drink:
-                    drink_name = drink['fields'].get('Name', 'Sconosciuto')
-                    if drink_name not in drink_stats:
-                        drink_stats[drink_name] = {
-                            'consumazioni': 0,
-                            'sorsi': 0,
-                            'tassi': [],
-                            'positivi': 0
-                        }
-                    
-                    drink_stats[drink_name]['consumazioni'] += 1
-                    
-                    # Recupera i sorsi per questa consumazione
-                    sorsi = get_sorsi_by_consumazione(cons['id'])
-                    drink_stats[drink_name]['sorsi'] += len(sorsi)
-                    totale_sorsi += len(sorsi)
-                    
-                    # Analizza i tassi alcolemici
-                    for sorso in sorsi:
-                        bac = float(sorso['fields'].get('BAC Temporaneo', 0))
-                        drink_stats[drink_name]['tassi'].append(bac)
-                        bac_values.append(bac)
-                        if bac > 0.5:  # Limite legale
-                            drink_stats[drink_name]['positivi'] += 1
+        if mirror_enabled():
+            # Conteggi e medie calcolati con query aggregate sul mirror locale
+            stats_bar = mirror.bar_stats(bar_id, bac_ranges)
+            totale_consumazioni = stats_bar['totale_consumazioni']
+            totale_sorsi = stats_bar['totale_sorsi']
+            tasso_medio = stats_bar['tasso_medio']
+            bac_data = stats_bar['bac_data']
+            drink_stats = stats_bar['drink_stats']
+        else:
+            totale_consumazioni, totale_sorsi, tasso_medio, bac_data, drink_stats = \
+                _bar_stats_from_airtable(bar_id, bac_ranges)
         
         # Calcola le statistiche generali
         media_sorsi_per_drink = totale_sorsi / totale_consumazioni if totale_consumazioni > 0 else 0
-        tasso_medio = sum(bac_values) / len(bac_values) if bac_values else 0
         
         # Prepara i dati per i grafici
         drink_labels = []
@@ -2510,28 +3333,16 @@ def statistica():
             
             # Calcola le statistiche per drink
             media_sorsi = stats['sorsi'] / stats['consumazioni'] if stats['consumazioni'] > 0 else 0
-            tasso_medio_drink = sum(stats['tassi']) / len(stats['tassi']) if stats['tassi'] else 0
             percentuale_positivi = (stats['positivi'] / stats['consumazioni'] * 100) if stats['consumazioni'] > 0 else 0
             
             dettaglio_drink.append({
                 'nome': drink_name,
                 'consumazioni': stats['consumazioni'],
                 'media_sorsi': media_sorsi,
-                'tasso_medio': tasso_medio_drink,
+                'tasso_medio': stats['tasso_medio'],
                 'percentuale_positivi': percentuale_positivi
             })
         
-        # Prepara i dati per il grafico della distribuzione BAC
-        bac_ranges = [(0, 0.2), (0.2, 0.4), (0.4, 0.6), (0.6, 0.8), (0.8, 1.0), (1.0, float('inf'))]
-        bac_labels = ['0-0.2', '0.2-0.4', '0.4-0.6', '0.6-0.8', '0.8-1.0', '>1.0']
-        bac_data = [0] * len(bac_ranges)
-        
-        for bac in bac_values:
-            for i, (min_bac, max_bac) in enumerate(bac_ranges):
-                if min_bac <= bac < max_bac:
-                    bac_data[i] += 1
-                    break
-        
         return render_template('statistica.html',
                              totale_consumazioni=totale_consumazioni,
                              drink_popolari=drink_labels[:5],
@@ -2544,10 +3355,71 @@ def statistica():
                              dettaglio_drink=dettaglio_drink)
                              
     except Exception as e:
-        logger.error(f"Errore nella pagina statistiche: {str(e)}")
+        logger.error("Errore nella pagina statistiche: %s", e)
         flash('Si è verificato un errore nel caricamento delle statistiche', 'danger')
         return redirect(url_for('home'))
 
+def _bar_stats_from_airtable(bar_id, bac_ranges):
+    """Statistiche di un bar calcolate scaricando consumazioni e sorsi da Airtable"""
+    # Recupera tutte le consumazioni per questo bar
+    consumazioni = get_user_consumazioni(bar_id=bar_id)
+    
+    # Inizializza le variabili per le statistiche
+    totale_consumazioni = len(consumazioni)
+    drink_stats = {}
+    bac_values = []
+    totale_sorsi = 0
+    
+    # Drink consumati (in blocco) e sorsi di ogni consumazione, letti in parallelo
+    calls = {'drinks': lambda: get_drinks_by_ids(cons['fields'].get('Drink', [''])[0] for cons in consumazioni)}
+    for cons in consumazioni:
+        calls[('sorsi', cons['id'])] = lambda consumazione_id=cons['id']: get_sorsi_by_consumazione(consumazione_id)
+    loaded = fanout.run(calls)
+    drinks_by_id = loaded['drinks']
+    
+    # Analizza ogni consumazione
+    for cons in consumazioni:
+        drink_id = cons['fields'].get('Drink', [''])[0]
+        if drink_id:
+            drink = drinks_by_id.get(drink_id)
+            if drink:
+                drink_name = drink['fields'].get('Name', 'Sconosciuto')
+                if drink_name not in drink_stats:
+                    drink_stats[drink_name] = {
+                        'consumazioni': 0,
+                        'sorsi': 0,
+                        'tassi': [],
+                        'positivi': 0
+                    }
+                
+                drink_stats[drink_name]['consumazioni'] += 1
+                
+                sorsi = loaded[('sorsi', cons['id'])]
+                drink_stats[drink_name]['sorsi'] += len(sorsi)
+                totale_sorsi += len(sorsi)
+                
+                # Analizza i tassi alcolemici
+                for sorso in sorsi:
+                    bac = float(sorso['fields'].get('BAC Temporaneo', 0))
+                    drink_stats[drink_name]['tassi'].append(bac)
+                    bac_values.append(bac)
+                    if bac > 0.5:  # Limite legale
+                        drink_stats[drink_name]['positivi'] += 1
+    
+    tasso_medio = sum(bac_values) / len(bac_values) if bac_values else 0
+    for stats in drink_stats.values():
+        stats['tasso_medio'] = sum(stats['tassi']) / len(stats['tassi']) if stats['tassi'] else 0
+    
+    # Conta i sorsi per fascia di BAC
+    bac_data = [0] * len(bac_ranges)
+    for bac in bac_values:
+        for i, (min_bac, max_bac) in enumerate(bac_ranges):
+            if min_bac <= bac < max_bac:
+                bac_data[i] += 1
+                break
+    
+    return totale_consumazioni, totale_sorsi, tasso_medio, bac_data, drink_stats
+
 @app.route('/set_selected_bar', methods=['POST'])
 @login_required
 def set_selected_bar():
@@ -2564,7 +3436,7 @@ def set_selected_bar():
         
         return jsonify({'success': True})
     except Exception as e:
-        logger.error(f"Errore nel salvataggio del bar selezionato: {str(e)}")
+        logger.error("Errore nel salvataggio del bar selezionato: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 if __name__ == '__main__':
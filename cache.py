@@ -0,0 +1,222 @@
+"""Cache in memoria per i dati letti da Airtable.
+
+``TTLCache`` tiene tra una richiesta e l'altra i dati di riferimento (Bar,
+Drinks); ``IdentityMap`` evita di rileggere gli stessi record all'interno di
+una singola richiesta.
+
+Le chiavi sono tuple che iniziano con il nome della tabella, ad esempio
+``('Drinks',)`` per l'intera tabella o ``('Drinks', 'recXXX')`` per un
+singolo record, così una scrittura su una tabella può invalidare in un colpo
+solo tutte le voci che la riguardano.
+
+Con ``stale_ttl`` il ``TTLCache`` fa stale-while-revalidate: per un certo
+tempo dopo la scadenza restituisce subito l'ultimo valore buono e lo ricarica
+in background, così una lettura lenta o fallita verso Airtable non blocca la
+richiesta.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Cache LRU con scadenza (TTL) e numero massimo di voci, thread-safe"""
+
+    def __init__(self, ttl=300, max_size=512, stale_ttl=0, on_stale=None):
+        """
+        Args:
+            ttl: Durata di validità di una voce in secondi
+            max_size: Numero massimo di voci; oltre questo limite si scarta la meno usata
+            stale_ttl: Secondi dopo la scadenza in cui una voce si può ancora
+                servire mentre viene ricaricata in background (0 = mai)
+            on_stale: Funzione ``(key, age)`` chiamata ogni volta che si serve
+                una voce scaduta; ``age`` sono i secondi dall'ultimo caricamento
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self.on_stale = on_stale
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        # Cambia a ogni invalidazione: una ricarica partita prima non deve
+        # rimettere in cache dati vecchi
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _lookup(self, key, missing):
+        """Cerca una voce: restituisce (valore, età) con età None se è fresca, ``missing`` se manca"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return missing, None
+            value, loaded_at, expires_at = entry
+            now = time.monotonic()
+            if expires_at > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value, None
+            if now < expires_at + self.stale_ttl:
+                self._data.move_to_end(key)
+                self.stale_hits += 1
+                return value, now - loaded_at
+            del self._data[key]
+            self.misses += 1
+            return missing, None
+
+    def _served_stale(self, key, age):
+        if self.on_stale is not None:
+            try:
+                self.on_stale(key, age)
+            except Exception as e:
+                logger.error("[CACHE] Errore in on_stale per %s: %s", key, e)
+
+    def get(self, key, default=None, allow_stale=False):
+        """
+        Restituisce il valore se presente e non scaduto, altrimenti ``default``.
+
+        Con ``allow_stale`` restituisce anche una voce scaduta da meno di
+        ``stale_ttl`` secondi (senza ricaricarla: non c'è un loader).
+        """
+        missing = object()
+        value, age = self._lookup(key, missing)
+        if value is missing:
+            return default
+        if age is not None:
+            if not allow_stale:
+                return default
+            self._served_stale(key, age)
+        return value
+
+    def set(self, key, value, ttl=None):
+        loaded_at = time.monotonic()
+        expires_at = loaded_at + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._data[key] = (value, loaded_at, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Restituisce il valore in cache oppure lo carica con ``loader()``.
+
+        Una voce scaduta da meno di ``stale_ttl`` secondi viene restituita
+        subito e ricaricata in background (una sola ricarica per chiave).
+        I risultati ``None`` non vengono memorizzati, così un record non
+        trovato o un errore di Airtable non restano in cache.
+        """
+        missing = object()
+        value, age = self._lookup(key, missing)
+        if value is missing:
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+        if age is not None:
+            self._served_stale(key, age)
+            self._refresh_async(key, loader, ttl)
+        return value
+
+    def _refresh_async(self, key, loader, ttl):
+        """Ricarica una voce scaduta in un thread, se non c'è già una ricarica in corso"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            generation = self._generation
+
+        def refresh():
+            try:
+                value = loader()
+                with self._lock:
+                    current = self._generation == generation
+                if value is not None and current:
+                    self.set(key, value, ttl)
+                with self._lock:
+                    self.refreshes += 1
+            except Exception as e:
+                with self._lock:
+                    self.refresh_errors += 1
+                logger.warning("[CACHE] Ricarica di %s fallita, resta il valore precedente: %s", key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='cache-refresh', daemon=True).start()
+
+    def invalidate(self, table=None):
+        """Elimina tutte le voci di una tabella, oppure l'intera cache se ``table`` è None"""
+        with self._lock:
+            self._generation += 1
+            if table is None:
+                self._data.clear()
+                return
+            for key in [k for k in self._data if k[0] == table]:
+                del self._data[key]
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'refreshing': len(self._refreshing),
+                'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0.0
+            }
+
+
+class IdentityMap:
+    """
+    Letture di una singola richiesta: ogni chiave viene caricata al massimo una
+    volta e le letture successive restituiscono lo stesso oggetto. Vive su
+    ``flask.g``, quindi non serve un TTL; il lock serve perché i thread del
+    fan-out della stessa richiesta la condividono (vedi ``FanOut``).
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        """Restituisce il valore già letto in questa richiesta, altrimenti lo carica con ``loader()``"""
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        # Il caricamento avviene fuori dal lock: se due thread leggono la
+        # stessa chiave insieme vince il primo, così tutti vedono lo stesso oggetto
+        value = loader()
+        with self._lock:
+            return self._data.setdefault(key, value)
+
+    def invalidate(self, table=None):
+        """Scarta le letture di una tabella (tutte se ``table`` è None)"""
+        with self._lock:
+            if table is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if k and k[0] == table]:
+                    del self._data[key]
@@ -0,0 +1,108 @@
+"""Circuit breaker per le chiamate verso un servizio esterno (Airtable).
+
+Dopo ``failure_threshold`` errori consecutivi (errori di rete o risposte 5xx)
+il circuito si apre: per ``reset_timeout`` secondi le chiamate vengono
+rifiutate subito, senza aspettare timeout e retry, e chi chiama può servire i
+dati in cache. Passato quel tempo il circuito è semiaperto e lascia passare
+una sola chiamata di prova: se riesce si richiude, altrimenti si riapre. Una
+prova che non riporta l'esito entro ``reset_timeout`` secondi (chi chiama è
+morto senza chiamare ``record_success``/``record_failure``) scade e ne parte
+un'altra, così il circuito non resta semiaperto per sempre.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Stato del circuito verso un servizio esterno, thread-safe"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            name: Nome del servizio, usato nei log
+            failure_threshold: Errori consecutivi dopo cui il circuito si apre
+            reset_timeout: Secondi di circuito aperto prima della chiamata di prova
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Vero se la chiamata può partire; a circuito aperto lascia passare solo la prova"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._state == HALF_OPEN and self._probing and \
+                    time.monotonic() - self._probe_started >= self.reset_timeout:
+                logger.warning("[CIRCUIT] %s: la chiamata di prova non ha riportato l'esito, ne parte un'altra",
+                               self.name)
+                self._probing = False
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self._probe_started = time.monotonic()
+                logger.info("[CIRCUIT] %s: chiamata di prova", self.name)
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """Secondi che mancano alla prossima chiamata di prova (0 se il circuito è chiuso)"""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                logger.warning("[CIRCUIT] %s: servizio di nuovo raggiungibile, circuito chiuso", self.name)
+            self._state = CLOSED
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                if self._state == CLOSED:
+                    logger.error("[CIRCUIT] %s: %d errori consecutivi, circuito aperto per %.0fs",
+                                 self.name, self._failures, self.reset_timeout)
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opened += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'opened': self.opened,
+                'rejected': self.rejected
+            }
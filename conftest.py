@@ -0,0 +1,16 @@
+import os
+
+# test_airtable.py e test_peso.py sono script da lanciare a mano contro
+# Airtable e contro un server avviato: pytest non deve raccoglierli
+collect_ignore = ['test_airtable.py', 'test_peso.py']
+
+# I test che importano app.py non devono lasciare file (journal, storico,
+# tabelle condivise) né usare il mirror su disco
+os.environ.update({
+    'WRITE_BEHIND': '0',
+    'WEIGHT_HISTORY': '0',
+    'DEVICE_SLOTS': '0',
+    'AIRTABLE_RATE': '0',
+    'DATABASE_URL': 'sqlite://',
+    'USE_LOCAL_MIRROR': '0',
+})
@@ -0,0 +1,366 @@
+"""Registro dei sottobicchieri (dispositivi Arduino) e delle loro letture.
+
+Ogni dispositivo ha un buffer circolare di dimensione fissa con le ultime
+letture (istante, grammi): la memoria per dispositivo resta costante qualunque
+sia la frequenza di invio. Un dispositivo può essere collegato alla
+consumazione in corso, così le letture vanno a chi sta bevendo da quel
+bicchiere e non a tutti gli utenti.
+
+Le letture possono arrivare anche a lotti (``decode_json_batch`` e
+``decode_binary_batch``): i campioni diventano due colonne NumPy (per il
+formato binario viste sul corpo della richiesta, senza copia), e ordinamento,
+scarto dei doppioni e copia nel buffer avvengono sull'intera colonna, senza
+creare un oggetto Python per campione.
+
+Il registro vive nella memoria del processo: con più worker ciascuno vede
+solo le letture che ha ricevuto.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Dispositivo usato da chi invia letture senza ID (firmware e script esistenti)
+DEFAULT_DEVICE_ID = 'default'
+
+# L'ID diventa anche il nome di una cartella dello storico: niente '.' iniziale,
+# così '.' e '..' (e i nomi nascosti) non sono ammessi
+_DEVICE_ID_RE = re.compile(r'^[A-Za-z0-9_:-][A-Za-z0-9_.:-]{0,63}$')
+
+
+def normalize_device_id(device_id):
+    """Restituisce l'ID del dispositivo ripulito, ``DEFAULT_DEVICE_ID`` se vuoto
+
+    Raises:
+        ValueError: se l'ID contiene caratteri non ammessi o è troppo lungo
+    """
+    if device_id is None:
+        return DEFAULT_DEVICE_ID
+    device_id = str(device_id).strip()
+    if not device_id:
+        return DEFAULT_DEVICE_ID
+    if not _DEVICE_ID_RE.match(device_id):
+        raise ValueError(f'ID dispositivo non valido: {device_id!r}')
+    return device_id
+
+
+# Campioni accettati al massimo in un lotto
+MAX_BATCH_SAMPLES = 4096
+
+# Letture tenute per dispositivo: almeno un lotto intero, perché il
+# riconoscimento dei sorsi rilegge dal buffer le letture appena registrate e
+# non deve trovarle già sovrascritte
+DEFAULT_BUFFER_SIZE = MAX_BATCH_SAMPLES
+
+# Formato binario di un campione: istante (secondi Unix) e grammi, due double little-endian
+BINARY_SAMPLE_SIZE = 16
+_BINARY_DTYPE = np.dtype('<f8')
+
+
+def _check_batch(timestamps, grams):
+    if len(timestamps) > MAX_BATCH_SAMPLES:
+        raise ValueError(f'Troppi campioni nel lotto: {len(timestamps)} (massimo {MAX_BATCH_SAMPLES})')
+    if not (np.isfinite(timestamps).all() and np.isfinite(grams).all()):
+        raise ValueError('Campioni non numerici nel lotto')
+    return timestamps, grams
+
+
+def decode_binary_batch(body):
+    """
+    Decodifica un lotto binario: campioni da 16 byte, ``<dd`` (istante, grammi).
+
+    Returns:
+        Due array NumPy (istanti, grammi): viste in sola lettura su ``body``
+
+    Raises:
+        ValueError: se la lunghezza non è multipla di 16 o i valori non sono finiti
+    """
+    if len(body) % BINARY_SAMPLE_SIZE:
+        raise ValueError(f'Lotto binario di {len(body)} byte: attesi multipli di {BINARY_SAMPLE_SIZE}')
+    values = np.frombuffer(body, _BINARY_DTYPE)
+    return _check_batch(values[0::2], values[1::2])
+
+
+def encode_binary_batch(timestamps, grams):
+    """Codifica un lotto nel formato di ``decode_binary_batch``"""
+    values = np.empty((len(timestamps), 2), _BINARY_DTYPE)
+    values[:, 0] = timestamps
+    values[:, 1] = grams
+    return values.tobytes()
+
+
+def decode_json_batch(samples):
+    """
+    Decodifica un lotto JSON: lista di coppie ``[istante, grammi]``.
+
+    Returns:
+        Due array NumPy: istanti e grammi
+
+    Raises:
+        ValueError: se il lotto non è una lista di coppie numeriche
+    """
+    if not isinstance(samples, list):
+        raise ValueError('Il lotto deve essere una lista di coppie [istante, grammi]')
+    if not samples:
+        return np.empty(0), np.empty(0)
+    try:
+        values = np.array(samples, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError('Il lotto deve essere una lista di coppie [istante, grammi]')
+    if values.ndim != 2 or values.shape[1] != 2:
+        raise ValueError('Il lotto deve essere una lista di coppie [istante, grammi]')
+    return _check_batch(values[:, 0], values[:, 1])
+
+
+class RingBuffer:
+    """Ultime ``capacity`` letture (istante, grammi) in due array NumPy preallocati"""
+
+    __slots__ = ('capacity', '_timestamps', '_grams', '_next', '_count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._timestamps = np.zeros(capacity)
+        self._grams = np.zeros(capacity)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, grams):
+        self._timestamps[self._next] = timestamp
+        self._grams[self._next] = grams
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def extend(self, timestamps, grams):
+        """Aggiunge più letture (array della stessa lunghezza) copiando a blocchi"""
+        n = len(timestamps)
+        if n > self.capacity:
+            timestamps, grams = timestamps[-self.capacity:], grams[-self.capacity:]
+            n = self.capacity
+        first = min(n, self.capacity - self._next)
+        self._timestamps[self._next:self._next + first] = timestamps[:first]
+        self._grams[self._next:self._next + first] = grams[:first]
+        if first < n:
+            self._timestamps[:n - first] = timestamps[first:]
+            self._grams[:n - first] = grams[first:]
+        self._next = (self._next + n) % self.capacity
+        self._count = min(self.capacity, self._count + n)
+
+    def latest(self):
+        """L'ultima lettura come (istante, grammi), None se il buffer è vuoto"""
+        if not self._count:
+            return None
+        index = (self._next - 1) % self.capacity
+        return float(self._timestamps[index]), float(self._grams[index])
+
+    def columns(self, since=None, limit=None):
+        """
+        Letture dalla più vecchia alla più recente come due array NumPy
+        (istanti, grammi), copiati a blocchi.
+
+        Args:
+            since: Solo le letture con istante successivo a questo
+            limit: Solo le ultime ``limit`` letture
+        """
+        count = self._count if limit is None else min(self._count, limit)
+        start = (self._next - count) % self.capacity
+        if start + count <= self.capacity:
+            timestamps = self._timestamps[start:start + count].copy()
+            grams = self._grams[start:start + count].copy()
+        else:
+            timestamps = np.concatenate((self._timestamps[start:], self._timestamps[:self._next]))
+            grams = np.concatenate((self._grams[start:], self._grams[:self._next]))
+        if since is not None:
+            # Le letture sono in ordine di tempo: quelle nuove sono in fondo
+            first = np.searchsorted(timestamps, since, 'right')
+            timestamps, grams = timestamps[first:], grams[first:]
+        return timestamps, grams
+
+    def items(self, since=None, limit=None):
+        """Come ``columns``, ma come lista di coppie (istante, grammi) da serializzare"""
+        timestamps, grams = self.columns(since=since, limit=limit)
+        return list(zip(timestamps.tolist(), grams.tolist()))
+
+
+class Device:
+    """Un sottobicchiere: buffer delle letture e consumazione collegata"""
+
+    def __init__(self, device_id, capacity):
+        self.device_id = device_id
+        self.buffer = RingBuffer(capacity)
+        self.consumazione_id = None
+        self.readings = 0
+        self.lock = threading.Lock()
+        # Sveglia chi aspetta nuove letture (vedi ``DeviceRegistry.wait_for``)
+        self.changed = threading.Condition(self.lock)
+
+
+class DeviceRegistry:
+    """Dispositivi noti al processo, ciascuno con il proprio buffer circolare"""
+
+    def __init__(self, capacity=DEFAULT_BUFFER_SIZE, max_devices=1000):
+        """
+        Args:
+            capacity: Letture tenute per ogni dispositivo (almeno MAX_BATCH_SAMPLES)
+            max_devices: Dispositivi tenuti in memoria; oltre si scarta quello
+                inattivo da più tempo (se non è collegato a una consumazione)
+        """
+        self.capacity = max(capacity, MAX_BATCH_SAMPLES)
+        self.max_devices = max_devices
+        self._devices = OrderedDict()
+        self._by_consumazione = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _device(self, device_id, create=False):
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                self._devices.move_to_end(device_id)
+                return device
+            if not create:
+                return None
+            device = self._devices[device_id] = Device(device_id, self.capacity)
+            if len(self._devices) > self.max_devices:
+                for old_id, old in list(self._devices.items()):
+                    if old.consumazione_id is None and old_id != device_id:
+                        del self._devices[old_id]
+                        self.evictions += 1
+                        break
+            return device
+
+    def record(self, device_id, grams, timestamp=None):
+        """Aggiunge una lettura al buffer del dispositivo; restituisce il ``Device``"""
+        device = self._device(device_id, create=True)
+        with device.lock:
+            device.buffer.append(timestamp if timestamp is not None else time.time(), float(grams))
+            device.readings += 1
+            device.changed.notify_all()
+        return device
+
+    def accept_batch(self, device_id, timestamps, grams):
+        """
+        Aggiunge un lotto di letture in ordine di tempo. I campioni non più
+        recenti dell'ultima lettura del dispositivo vengono ignorati, così un
+        lotto reinviato dopo un errore di rete non crea doppioni.
+
+        Returns:
+            (istanti, grammi, cursore): le colonne dei campioni accettati, in
+            ordine di tempo, e l'istante dell'ultima lettura tenuta; il
+            dispositivo può scartare tutto ciò che non lo supera
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        grams = np.asarray(grams, dtype=np.float64)
+        if len(timestamps) > 1 and (np.diff(timestamps) < 0).any():
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, grams = timestamps[order], grams[order]
+        device = self._device(device_id, create=True)
+        with device.lock:
+            latest = device.buffer.latest()
+            start = np.searchsorted(timestamps, latest[0], 'right') if latest else 0
+            timestamps, grams = timestamps[start:], grams[start:]
+            if len(timestamps):
+                device.buffer.extend(timestamps, grams)
+                device.readings += len(timestamps)
+                device.changed.notify_all()
+            latest = device.buffer.latest()
+        return timestamps, grams, (latest[0] if latest else None)
+
+    def record_batch(self, device_id, timestamps, grams):
+        """Come ``accept_batch``, ma restituisce (campioni accettati, cursore)"""
+        timestamps, _, cursor = self.accept_batch(device_id, timestamps, grams)
+        return len(timestamps), cursor
+
+    def latest(self, device_id):
+        """Ultima lettura (istante, grammi) del dispositivo, None se non ce ne sono"""
+        device = self._device(device_id)
+        if device is None:
+            return None
+        with device.lock:
+            return device.buffer.latest()
+
+    def samples(self, device_id, since=None, limit=None):
+        """Letture del dispositivo dalla più vecchia alla più recente (vedi ``RingBuffer.items``)"""
+        device = self._device(device_id)
+        if device is None:
+            return []
+        with device.lock:
+            return device.buffer.items(since=since, limit=limit)
+
+    def wait_for(self, device_id, since=None, timeout=None, limit=None):
+        """
+        Come ``samples``, ma se non ci sono letture successive a ``since``
+        aspetta che ne arrivi una, al massimo ``timeout`` secondi.
+
+        Returns:
+            Le letture nuove, lista vuota se il tempo è scaduto
+        """
+        device = self._device(device_id, create=True)
+
+        def arrived():
+            latest = device.buffer.latest()
+            return latest is not None and (since is None or latest[0] > since)
+
+        with device.changed:
+            if not device.changed.wait_for(arrived, timeout):
+                return []
+            return device.buffer.items(since=since, limit=limit)
+
+    def columns(self, device_id, since=None):
+        """Letture del dispositivo successive a ``since`` come (istanti, grammi), vedi ``RingBuffer.columns``"""
+        device = self._device(device_id)
+        if device is None:
+            return np.empty(0), np.empty(0)
+        with device.lock:
+            return device.buffer.columns(since=since)
+
+    def bind(self, device_id, consumazione_id):
+        """Collega il dispositivo a una consumazione (scollegando le precedenti)"""
+        device = self._device(device_id, create=True)
+        with self._lock:
+            if device.consumazione_id:
+                self._by_consumazione.pop(device.consumazione_id, None)
+            previous = self._by_consumazione.get(consumazione_id)
+            if previous is not None and previous != device_id and previous in self._devices:
+                self._devices[previous].consumazione_id = None
+            device.consumazione_id = consumazione_id
+            self._by_consumazione[consumazione_id] = device_id
+
+    def unbind_consumazione(self, consumazione_id):
+        """Scollega la consumazione dal suo dispositivo (a consumazione completata)"""
+        with self._lock:
+            device_id = self._by_consumazione.pop(consumazione_id, None)
+            device = self._devices.get(device_id)
+            if device is not None and device.consumazione_id == consumazione_id:
+                device.consumazione_id = None
+        return device_id
+
+    def device_ids(self):
+        """ID dei dispositivi in memoria, dal più recente"""
+        with self._lock:
+            return list(reversed(self._devices))
+
+    def consumazione_for(self, device_id):
+        device = self._device(device_id)
+        return device.consumazione_id if device else None
+
+    def device_for(self, consumazione_id):
+        with self._lock:
+            return self._by_consumazione.get(consumazione_id)
+
+    def get_stats(self):
+        with self._lock:
+            devices = list(self._devices.values())
+            return {
+                'devices': len(devices),
+                'bound': len(self._by_consumazione),
+                'capacity': self.capacity,
+                'readings': sum(device.readings for device in devices),
+                'evictions': self.evictions
+            }
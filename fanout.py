@@ -0,0 +1,92 @@
+"""Esecuzione concorrente di letture indipendenti verso Airtable.
+
+Le viste che fanno più letture senza dipendenze tra loro le lanciano insieme
+su un pool di thread condiviso, così la latenza diventa circa quella della
+chiamata più lenta invece della somma. Il pool ha un numero fisso di thread:
+è il limite alle chiamate contemporanee del processo verso la base, qualunque
+sia il numero di richieste in corso.
+
+Ogni thread spinge una copia del contesto della richiesta, e con essa un app
+context nuovo: il suo ``g`` parte vuoto. Quello che deve essere condiviso con
+chi chiama (ad esempio l'identity map delle letture) va indicato con
+``shared_g`` e deve essere thread-safe.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import copy_current_request_context, g, has_request_context
+
+from rate_governor import current_lane, priority
+
+_worker = threading.local()
+
+
+class FanOut:
+    """Pool di thread limitato per eseguire in parallelo letture indipendenti"""
+
+    def __init__(self, max_workers=4, shared_g=None):
+        """
+        Args:
+            max_workers: Numero massimo di letture contemporanee del processo
+            shared_g: Funzione senza argomenti chiamata nel thread della
+                richiesta; restituisce gli attributi {nome: valore} da
+                impostare sul ``g`` di ogni thread del pool
+        """
+        self.max_workers = max_workers
+        self.shared_g = shared_g
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='airtable-fanout')
+
+    def _wrap(self, fn):
+        # Dentro una richiesta i thread vedono la stessa request e la stessa
+        # sessione, più gli attributi di g indicati da shared_g
+        if has_request_context():
+            shared = self.shared_g() if self.shared_g else {}
+            target = fn
+
+            def with_shared_g():
+                for name, value in shared.items():
+                    setattr(g, name, value)
+                return target()
+            fn = copy_current_request_context(with_shared_g)
+        # e la stessa corsia di priorità verso Airtable. Non si copia l'intero
+        # contesto: conterrebbe anche l'app context (e quindi g) di chi chiama
+        lane = current_lane()
+
+        def run():
+            _worker.active = True
+            try:
+                with priority(lane):
+                    return fn()
+            finally:
+                _worker.active = False
+        return run
+
+    def run(self, calls):
+        """
+        Esegue in parallelo le funzioni senza argomenti di ``calls``.
+
+        Args:
+            calls: Dizionario {nome: funzione}
+
+        Returns:
+            Dizionario {nome: risultato}; se una funzione solleva un'eccezione,
+            questa viene rilanciata dopo che tutte le altre sono terminate
+        """
+        # Da un thread del pool si esegue in sequenza: aspettare altri thread
+        # dello stesso pool potrebbe bloccarlo del tutto
+        if getattr(_worker, 'active', False) or len(calls) <= 1:
+            return {name: fn() for name, fn in calls.items()}
+
+        futures = {name: self._executor.submit(self._wrap(fn)) for name, fn in calls.items()}
+        errors = [future.exception() for future in futures.values()]
+        for error in errors:
+            if error is not None:
+                raise error
+        return {name: future.result() for name, future in futures.items()}
+
+    def map(self, fn, items):
+        """Come ``run``, ma applica ``fn`` a ogni elemento: restituisce i risultati nello stesso ordine"""
+        items = list(items)
+        results = self.run({i: (lambda item=item: fn(item)) for i, item in enumerate(items)})
+        return [results[i] for i in range(len(items))]
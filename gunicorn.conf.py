@@ -0,0 +1,30 @@
+"""Configurazione di gunicorn (letta da sola se si avvia dalla cartella del progetto).
+
+Gli stream di /stream_arduino_data restano aperti fino a SSE_MAX_DURATION
+secondi: con i worker ``sync`` ognuno occuperebbe un intero processo. Con
+``gthread`` ogni worker serve più richieste in parallelo, una per thread, e
+uno stream occupa solo un thread.
+
+Ogni worker tiene aperti al massimo SSE_MAX_STREAMS stream (8): oltre, l'app
+risponde 503 e il browser riprova dopo qualche secondo. I thread sono quelli
+degli stream più GUNICORN_REQUEST_THREADS per le altre richieste, così gli
+stream non possono occupare tutto il worker. Gli utenti che seguono una
+consumazione insieme sono al massimo WEB_CONCURRENCY * SSE_MAX_STREAMS.
+
+Variabili d'ambiente:
+    WEB_CONCURRENCY: numero di worker (2)
+    SSE_MAX_STREAMS: stream SSE aperti al massimo in un worker (8)
+    GUNICORN_REQUEST_THREADS: thread per worker lasciati alle altre richieste (8)
+    GUNICORN_THREADS: thread per worker; se indicato sostituisce la somma dei due precedenti
+    GUNICORN_TIMEOUT: secondi di silenzio prima di riavviare un worker (60)
+    PORT: porta su cui ascoltare (8000)
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS') or
+              int(os.environ.get('SSE_MAX_STREAMS', '8')) + int(os.environ.get('GUNICORN_REQUEST_THREADS', '8')))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
@@ -0,0 +1,467 @@
+"""Journal locale write-behind per le scritture di Sorsi e Consumazioni.
+
+Ogni scrittura viene aggiunta (e sincronizzata su disco) a un file append-only
+e confermata subito a chi la richiede con un ID provvisorio ('loc...'). Un
+thread in background invia i record ad Airtable a blocchi di 10 (il massimo
+per richiesta), ritenta gli errori e rispetta l'ordine delle scritture di
+ciascuna consumazione: un sorso collegato a una consumazione non ancora
+inviata aspetta che Airtable le assegni l'ID definitivo.
+
+Le letture uniscono ai dati di Airtable le scritture non ancora inviate, così
+l'utente vede subito i propri sorsi. Ogni processo usa un proprio file del
+journal (bloccato con flock): i file lasciati da un processo terminato vengono
+ripresi e svuotati dal primo processo che li trova liberi.
+
+Scritture in attesa e ID provvisori sono visibili solo al processo che li ha
+creati: un ID provvisorio non deve finire dove lo legge un altro worker (ad
+esempio in sessione). Per questo l'app crea le consumazioni direttamente su
+Airtable e passa dal journal solo per sorsi e aggiornamenti, con l'ID definitivo
+della consumazione come chiave.
+
+Una creazione non è idempotente: dopo un 5xx, un timeout di lettura o un
+arresto a metà invio Airtable potrebbe aver già creato i record. Prima di ogni
+POST le scritture vengono segnate come inviate; si ritentano liberamente solo
+se la richiesta non è partita o Airtable ha risposto 429/4xx. Altrimenti
+l'esito è incerto: con ``id_field`` ogni record porta su Airtable il proprio ID
+provvisorio e prima di reinviarlo si cerca se esiste già; senza, la scrittura
+non viene ripetuta e finisce in rejected.log. Gli aggiornamenti (PATCH degli
+stessi campi) si possono ripetere senza effetti doppi.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import requests
+
+import airtable_query as aq
+from airtable_client import RETRY_STATUS_CODES, CircuitOpenError, request_not_sent
+from rate_governor import CRITICAL, set_lane
+
+logger = logging.getLogger(__name__)
+
+# Prefisso degli ID provvisori assegnati prima dell'invio ad Airtable
+LOCAL_ID_PREFIX = 'loc'
+
+# Massimo numero di record per richiesta accettato da Airtable
+BATCH_SIZE = 10
+
+# Tentativi dopo i quali un record rifiutato da Airtable (4xx) viene scartato
+# e copiato in rejected.log
+MAX_ATTEMPTS = 10
+
+# Corrispondenze ID provvisorio -> ID Airtable conservate dopo la compattazione
+MAX_ALIASES = 10000
+
+# Righe scritte dopo le quali il file, se non ci sono record in attesa, viene compattato
+COMPACT_AFTER = 1000
+
+
+def is_local_id(record_id):
+    return isinstance(record_id, str) and record_id.startswith(LOCAL_ID_PREFIX)
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class WriteJournal:
+    """Coda persistente di scritture verso Airtable, svuotata da un thread in background"""
+
+    def __init__(self, client, directory, flush_interval=0.5, max_backoff=30.0, on_flushed=None,
+                 id_field=None):
+        """
+        Args:
+            client: AirtableClient usato per l'invio
+            directory: Cartella dei file del journal
+            flush_interval: Attesa massima in secondi tra due invii
+            max_backoff: Attesa massima in secondi dopo errori ripetuti
+            on_flushed: Funzione chiamata con (tabella, record) dopo ogni invio riuscito
+            id_field: Campo di testo delle tabelle in cui ogni record creato
+                porta il proprio ID provvisorio, per riconoscere i record già
+                creati da un invio dall'esito incerto (None: nessun reinvio)
+        """
+        self.client = client
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.on_flushed = on_flushed
+        self.id_field = id_field
+
+        self._pending = OrderedDict()
+        self._aliases = OrderedDict()
+        self._seq = 0
+        self._lines = 0
+        self._dropped = 0
+        self._flushed = 0
+        self._failures = 0
+        self._cond = threading.Condition(threading.RLock())
+        self._thread = None
+        self._file = self._open()
+        self._replay()
+
+    # === File ===
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        index = 0
+        while True:
+            path = os.path.join(self.directory, f'journal-{index}.log')
+            fh = open(path, 'a+', encoding='utf-8')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                index += 1
+                continue
+            self.path = path
+            return fh
+
+    def close(self):
+        """Chiude il file del journal: le scritture in attesa restano per il prossimo avvio"""
+        with self._cond:
+            self._file.close()
+
+    def _replay(self):
+        self._file.seek(0)
+        for line in self._file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Riga troncata da un arresto durante la scrittura
+                continue
+            self._lines += 1
+            if 'op' in entry:
+                self._pending[entry['seq']] = entry
+                self._seq = max(self._seq, entry['seq'])
+            elif 'ack' in entry:
+                acked = self._pending.pop(entry['ack'], None)
+                if acked and acked['op'] == 'create':
+                    self._aliases[acked['id']] = entry['id']
+            elif 'drop' in entry:
+                self._pending.pop(entry['drop'], None)
+            elif 'sending' in entry or 'unsent' in entry:
+                sent = 'sending' in entry
+                for seq in entry['sending' if sent else 'unsent']:
+                    if seq in self._pending:
+                        self._pending[seq]['sent'] = sent
+            elif 'alias' in entry:
+                self._aliases[entry['alias']] = entry['id']
+        if self._pending:
+            logger.info("[JOURNAL] %s: %d scritture da inviare", self.path, len(self._pending))
+
+    def _write(self, *entries):
+        self._file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lines += len(entries)
+
+    def _compact(self):
+        """Riscrive il file con le sole corrispondenze degli ID (nessun record in attesa)"""
+        while len(self._aliases) > MAX_ALIASES:
+            self._aliases.popitem(last=False)
+        self._file.seek(0)
+        self._file.truncate()
+        self._lines = 0
+        self._write(*({'alias': local_id, 'id': record_id} for local_id, record_id in self._aliases.items()))
+
+    # === Scrittura ===
+
+    def append_create(self, table, fields, key=None):
+        """
+        Registra la creazione di un record e lo restituisce con un ID provvisorio.
+
+        Args:
+            table: Tabella Airtable
+            fields: Campi del record; gli ID provvisori nei campi collegati
+                vengono sostituiti con quelli definitivi prima dell'invio
+            key: Chiave di ordinamento (l'ID della consumazione); le scritture
+                con la stessa chiave vengono inviate nell'ordine di arrivo
+        """
+        local_id = LOCAL_ID_PREFIX + uuid.uuid4().hex[:14]
+        created_time = _now_iso()
+        with self._cond:
+            self._seq += 1
+            entry = {'seq': self._seq, 'op': 'create', 'table': table, 'id': local_id,
+                     'key': self.resolve(key or local_id), 'fields': fields, 'created': created_time}
+            self._write(entry)
+            self._pending[entry['seq']] = entry
+            self._cond.notify()
+        return {'id': local_id, 'createdTime': created_time, 'fields': dict(fields)}
+
+    def append_update(self, table, record_id, fields, key=None):
+        """Registra l'aggiornamento di alcuni campi di un record (anche con ID provvisorio)"""
+        with self._cond:
+            self._seq += 1
+            entry = {'seq': self._seq, 'op': 'update', 'table': table, 'id': record_id,
+                     'key': self.resolve(key or record_id), 'fields': fields}
+            self._write(entry)
+            self._pending[entry['seq']] = entry
+            self._cond.notify()
+
+    # === Lettura ===
+
+    def resolve(self, record_id):
+        """ID definitivo di Airtable se l'ID provvisorio è già stato inviato, altrimenti l'ID stesso"""
+        return self._aliases.get(record_id, record_id)
+
+    def _resolve_fields(self, fields):
+        return {
+            name: [self.resolve(v) for v in value] if isinstance(value, list) else value
+            for name, value in fields.items()
+        }
+
+    def _apply_updates(self, table, record):
+        record_id = self.resolve(record['id'])
+        for entry in self._pending.values():
+            if entry['op'] == 'update' and entry['table'] == table and self.resolve(entry['id']) == record_id:
+                record['fields'].update(self._resolve_fields(entry['fields']))
+        return record
+
+    def get_pending(self, table, record_id):
+        """Il record ancora in attesa di essere creato, con gli aggiornamenti successivi (o None)"""
+        with self._cond:
+            for entry in self._pending.values():
+                if entry['op'] == 'create' and entry['table'] == table and entry['id'] == record_id:
+                    record = {'id': entry['id'], 'createdTime': entry['created'],
+                              'fields': self._resolve_fields(entry['fields'])}
+                    return self._apply_updates(table, record)
+        return None
+
+    def apply_pending(self, table, record):
+        """Applica a un record letto da Airtable gli aggiornamenti non ancora inviati"""
+        if not record:
+            return record
+        with self._cond:
+            return self._apply_updates(table, record)
+
+    def pending_records(self, table, link_field=None, link_id=None):
+        """Record non ancora creati su Airtable, eventualmente filtrati per campo collegato"""
+        target = self.resolve(link_id) if link_id else None
+        records = []
+        with self._cond:
+            for entry in self._pending.values():
+                if entry['op'] != 'create' or entry['table'] != table:
+                    continue
+                fields = self._resolve_fields(entry['fields'])
+                if link_field and target not in fields.get(link_field, []):
+                    continue
+                record = {'id': entry['id'], 'createdTime': entry['created'], 'fields': fields}
+                records.append(self._apply_updates(table, record))
+        return records
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'path': self.path,
+                'pending': len(self._pending),
+                'flushed': self._flushed,
+                'dropped': self._dropped,
+                'consecutive_failures': self._failures,
+            }
+
+    # === Invio ===
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='airtable-journal', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        # Sorsi e consumazioni hanno la precedenza sul budget di richieste ad Airtable
+        set_lane(CRITICAL)
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(self.flush_interval)
+            try:
+                sent = self.flush()
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                delay = min(self.max_backoff, self.flush_interval * 2 ** self._failures)
+                logger.warning("[JOURNAL] Invio ad Airtable fallito (%s), nuovo tentativo tra %.1fs", e, delay)
+                threading.Event().wait(delay)
+                continue
+            if not sent:
+                with self._cond:
+                    self._cond.wait(self.flush_interval)
+
+    def _is_ready(self, entry):
+        """Vero se tutti gli ID provvisori a cui la scrittura fa riferimento sono già stati risolti"""
+        if entry['op'] == 'update' and is_local_id(self.resolve(entry['id'])):
+            return False
+        for value in entry['fields'].values():
+            if isinstance(value, list) and any(is_local_id(self.resolve(v)) for v in value):
+                return False
+        return True
+
+    def _next_batch(self):
+        """
+        Sceglie fino a BATCH_SIZE scritture con la stessa tabella e operazione
+        della più vecchia tra quelle pronte. Una chiave esclusa da questo giro
+        blocca anche le scritture successive con la stessa chiave, così
+        l'ordine per consumazione è rispettato.
+        """
+        batch = []
+        blocked = set()
+        kind = None
+        with self._cond:
+            for entry in self._pending.values():
+                key = self.resolve(entry['key'])
+                if key in blocked:
+                    continue
+                if not self._is_ready(entry):
+                    blocked.add(key)
+                    continue
+                if kind is None:
+                    kind = (entry['table'], entry['op'])
+                if (entry['table'], entry['op']) != kind or len(batch) >= BATCH_SIZE:
+                    blocked.add(key)
+                    continue
+                batch.append(entry)
+        return batch
+
+    def flush(self):
+        """Invia un blocco di scritture in attesa; restituisce quante sono state completate"""
+        batch = self._next_batch()
+        if not batch:
+            if self._lines >= COMPACT_AFTER:
+                with self._cond:
+                    if not self._pending:
+                        self._compact()
+            return 0
+
+        table, op = batch[0]['table'], batch[0]['op']
+        done = 0
+        if op == 'create':
+            batch, done = self._recover_uncertain(table, batch)
+            if not batch:
+                return done
+        response = self._send(table, op, batch)
+
+        if response.status_code == 200:
+            return done + self._ack(table, op, batch, response.json().get('records', []))
+
+        if response.status_code in RETRY_STATUS_CODES:
+            raise RuntimeError(f"Airtable ha risposto {response.status_code}")
+
+        # Richiesta rifiutata: se il blocco ha più record si riprova uno per uno,
+        # così un solo record non valido non blocca gli altri
+        logger.error("[JOURNAL] %s %s rifiutata (%s): %s", op, table, response.status_code, response.text)
+        if len(batch) == 1:
+            self._reject(batch[0])
+        else:
+            for entry in batch:
+                self._flush_single(entry)
+        raise RuntimeError(f"Airtable ha rifiutato la scrittura ({response.status_code})")
+
+    def _send(self, table, op, batch):
+        """Una richiesta POST/PATCH per il blocco; le creazioni restano segnate se l'esito è incerto"""
+        records = []
+        for entry in batch:
+            record = {'fields': self._resolve_fields(entry['fields'])}
+            if op == 'update':
+                record['id'] = self.resolve(entry['id'])
+            elif self.id_field:
+                record['fields'][self.id_field] = entry['id']
+            records.append(record)
+        if op == 'create':
+            self._mark_sent(batch, True)
+        try:
+            response = self.client.request('POST' if op == 'create' else 'PATCH', table,
+                                           json={'records': records})
+        except requests.RequestException as e:
+            if op == 'create' and (isinstance(e, CircuitOpenError) or request_not_sent(e)):
+                self._mark_sent(batch, False)
+            raise
+        # 200: confermate da _ack; 429 e 4xx: Airtable non ha creato niente
+        if op == 'create' and response.status_code != 200 and response.status_code < 500:
+            self._mark_sent(batch, False)
+        return response
+
+    def _mark_sent(self, batch, sent):
+        with self._cond:
+            for entry in batch:
+                entry['sent'] = sent
+            self._write({'sending' if sent else 'unsent': [entry['seq'] for entry in batch]})
+
+    def _recover_uncertain(self, table, batch):
+        """
+        Risolve le creazioni già inviate con esito incerto: quelle che Airtable
+        ha creato vengono confermate, le altre si possono inviare.
+
+        Returns:
+            (scritture da inviare, scritture confermate o scartate)
+        """
+        uncertain = [entry for entry in batch if entry.get('sent')]
+        if not uncertain:
+            return batch, 0
+        if not self.id_field:
+            for entry in uncertain:
+                self._discard(entry, 'esito incerto, non reinviata per non duplicarla')
+            return [entry for entry in batch if not entry.get('sent')], len(uncertain)
+
+        formula = aq.or_(*(aq.eq(self.id_field, entry['id']) for entry in uncertain))
+        found = {}
+        for record in self.client.get_all(table, params=aq.build_params(formula=formula)):
+            found.setdefault(record['fields'].get(self.id_field), record)
+        created = [entry for entry in uncertain if entry['id'] in found]
+        if created:
+            logger.warning("[JOURNAL] %d scritture di %s erano già su Airtable", len(created), table)
+            self._ack(table, 'create', created, [found[entry['id']] for entry in created])
+        retry = [entry for entry in uncertain if entry['id'] not in found]
+        if retry:
+            self._mark_sent(retry, False)
+        return [entry for entry in batch if entry['id'] not in found], len(created)
+
+    def _ack(self, table, op, batch, saved):
+        with self._cond:
+            acks = []
+            for entry, record in zip(batch, saved):
+                self._pending.pop(entry['seq'], None)
+                if op == 'create':
+                    self._aliases[entry['id']] = record['id']
+                acks.append({'ack': entry['seq'], 'id': record['id']})
+            self._write(*acks)
+            self._flushed += len(acks)
+        self._notify_flushed(table, saved)
+        return len(acks)
+
+    def _flush_single(self, entry):
+        response = self._send(entry['table'], entry['op'], [entry])
+        if response.status_code == 200:
+            self._ack(entry['table'], entry['op'], [entry], response.json().get('records', []))
+        elif response.status_code not in RETRY_STATUS_CODES:
+            self._reject(entry)
+
+    def _reject(self, entry):
+        """Conta un rifiuto di Airtable; oltre MAX_ATTEMPTS la scrittura va in rejected.log"""
+        with self._cond:
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            if entry['attempts'] >= MAX_ATTEMPTS:
+                self._discard(entry, f"rifiutata {entry['attempts']} volte")
+
+    def _discard(self, entry, reason):
+        """Toglie la scrittura dal journal e la copia in rejected.log"""
+        with self._cond:
+            with open(os.path.join(self.directory, 'rejected.log'), 'a', encoding='utf-8') as fh:
+                fh.write(json.dumps(dict(entry, reason=reason)) + '\n')
+            self._pending.pop(entry['seq'], None)
+            self._write({'drop': entry['seq']})
+            self._dropped += 1
+            logger.error("[JOURNAL] Scrittura %s scartata: %s", entry['seq'], reason)
+
+    def _notify_flushed(self, table, records):
+        if not self.on_flushed:
+            return
+        try:
+            self.on_flushed(table, records)
+        except Exception as e:
+            logger.error("[JOURNAL] Errore dopo l'invio di %s: %s", table, e)
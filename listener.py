@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Ricevitore delle letture dei sottobicchieri, fuori da Flask/gunicorn.
+
+Un processo asyncio ascolta su UDP e/o TCP un protocollo a righe:
+
+    [device_id] grammi [istante]
+
+una lettura per riga (istante Unix in secondi; se manca vale l'ora di
+arrivo, se manca anche il dispositivo si usa quello di default). Un datagramma
+UDP può contenere più righe. Le letture vengono raccolte per dispositivo e
+inviate a lotti a ``/arduino_batch`` dell'applicazione, la stessa via di
+ingestione degli altri endpoint: i worker web ricevono una richiesta per
+dispositivo ogni FLUSH_INTERVAL invece di una per lettura.
+
+Uso:
+    python listener.py serve --udp 5005 --tcp 5006 --target http://localhost:5000
+    python listener.py simulate --udp 5005 --devices 5 --rate 20 --duration 30
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from array import array
+
+import requests
+
+from devices import MAX_BATCH_SAMPLES, encode_binary_batch, normalize_device_id
+from log_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UDP_PORT = 5005
+DEFAULT_TCP_PORT = 5006
+
+# Ogni quanto le letture raccolte vengono inviate all'applicazione
+FLUSH_INTERVAL = 0.25
+
+# Letture tenute per dispositivo mentre l'applicazione non risponde: oltre
+# si scartano le più vecchie
+MAX_PENDING = MAX_BATCH_SAMPLES * 4
+
+
+def parse_line(line, now):
+    """
+    ``[device_id] grammi [istante]`` -> (device_id, istante, grammi)
+
+    Raises:
+        ValueError: se la riga non è nel formato atteso
+    """
+    fields = line.split()
+    if len(fields) == 1:
+        device_id, grams, timestamp = None, fields[0], None
+    elif len(fields) == 2:
+        (device_id, grams), timestamp = fields, None
+    elif len(fields) == 3:
+        device_id, grams, timestamp = fields
+    else:
+        raise ValueError(f'Riga non valida: {line!r}')
+    return normalize_device_id(device_id), float(timestamp) if timestamp else now, float(grams)
+
+
+class RegistrySink:
+    """Scrive i lotti direttamente in un ``DeviceRegistry`` dello stesso processo"""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def send(self, device_id, timestamps, grams):
+        return self.registry.record_batch(device_id, timestamps, grams)[1]
+
+
+class HttpSink:
+    """Invia i lotti a ``/arduino_batch`` dell'applicazione nel formato binario"""
+
+    def __init__(self, base_url, timeout=(3.05, 10)):
+        self.url = base_url.rstrip('/') + '/arduino_batch'
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, device_id, timestamps, grams):
+        response = self.session.post(
+            self.url, params={'device': device_id}, data=encode_binary_batch(timestamps, grams),
+            headers={'Content-Type': 'application/octet-stream'}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()['cursor']
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.feed(data)
+
+
+class ReadingListener:
+    """Raccoglie le letture ricevute su UDP/TCP e le passa a lotti a un sink"""
+
+    def __init__(self, sink, flush_interval=FLUSH_INTERVAL):
+        """
+        Args:
+            sink: Oggetto con ``send(device_id, istanti, grammi)`` (``HttpSink`` o ``RegistrySink``)
+            flush_interval: Secondi tra due invii
+        """
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._servers = []
+        self._flushing = None
+        self.stats = {'received': 0, 'invalid': 0, 'sent': 0, 'send_errors': 0, 'dropped': 0}
+
+    def feed(self, data, now=None):
+        """Aggiunge le letture contenute in ``data`` (una o più righe)"""
+        now = now if now is not None else time.time()
+        for line in data.decode('ascii', 'replace').splitlines():
+            if not line.strip():
+                continue
+            try:
+                device_id, timestamp, grams = parse_line(line, now)
+            except ValueError as e:
+                self.stats['invalid'] += 1
+                logger.debug("[LISTENER] %s", e)
+                continue
+            pending = self._pending.get(device_id)
+            if pending is None:
+                pending = self._pending[device_id] = (array('d'), array('d'))
+            pending[0].append(timestamp)
+            pending[1].append(grams)
+            self.stats['received'] += 1
+
+    def pending(self):
+        return sum(len(timestamps) for timestamps, _ in self._pending.values())
+
+    async def flush(self):
+        """Invia le letture raccolte, a blocchi di al massimo MAX_BATCH_SAMPLES per dispositivo"""
+        batches, self._pending = self._pending, {}
+        for device_id, (timestamps, grams) in batches.items():
+            for start in range(0, len(timestamps), MAX_BATCH_SAMPLES):
+                end = start + MAX_BATCH_SAMPLES
+                try:
+                    await asyncio.to_thread(self.sink.send, device_id, timestamps[start:end], grams[start:end])
+                except Exception as e:
+                    self.stats['send_errors'] += 1
+                    logger.warning("[LISTENER] Invio di %s letture di %s fallito: %s",
+                                   len(timestamps) - start, device_id, e)
+                    self._requeue(device_id, timestamps[start:], grams[start:])
+                    break
+                self.stats['sent'] += min(end, len(timestamps)) - start
+
+    def _requeue(self, device_id, timestamps, grams):
+        # Le letture non inviate tornano davanti a quelle arrivate nel frattempo;
+        # il cursore di /arduino_batch scarta quelle che erano già arrivate
+        newer = self._pending.get(device_id)
+        if newer is not None:
+            timestamps, grams = timestamps + newer[0], grams + newer[1]
+        if len(timestamps) > MAX_PENDING:
+            self.stats['dropped'] += len(timestamps) - MAX_PENDING
+            timestamps, grams = timestamps[-MAX_PENDING:], grams[-MAX_PENDING:]
+        self._pending[device_id] = (timestamps, grams)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Protetto dalla cancellazione di stop(): un invio a metà finisce,
+            # altrimenti le letture già tolte da _pending andrebbero perse
+            self._flushing = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flushing)
+
+    async def _handle_tcp(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.feed(line)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.warning("[LISTENER] Connessione TCP chiusa: %s", e)
+        finally:
+            writer.close()
+
+    async def start(self, host='0.0.0.0', udp_port=None, tcp_port=None):
+        """Apre le porte richieste; restituisce gli indirizzi effettivi (utile con porta 0)"""
+        loop = asyncio.get_running_loop()
+        addresses = {}
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(lambda: _UdpProtocol(self), local_addr=(host, udp_port))
+            self._servers.append(transport)
+            addresses['udp'] = transport.get_extra_info('sockname')
+        if tcp_port is not None:
+            server = await asyncio.start_server(self._handle_tcp, host, tcp_port)
+            self._servers.append(server)
+            addresses['tcp'] = server.sockets[0].getsockname()
+        self._servers.append(loop.create_task(self._flush_forever()))
+        logger.info("[LISTENER] In ascolto su %s", addresses)
+        return addresses
+
+    async def stop(self):
+        """Chiude le porte e invia le letture rimaste"""
+        for server in self._servers:
+            if isinstance(server, asyncio.Task):
+                server.cancel()
+            else:
+                server.close()
+        self._servers = []
+        if self._flushing is not None:
+            await self._flushing
+            self._flushing = None
+        await self.flush()
+
+
+async def simulate(host, udp_port=None, tcp_port=None, devices=3, rate=10.0, duration=10.0, seed=None):
+    """
+    Simula ``devices`` sottobicchieri che mandano ``rate`` letture al secondo:
+    bicchieri che si svuotano a sorsi, con un po' di rumore della bilancia.
+
+    Returns:
+        Il numero di letture inviate
+    """
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    if tcp_port is not None:
+        _, writer = await asyncio.open_connection(host, tcp_port)
+        send = writer.write
+    else:
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, udp_port))
+        send = transport.sendto
+
+    weights = {f'sim-{i}': rng.uniform(200, 350) for i in range(devices)}
+    sent = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        now = time.time()
+        lines = []
+        for device_id, weight in weights.items():
+            if rng.random() < 0.02:
+                weights[device_id] = weight = max(0.0, weight - rng.uniform(10, 30))
+            lines.append(f'{device_id} {weight + rng.gauss(0, 0.3):.1f} {now:.3f}\n')
+        send(''.join(lines).encode('ascii'))
+        sent += len(lines)
+        await asyncio.sleep(1 / rate)
+
+    if tcp_port is not None:
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    else:
+        transport.close()
+    return sent
+
+
+async def _serve(args):
+    listener = ReadingListener(HttpSink(args.target), flush_interval=args.flush_interval)
+    await listener.start(args.host, args.udp, args.tcp)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await listener.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ricevitore e simulatore delle letture dei sottobicchieri')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='Riceve le letture e le inoltra all\'applicazione')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--udp', type=int, default=None, help=f'Porta UDP (es. {DEFAULT_UDP_PORT})')
+    serve.add_argument('--tcp', type=int, default=None, help=f'Porta TCP (es. {DEFAULT_TCP_PORT})')
+    serve.add_argument('--target', default=os.environ.get('LISTENER_TARGET', 'http://localhost:5000'),
+                       help='URL dell\'applicazione Flask')
+    serve.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL)
+
+    sim = commands.add_parser('simulate', help='Manda letture di sottobicchieri simulati')
+    sim.add_argument('--host', default='127.0.0.1')
+    sim.add_argument('--udp', type=int, default=None)
+    sim.add_argument('--tcp', type=int, default=None)
+    sim.add_argument('--devices', type=int, default=3)
+    sim.add_argument('--rate', type=float, default=10.0, help='Letture al secondo per sottobicchiere')
+    sim.add_argument('--duration', type=float, default=10.0, help='Secondi di simulazione')
+
+    args = parser.parse_args(argv)
+    configure_logging()
+    if args.command == 'serve':
+        if args.udp is None and args.tcp is None:
+            args.udp = DEFAULT_UDP_PORT
+        try:
+            asyncio.run(_serve(args))
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.udp is None and args.tcp is None:
+            args.udp = DEFAULT_UDP_PORT
+        sent = asyncio.run(simulate(args.host, args.udp, args.tcp, args.devices, args.rate, args.duration))
+        logger.info("[SIMULATORE] Inviate %s letture", sent)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Configurazione del logging dell'applicazione.
+
+I record passano da una coda (``QueueHandler``) a un thread che li formatta e
+li scrive (``QueueListener``): chi logga non aspetta né la formattazione né
+l'I/O. I messaggi vanno scritti in stile ``%`` (``logger.debug("x=%s", x)``),
+così se il livello è disattivato non si costruisce nemmeno la stringa.
+
+Variabili d'ambiente:
+    LOG_LEVEL: livello di default (INFO)
+    LOG_LEVELS: livelli per modulo, es. ``app.arduino=WARNING,airtable_client=DEBUG``
+    LOG_FORMAT: ``text`` (default) oppure ``json``, una riga per record
+
+I campi passati con ``extra={...}`` finiscono nel record strutturato: come
+``chiave=valore`` in testo, come chiavi proprie in JSON.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+# Attributi standard di LogRecord: tutto il resto arriva da ``extra``
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Argomenti che si possono lasciare da formattare al thread del listener
+# senza rischiare che cambino nel frattempo
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+_listener = None
+
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """``2026-10-17T10:00:00.000Z INFO app messaggio chiave=valore``"""
+
+    def format(self, record):
+        line = '%s %s %s %s' % (
+            datetime.fromtimestamp(record.created, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            record.levelname, record.name, record.getMessage()
+        )
+        fields = _extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value!r}' if isinstance(value, str) and ' ' in value
+                                   else f'{key}={value}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Un oggetto JSON per riga, con i campi di ``extra`` al primo livello"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        data.update(_extra_fields(record))
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler che non formatta nel thread di chi logga quando non serve.
+
+    Quello standard costruisce il messaggio subito (pensato per code tra
+    processi); qui la coda è nello stesso processo, quindi se gli argomenti
+    sono immutabili il record passa così com'è e lo formatta il listener.
+    """
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, _IMMUTABLE) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lascia passare un record ogni ``every`` sotto il livello ``max_level``
+    (di default tutti i livelli fino a INFO): gli eventi frequenti, come le
+    letture della bilancia, restano visibili senza riempire i log. Avvisi ed
+    errori passano sempre.
+    """
+
+    def __init__(self, every, max_level=logging.INFO):
+        super().__init__()
+        self.every = max(1, int(every))
+        self.max_level = max_level
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level or self.every == 1:
+            return True
+        with self._lock:
+            self._count += 1
+            keep = self._count % self.every == 1
+        if keep:
+            record.sampled = self.every
+        return keep
+
+
+def parse_levels(spec):
+    """``'app=INFO,airtable_client=DEBUG'`` -> {'app': 'INFO', 'airtable_client': 'DEBUG'}"""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, sep, level = item.strip().partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level=None, module_levels=None, fmt=None):
+    """
+    Imposta il logging del processo: coda asincrona verso stderr, livelli per
+    modulo e formato testo o JSON. Chiamarla più volte non aggiunge handler.
+    """
+    global _listener
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    module_levels = module_levels if module_levels is not None else parse_levels(os.environ.get('LOG_LEVELS'))
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'text')
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for name, module_level in module_levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    if _listener is not None:
+        return _listener
+
+    sink = logging.StreamHandler()
+    sink.setFormatter(JsonFormatter() if fmt == 'json' else KeyValueFormatter())
+
+    log_queue = queue.SimpleQueue()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, sink, respect_handler_level=True)
+    _listener.start()
+    # Alla chiusura il listener svuota la coda prima di terminare
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def sampled_logger(name, every):
+    """Logger ``name`` che tiene un record ogni ``every`` fino al livello INFO"""
+    logger = logging.getLogger(name)
+    if not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(every))
+    return logger
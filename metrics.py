@@ -0,0 +1,205 @@
+"""Metriche dell'applicazione nel formato testuale di Prometheus.
+
+Contatori e istogrammi sono pensati per i percorsi caldi: ogni thread scrive
+in un proprio dizionario (nessun lock per osservazione) e i valori dei thread
+vengono sommati solo quando qualcuno legge ``/metrics``. I dati che esistono
+già altrove (statistiche del client Airtable, della cache, del journal) non
+vengono duplicati: li legge al momento della lettura un collector.
+
+Ogni processo ha le proprie metriche: con più worker gunicorn ogni lettura
+restituisce quelle del worker che la serve (vedi ``worker_pid``).
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Limiti degli istogrammi di latenza, in secondi
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _PerThread:
+    """
+    Un dizionario {etichette: valore} per thread. Chi scrive tocca solo il
+    proprio; chi legge somma tutti e riporta nella base quelli dei thread
+    terminati, così i thread creati per ogni richiesta non si accumulano.
+    """
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._base = {}
+
+    def mine(self):
+        data = getattr(self._local, 'data', None)
+        if data is None:
+            data = self._local.data = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), data))
+        return data
+
+    def collect(self):
+        with self._lock:
+            alive = []
+            for thread, data in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, data))
+                else:
+                    self._merge_into(self._base, data)
+            self._shards = alive
+            total = {}
+            self._merge_into(total, self._base)
+            for _, data in alive:
+                self._merge_into(total, dict(data))
+        return total
+
+    def _merge_into(self, target, data):
+        for key, value in data.items():
+            target[key] = self._merge(target.get(key), value)
+
+
+class Counter:
+    """Contatore monotono con etichette; per convenzione il nome finisce con ``_total``"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = _PerThread(lambda a, b: (a or 0) + b)
+
+    def inc(self, *labels, amount=1):
+        data = self._values.mine()
+        data[labels] = data.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.collect().items()):
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+
+def _merge_histogram(current, other):
+    if current is None:
+        return list(other)
+    return [a + b for a, b in zip(current, other)]
+
+
+class Histogram:
+    """Istogramma cumulativo (bucket, somma e numero di osservazioni) con etichette"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = _PerThread(_merge_histogram)
+
+    def observe(self, value, *labels):
+        data = self._values.mine()
+        counts = data.get(labels)
+        if counts is None:
+            # Un contatore per bucket, più +Inf, somma e numero
+            counts = data[labels] = [0] * (len(self.buckets) + 3)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Osserva la durata del blocco"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        for labels, counts in sorted(self._values.collect().items()):
+            labels = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+            yield self.name + '_sum', labels, counts[-2]
+            yield self.name + '_count', labels, counts[-1]
+
+
+class MetricsRegistry:
+    """Insieme delle metriche esposte da ``/metrics``"""
+
+    def __init__(self, namespace=''):
+        self.namespace = namespace
+        self._metrics = []
+        self._collectors = []
+
+    def _name(self, name):
+        return f'{self.namespace}_{name}' if self.namespace else name
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self._name(name), documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self._name(name), documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """
+        Registra una funzione chiamata a ogni lettura. Deve restituire tuple
+        ``(nome, tipo, descrizione, [(etichette, valore), ...])`` dove le
+        etichette sono un dizionario; il nome è già completo.
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        """Testo nel formato di esposizione di Prometheus (versione 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        families = [(self._name('worker_pid'), 'gauge', 'PID del worker che ha servito la lettura', [({}, os.getpid())])]
+        for collector in self._collectors:
+            families.extend(collector())
+        for name, kind, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
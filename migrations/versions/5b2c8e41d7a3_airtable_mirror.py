@@ -0,0 +1,163 @@
+"""Airtable mirror tables
+
+Revision ID: 5b2c8e41d7a3
+Revises: ad7f9a65706e
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2c8e41d7a3'
+down_revision = 'ad7f9a65706e'
+branch_labels = None
+depends_on = None
+
+
+def _mirror_columns():
+    return [
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('created_time', sa.DateTime(), nullable=True),
+        sa.Column('fields_json', sa.Text(), nullable=False),
+    ]
+
+
+def upgrade():
+    # Le tabelle iniziali (ID interi) non sono mai state usate: vengono sostituite
+    # dalle tabelle del mirror, identificate dagli ID dei record Airtable
+    op.drop_table('consumazione')
+    op.drop_table('drink')
+    op.drop_table('user')
+    op.drop_table('bar')
+
+    op.create_table('bar',
+    *_mirror_columns(),
+    sa.Column('nome', sa.String(length=200), nullable=True),
+    sa.Column('indirizzo', sa.String(length=300), nullable=True),
+    sa.Column('citta', sa.String(length=100), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_bar_created_time', 'bar', ['created_time'])
+    op.create_index('ix_bar_citta', 'bar', ['citta'])
+
+    op.create_table('user',
+    *_mirror_columns(),
+    sa.Column('email', sa.String(length=200), nullable=True),
+    sa.Column('peso', sa.Float(), nullable=True),
+    sa.Column('genere', sa.String(length=20), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_user_created_time', 'user', ['created_time'])
+    op.create_index('ix_user_email', 'user', ['email'])
+
+    op.create_table('drink',
+    *_mirror_columns(),
+    sa.Column('nome', sa.String(length=200), nullable=True),
+    sa.Column('gradazione', sa.Float(), nullable=True),
+    sa.Column('alcolico', sa.Boolean(), nullable=True),
+    sa.Column('speciale', sa.Boolean(), nullable=True),
+    sa.Column('ingredienti', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_drink_created_time', 'drink', ['created_time'])
+
+    op.create_table('drink_bar',
+    sa.Column('drink_id', sa.String(length=32), nullable=False),
+    sa.Column('bar_id', sa.String(length=32), nullable=False),
+    sa.ForeignKeyConstraint(['drink_id'], ['drink.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('drink_id', 'bar_id')
+    )
+    op.create_index('ix_drink_bar_bar_id', 'drink_bar', ['bar_id'])
+
+    op.create_table('consumazione',
+    *_mirror_columns(),
+    sa.Column('user_id', sa.String(length=32), nullable=True),
+    sa.Column('drink_id', sa.String(length=32), nullable=True),
+    sa.Column('bar_id', sa.String(length=32), nullable=True),
+    sa.Column('peso', sa.Float(), nullable=True),
+    sa.Column('tasso', sa.Float(), nullable=True),
+    sa.Column('stomaco', sa.String(length=20), nullable=True),
+    sa.Column('risultato', sa.String(length=20), nullable=True),
+    sa.Column('completato', sa.String(length=30), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_consumazione_created_time', 'consumazione', ['created_time'])
+    op.create_index('ix_consumazione_user_id', 'consumazione', ['user_id'])
+    op.create_index('ix_consumazione_drink_id', 'consumazione', ['drink_id'])
+    op.create_index('ix_consumazione_bar_id', 'consumazione', ['bar_id'])
+    op.create_index('ix_consumazione_user_created', 'consumazione', ['user_id', 'created_time'])
+    op.create_index('ix_consumazione_bar_created', 'consumazione', ['bar_id', 'created_time'])
+
+    op.create_table('sorso',
+    *_mirror_columns(),
+    sa.Column('consumazione_id', sa.String(length=32), nullable=True),
+    sa.Column('email', sa.String(length=200), nullable=True),
+    sa.Column('volume', sa.Float(), nullable=True),
+    sa.Column('bac', sa.Float(), nullable=True),
+    sa.Column('ora_inizio', sa.DateTime(), nullable=True),
+    sa.Column('ora_fine', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_sorso_created_time', 'sorso', ['created_time'])
+    op.create_index('ix_sorso_consumazione_id', 'sorso', ['consumazione_id'])
+    op.create_index('ix_sorso_ora_inizio', 'sorso', ['ora_inizio'])
+    op.create_index('ix_sorso_consumazione_inizio', 'sorso', ['consumazione_id', 'ora_inizio'])
+    op.create_index('ix_sorso_email_inizio', 'sorso', ['email', 'ora_inizio'])
+
+    op.create_table('game_data',
+    *_mirror_columns(),
+    sa.Column('user_id', sa.String(length=32), nullable=True),
+    sa.Column('level', sa.Integer(), nullable=True),
+    sa.Column('points', sa.Integer(), nullable=True),
+    sa.Column('last_updated', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_game_data_created_time', 'game_data', ['created_time'])
+    op.create_index('ix_game_data_user_id', 'game_data', ['user_id'])
+    op.create_index('ix_game_data_points', 'game_data', ['points'])
+    op.create_index('ix_game_data_user_updated', 'game_data', ['user_id', 'last_updated'])
+
+
+def downgrade():
+    op.drop_table('game_data')
+    op.drop_table('sorso')
+    op.drop_table('consumazione')
+    op.drop_table('drink_bar')
+    op.drop_table('drink')
+    op.drop_table('user')
+    op.drop_table('bar')
+
+    op.create_table('bar',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('nome', sa.String(length=100), nullable=False),
+    sa.Column('indirizzo', sa.String(length=200), nullable=False),
+    sa.Column('tipo', sa.String(length=50), nullable=False),
+    sa.Column('citta', sa.String(length=100), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('user',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.String(length=120), nullable=False),
+    sa.Column('password_hash', sa.String(length=300), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_table('drink',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('nome', sa.String(length=100), nullable=False),
+    sa.Column('ingredienti', sa.Text(), nullable=False),
+    sa.Column('bar_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['bar_id'], ['bar.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('consumazione',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('drink_id', sa.Integer(), nullable=False),
+    sa.Column('data', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['drink_id'], ['drink.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
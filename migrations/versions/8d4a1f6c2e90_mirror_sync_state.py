@@ -0,0 +1,32 @@
+"""Mirror sync state
+
+Revision ID: 8d4a1f6c2e90
+Revises: 5b2c8e41d7a3
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4a1f6c2e90'
+down_revision = '5b2c8e41d7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sync_state',
+    sa.Column('table', sa.String(length=64), nullable=False),
+    sa.Column('watermark', sa.DateTime(), nullable=True),
+    sa.Column('reconciled_at', sa.DateTime(), nullable=True),
+    sa.Column('synced_at', sa.DateTime(), nullable=True),
+    sa.Column('last_upserted', sa.Integer(), nullable=True),
+    sa.Column('last_deleted', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('table')
+    )
+
+
+def downgrade():
+    op.drop_table('sync_state')
@@ -0,0 +1,359 @@
+"""Copia locale in SQL delle tabelle Airtable e query di lettura per le viste.
+
+Il mirror viene riempito da ``refresh_all`` (comando ``flask mirror-refresh``),
+aggiornato in modo incrementale da ``sync_all`` (comando ``flask mirror-sync``)
+e tenuto allineato con le scritture fatte dall'app (``upsert_records``). Le
+viste pesanti (world, statistica, drink_master, game, sorsi giornalieri)
+leggono da qui con query aggregate invece di scaricare tabelle da Airtable.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import case, func
+
+import airtable_query as aq
+from models import (
+    TABLE_MODELS, Bar, Consumazione, Drink, GameData, Sorso, SyncState, User, db, drink_bar
+)
+
+logger = logging.getLogger(__name__)
+
+# Limite legale del tasso alcolemico (g/L) usato nelle statistiche
+LEGAL_LIMIT = 0.5
+
+# Margine sottratto al watermark: copre la differenza tra l'orologio locale e
+# quello di Airtable e le scritture concorrenti alla lettura (gli upsert sono idempotenti)
+WATERMARK_OVERLAP = timedelta(minutes=2)
+
+# Ogni quanto confrontare gli ID locali con quelli di Airtable: l'API non
+# espone i record eliminati, quindi vanno rilevati per differenza
+RECONCILE_INTERVAL = timedelta(hours=6)
+
+# Campo leggero richiesto quando si scaricano solo gli ID di una tabella
+KEY_FIELDS = {
+    'Bar': 'Name',
+    'Users': 'Email',
+    'Drinks': 'Name',
+    'Consumazioni': 'User',
+    'Sorsi': 'Consumazioni Id',
+    'GameData': 'User',
+}
+
+
+# === Scrittura ===
+
+def upsert_records(table, records, commit=True):
+    """Inserisce o aggiorna nel mirror i record Airtable di una tabella"""
+    model = TABLE_MODELS.get(table)
+    if model is None:
+        return 0
+
+    count = 0
+    for record in records:
+        if not record or 'id' not in record:
+            continue
+        row = db.session.get(model, record['id']) or model()
+        row.load_record(record)
+        db.session.add(row)
+        if model is Drink:
+            _replace_drink_bars(record['id'], record.get('fields', {}).get('Bar', []))
+        count += 1
+
+    if commit:
+        db.session.commit()
+    return count
+
+
+def delete_records(table, record_ids, commit=True):
+    """Elimina dal mirror i record indicati"""
+    model = TABLE_MODELS.get(table)
+    record_ids = list(record_ids)
+    if model is None or not record_ids:
+        return 0
+    if model is Drink:
+        db.session.execute(drink_bar.delete().where(drink_bar.c.drink_id.in_(record_ids)))
+    deleted = model.query.filter(model.id.in_(record_ids)).delete(synchronize_session=False)
+    if commit:
+        db.session.commit()
+    return deleted
+
+
+def _replace_drink_bars(drink_id, bar_ids):
+    db.session.execute(drink_bar.delete().where(drink_bar.c.drink_id == drink_id))
+    for bar_id in dict.fromkeys(bar_ids):
+        db.session.execute(drink_bar.insert().values(drink_id=drink_id, bar_id=bar_id))
+
+
+def _delete_missing(table, live_ids):
+    """Elimina dal mirror i record che non sono più tra ``live_ids``"""
+    model = TABLE_MODELS[table]
+    stale_ids = [row_id for (row_id,) in db.session.query(model.id) if row_id not in live_ids]
+    return delete_records(table, stale_ids, commit=False)
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _save_state(table, started, upserted, deleted, reconciled):
+    state = db.session.get(SyncState, table) or SyncState(table=table)
+    state.watermark = started - WATERMARK_OVERLAP
+    state.synced_at = started
+    state.last_upserted = upserted
+    state.last_deleted = deleted
+    if reconciled:
+        state.reconciled_at = started
+    db.session.add(state)
+
+
+def refresh_table(client, table):
+    """Ricarica un'intera tabella da Airtable, eliminando i record non più presenti"""
+    started = _utcnow()
+    records = client.get_all(table)
+    deleted = _delete_missing(table, {record['id'] for record in records})
+    upsert_records(table, records, commit=False)
+    _save_state(table, started, len(records), deleted, reconciled=True)
+    db.session.commit()
+    logger.info("[MIRROR] %s: %d record, %d eliminati", table, len(records), deleted)
+    return len(records)
+
+
+def refresh_all(client):
+    """Ricarica tutte le tabelle del mirror"""
+    return {table: refresh_table(client, table) for table in TABLE_MODELS}
+
+
+# === Sincronizzazione incrementale ===
+
+def sync_table(client, table, reconcile=None):
+    """
+    Porta il mirror di una tabella allo stato di Airtable scaricando solo i
+    record modificati dall'ultimo watermark (LAST_MODIFIED_TIME()).
+
+    Alla prima esecuzione, senza watermark, la tabella viene ricaricata per
+    intero. Le eliminazioni si rilevano confrontando solo gli ID con quelli
+    locali, al massimo una volta ogni RECONCILE_INTERVAL.
+
+    Args:
+        client: AirtableClient
+        table: Nome della tabella Airtable
+        reconcile: True/False per forzare o saltare il controllo delle
+            eliminazioni; None per eseguirlo solo quando è scaduto l'intervallo
+
+    Returns:
+        Dizionario con 'mode' ('full' o 'incremental'), 'upserted' e 'deleted'
+    """
+    state = db.session.get(SyncState, table)
+    if state is None or state.watermark is None:
+        upserted = refresh_table(client, table)
+        state = db.session.get(SyncState, table)
+        return {'mode': 'full', 'upserted': upserted, 'deleted': state.last_deleted}
+
+    started = _utcnow()
+    params = aq.build_params(formula=aq.modified_since(state.watermark))
+    upserted = 0
+    for page in client.iter_pages(table, params=params):
+        upserted += upsert_records(table, page, commit=False)
+
+    if reconcile is None:
+        reconcile = state.reconciled_at is None or started - state.reconciled_at >= RECONCILE_INTERVAL
+    deleted = 0
+    if reconcile:
+        id_params = {'fields[]': [KEY_FIELDS[table]]}
+        deleted = _delete_missing(table, {record['id'] for record in client.iter_records(table, params=id_params)})
+
+    _save_state(table, started, upserted, deleted, reconciled=reconcile)
+    db.session.commit()
+    logger.info("[MIRROR] sync %s: %d aggiornati, %d eliminati", table, upserted, deleted)
+    return {'mode': 'incremental', 'upserted': upserted, 'deleted': deleted}
+
+
+def sync_all(client, reconcile=None):
+    """Sincronizza tutte le tabelle del mirror: {tabella: risultato di sync_table}"""
+    return {table: sync_table(client, table, reconcile=reconcile) for table in TABLE_MODELS}
+
+
+# === Lettura ===
+
+def _records(rows):
+    return [row.to_record() for row in rows]
+
+
+def get_record(table, record_id):
+    row = db.session.get(TABLE_MODELS[table], record_id)
+    return row.to_record() if row else None
+
+
+def get_user_consumazioni(user_id=None, bar_id=None):
+    """Consumazioni filtrate per utente e/o bar, in ordine di creazione"""
+    query = Consumazione.query
+    if user_id:
+        query = query.filter(Consumazione.user_id == user_id)
+    if bar_id:
+        query = query.filter(Consumazione.bar_id == bar_id)
+    return _records(query.order_by(Consumazione.created_time))
+
+
+def get_sorsi_by_consumazione(consumazione_id):
+    rows = Sorso.query.filter(Sorso.consumazione_id == consumazione_id).order_by(Sorso.ora_inizio)
+    return _records(rows)
+
+
+def get_sorsi_by_consumazioni(consumazione_ids):
+    """Sorsi di più consumazioni con una sola query: {consumazione_id: [record, ...]}"""
+    result = defaultdict(list)
+    consumazione_ids = list(consumazione_ids)
+    if not consumazione_ids:
+        return result
+    rows = (Sorso.query.filter(Sorso.consumazione_id.in_(consumazione_ids))
+            .order_by(Sorso.ora_inizio))
+    for row in rows:
+        result[row.consumazione_id].append(row.to_record())
+    return result
+
+
+def get_sorsi_giornalieri(email, start_utc, end_utc):
+    """Sorsi di un utente con 'Ora inizio' in [start_utc, end_utc), in ordine cronologico"""
+    rows = (Sorso.query
+            .filter(Sorso.email == email, Sorso.ora_inizio >= start_utc, Sorso.ora_inizio < end_utc)
+            .order_by(Sorso.ora_inizio))
+    return _records(rows)
+
+
+def _top(query, limit):
+    return [{'nome': nome or 'N/D', 'conteggio': conteggio} for nome, conteggio in query.limit(limit)]
+
+
+def world_stats(user_id):
+    """Statistiche globali e personali della pagina World, calcolate con aggregati SQL"""
+    count = func.count(Consumazione.id)
+
+    classifica = _top(
+        db.session.query(func.coalesce(User.email, Consumazione.user_id), count)
+        .outerjoin(User, User.id == Consumazione.user_id)
+        .filter(Consumazione.user_id.isnot(None))
+        .group_by(Consumazione.user_id, User.email)
+        .order_by(count.desc()), 20)
+
+    drink_popolari = _top(
+        db.session.query(Drink.nome, count)
+        .outerjoin(Drink, Drink.id == Consumazione.drink_id)
+        .filter(Consumazione.drink_id.isnot(None))
+        .group_by(Drink.nome)
+        .order_by(count.desc()), 10)
+
+    bar_popolari = _top(
+        db.session.query(Bar.nome, count)
+        .outerjoin(Bar, Bar.id == Consumazione.bar_id)
+        .filter(Consumazione.bar_id.isnot(None))
+        .group_by(Bar.nome)
+        .order_by(count.desc()), 10)
+
+    stats = {
+        'classifica': classifica,
+        'drink_popolari': drink_popolari,
+        'bar_popolari': bar_popolari,
+        'totale_consumazioni': Consumazione.query.count(),
+        'totale_sorsi': Sorso.query.count(),
+        'num_bar': Bar.query.count(),
+        'num_consumazioni_utente': Consumazione.query.filter(Consumazione.user_id == user_id).count(),
+        'tasso_medio_utente': 0.0,
+        'perc_esiti_positivi_utente': 0,
+        'drink_preferito_utente': 'N/D',
+    }
+
+    media, totale, oltre_limite = (
+        db.session.query(
+            func.avg(Sorso.bac),
+            func.count(Sorso.bac),
+            func.sum(case((Sorso.bac > LEGAL_LIMIT, 1), else_=0)))
+        .join(Consumazione, Consumazione.id == Sorso.consumazione_id)
+        .filter(Consumazione.user_id == user_id, Sorso.bac.isnot(None))
+        .one())
+    if totale:
+        stats['tasso_medio_utente'] = float(media or 0.0)
+        stats['perc_esiti_positivi_utente'] = (oltre_limite or 0) / totale * 100
+
+    preferito = (
+        db.session.query(Drink.nome, count)
+        .outerjoin(Drink, Drink.id == Consumazione.drink_id)
+        .filter(Consumazione.user_id == user_id, Consumazione.drink_id.isnot(None))
+        .group_by(Drink.nome)
+        .order_by(count.desc())
+        .first())
+    if preferito:
+        stats['drink_preferito_utente'] = preferito[0] or 'N/D'
+
+    return stats
+
+
+def bar_stats(bar_id, bac_ranges):
+    """
+    Statistiche di un bar per la pagina Statistica.
+
+    Returns:
+        Dizionario con i totali, le statistiche per drink e il conteggio dei
+        sorsi per ciascuna fascia di BAC in ``bac_ranges``
+    """
+    cons_per_drink = dict(
+        db.session.query(Drink.nome, func.count(Consumazione.id))
+        .join(Drink, Drink.id == Consumazione.drink_id)
+        .filter(Consumazione.bar_id == bar_id)
+        .group_by(Drink.nome))
+
+    # I sorsi senza BAC contano come 0, come nel calcolo fatto sui record Airtable
+    bac = func.coalesce(Sorso.bac, 0.0)
+    sorsi_rows = (
+        db.session.query(
+            Drink.nome,
+            func.count(Sorso.id),
+            func.avg(bac),
+            func.sum(case((bac > LEGAL_LIMIT, 1), else_=0)))
+        .join(Consumazione, Consumazione.id == Sorso.consumazione_id)
+        .join(Drink, Drink.id == Consumazione.drink_id)
+        .filter(Consumazione.bar_id == bar_id)
+        .group_by(Drink.nome))
+
+    drink_stats = {
+        nome: {'consumazioni': n, 'sorsi': 0, 'tasso_medio': 0.0, 'positivi': 0}
+        for nome, n in cons_per_drink.items()
+    }
+    for nome, sorsi, media, positivi in sorsi_rows:
+        stats = drink_stats.setdefault(nome, {'consumazioni': 0, 'sorsi': 0, 'tasso_medio': 0.0, 'positivi': 0})
+        stats.update({'sorsi': sorsi, 'tasso_medio': float(media or 0.0), 'positivi': positivi or 0})
+
+    buckets = [
+        func.sum(case(((bac >= low) & (bac < high), 1), else_=0)) if high != float('inf')
+        else func.sum(case((bac >= low, 1), else_=0))
+        for low, high in bac_ranges
+    ]
+    overall = (
+        db.session.query(func.count(Sorso.id), func.avg(bac), *buckets)
+        .join(Consumazione, Consumazione.id == Sorso.consumazione_id)
+        .join(Drink, Drink.id == Consumazione.drink_id)
+        .filter(Consumazione.bar_id == bar_id)
+        .one())
+
+    return {
+        'totale_consumazioni': Consumazione.query.filter(Consumazione.bar_id == bar_id).count(),
+        'totale_sorsi': overall[0] or 0,
+        'tasso_medio': float(overall[1] or 0.0),
+        'bac_data': [int(n or 0) for n in overall[2:]],
+        'drink_stats': drink_stats,
+    }
+
+
+def leaderboard(limit=10):
+    """Classifica del gioco: [(record GameData, record utente)] con l'ultima riga di ogni utente, ordinata per punti"""
+    latest = (db.session.query(GameData.user_id, func.max(GameData.last_updated).label('last_updated'))
+              .filter(GameData.user_id.isnot(None), GameData.last_updated.isnot(None))
+              .group_by(GameData.user_id)
+              .subquery())
+    rows = (db.session.query(GameData, User)
+            .join(latest, (GameData.user_id == latest.c.user_id) & (GameData.last_updated == latest.c.last_updated))
+            .join(User, User.id == GameData.user_id)
+            .order_by(GameData.points.desc())
+            .limit(limit))
+    return [(game_data.to_record(), user.to_record()) for game_data, user in rows]
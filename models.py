@@ -0,0 +1,214 @@
+"""Modelli SQLAlchemy della copia locale (mirror) delle tabelle Airtable.
+
+Ogni riga è identificata dall'ID del record Airtable ('recXXXX'). Oltre alle
+colonne tipizzate e indicizzate usate dalle query aggregate, ogni modello
+conserva i campi originali in ``fields_json``, così ``to_record()`` restituisce
+lo stesso formato {'id', 'createdTime', 'fields'} che le viste già usano.
+"""
+
+import json
+from datetime import datetime, timezone
+
+from flask_sqlalchemy import SQLAlchemy
+
+db = SQLAlchemy()
+
+# Campi che non vanno copiati in locale
+EXCLUDED_FIELDS = {'Password'}
+
+
+def parse_timestamp(value):
+    """Converte un timestamp ISO di Airtable in datetime UTC senza fuso (None se assente o non valido)"""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def first_link(fields, name):
+    """Primo ID di un campo collegato (lista di ID), oppure None"""
+    values = fields.get(name) or []
+    return values[0] if values else None
+
+
+def to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+drink_bar = db.Table(
+    'drink_bar',
+    db.Column('drink_id', db.String(32), db.ForeignKey('drink.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('bar_id', db.String(32), primary_key=True, index=True)
+)
+
+
+class MirrorRecord:
+    """Comportamento comune: conversione da/verso il formato dei record Airtable"""
+
+    id = db.Column(db.String(32), primary_key=True)
+    created_time = db.Column(db.DateTime, index=True)
+    fields_json = db.Column(db.Text, nullable=False, default='{}')
+
+    def load_record(self, record):
+        fields = {k: v for k, v in record.get('fields', {}).items() if k not in EXCLUDED_FIELDS}
+        self.id = record['id']
+        self.created_time = parse_timestamp(record.get('createdTime'))
+        self.fields_json = json.dumps(fields)
+        self.load_fields(fields)
+
+    def load_fields(self, fields):
+        raise NotImplementedError
+
+    def to_record(self):
+        record = {'id': self.id, 'fields': json.loads(self.fields_json or '{}')}
+        if self.created_time:
+            record['createdTime'] = self.created_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return record
+
+
+class Bar(MirrorRecord, db.Model):
+    __tablename__ = 'bar'
+
+    nome = db.Column(db.String(200))
+    indirizzo = db.Column(db.String(300))
+    citta = db.Column(db.String(100), index=True)
+
+    def load_fields(self, fields):
+        self.nome = fields.get('Name')
+        self.indirizzo = fields.get('Indirizzo')
+        self.citta = fields.get('Città')
+
+
+class User(MirrorRecord, db.Model):
+    __tablename__ = 'user'
+
+    email = db.Column(db.String(200), index=True)
+    peso = db.Column(db.Float)
+    genere = db.Column(db.String(20))
+
+    def load_fields(self, fields):
+        self.email = fields.get('Email')
+        self.peso = to_float(fields.get('Peso'))
+        self.genere = fields.get('Genere')
+
+
+class Drink(MirrorRecord, db.Model):
+    __tablename__ = 'drink'
+
+    nome = db.Column(db.String(200))
+    gradazione = db.Column(db.Float)
+    alcolico = db.Column(db.Boolean)
+    speciale = db.Column(db.Boolean)
+    ingredienti = db.Column(db.Text)
+
+    def load_fields(self, fields):
+        self.nome = fields.get('Name')
+        self.gradazione = to_float(fields.get('Gradazione'))
+        self.alcolico = fields.get('Alcolico (bool)') == '1'
+        self.speciale = fields.get('Speciale (bool)') == '1'
+        self.ingredienti = fields.get('Ingredienti')
+
+    @property
+    def bar_ids(self):
+        return json.loads(self.fields_json or '{}').get('Bar', [])
+
+
+class Consumazione(MirrorRecord, db.Model):
+    __tablename__ = 'consumazione'
+    __table_args__ = (
+        db.Index('ix_consumazione_user_created', 'user_id', 'created_time'),
+        db.Index('ix_consumazione_bar_created', 'bar_id', 'created_time'),
+    )
+
+    user_id = db.Column(db.String(32), index=True)
+    drink_id = db.Column(db.String(32), index=True)
+    bar_id = db.Column(db.String(32), index=True)
+    peso = db.Column(db.Float)
+    tasso = db.Column(db.Float)
+    stomaco = db.Column(db.String(20))
+    risultato = db.Column(db.String(20))
+    completato = db.Column(db.String(30))
+
+    def load_fields(self, fields):
+        self.user_id = first_link(fields, 'User')
+        self.drink_id = first_link(fields, 'Drink')
+        self.bar_id = first_link(fields, 'Bar')
+        self.peso = to_float(fields.get('Peso (g)'))
+        self.tasso = to_float(fields.get('Tasso Calcolato (g/L)'))
+        self.stomaco = fields.get('Stomaco')
+        self.risultato = fields.get('Risultato')
+        self.completato = fields.get('Completato')
+
+
+class Sorso(MirrorRecord, db.Model):
+    __tablename__ = 'sorso'
+    __table_args__ = (
+        db.Index('ix_sorso_consumazione_inizio', 'consumazione_id', 'ora_inizio'),
+        db.Index('ix_sorso_email_inizio', 'email', 'ora_inizio'),
+    )
+
+    consumazione_id = db.Column(db.String(32), index=True)
+    email = db.Column(db.String(200))
+    volume = db.Column(db.Float)
+    bac = db.Column(db.Float)
+    ora_inizio = db.Column(db.DateTime, index=True)
+    ora_fine = db.Column(db.DateTime)
+
+    def load_fields(self, fields):
+        self.consumazione_id = first_link(fields, 'Consumazioni Id')
+        self.email = fields.get('Email')
+        self.volume = to_float(fields.get('Volume (g)'))
+        self.bac = to_float(fields.get('BAC Temporaneo'))
+        self.ora_inizio = parse_timestamp(fields.get('Ora inizio'))
+        self.ora_fine = parse_timestamp(fields.get('Ora fine'))
+
+
+class GameData(MirrorRecord, db.Model):
+    __tablename__ = 'game_data'
+    __table_args__ = (
+        db.Index('ix_game_data_user_updated', 'user_id', 'last_updated'),
+    )
+
+    user_id = db.Column(db.String(32), index=True)
+    level = db.Column(db.Integer)
+    points = db.Column(db.Integer, index=True)
+    last_updated = db.Column(db.DateTime)
+
+    def load_fields(self, fields):
+        self.user_id = first_link(fields, 'User')
+        self.level = fields.get('Level')
+        self.points = fields.get('Points')
+        self.last_updated = parse_timestamp(fields.get('Last Updated'))
+
+
+class SyncState(db.Model):
+    """Stato della sincronizzazione incrementale di una tabella Airtable"""
+    __tablename__ = 'sync_state'
+
+    table = db.Column(db.String(64), primary_key=True)
+    # Vengono riletti i record modificati dopo questo istante (UTC)
+    watermark = db.Column(db.DateTime)
+    # Ultimo confronto completo degli ID per rilevare i record eliminati
+    reconciled_at = db.Column(db.DateTime)
+    synced_at = db.Column(db.DateTime)
+    last_upserted = db.Column(db.Integer, default=0)
+    last_deleted = db.Column(db.Integer, default=0)
+
+
+# Tabella Airtable -> modello locale
+TABLE_MODELS = {
+    'Bar': Bar,
+    'Users': User,
+    'Drinks': Drink,
+    'Consumazioni': Consumazione,
+    'Sorsi': Sorso,
+    'GameData': GameData,
+}
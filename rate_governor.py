@@ -0,0 +1,209 @@
+"""Limite di richieste verso Airtable condiviso tra i processi (worker gunicorn).
+
+Airtable accetta circa 5 richieste al secondo per base. Il limite è un token
+bucket il cui stato (token disponibili e ultimo aggiornamento) sta in un
+piccolo file binario bloccato con flock, così tutti i worker della macchina
+attingono allo stesso budget.
+
+Ogni chiamata appartiene a una corsia di priorità, letta da un ContextVar
+impostato con ``priority()``. Le corsie meno importanti possono prendere un
+token solo se nel bucket ne resta una riserva: le pagine di analisi non
+possono svuotarlo e chi registra un sorso trova quasi sempre un token subito.
+La velocità media non cambia, cambia solo chi passa per primo.
+"""
+
+import contextvars
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Corsie, dalla più importante: scritture dei sorsi e consumazione attiva,
+# dati di riferimento (bar, drink, utenti), pagine di analisi e sincronizzazioni
+CRITICAL = 'critical'
+REFERENCE = 'reference'
+ANALYTICS = 'analytics'
+LANES = (CRITICAL, REFERENCE, ANALYTICS)
+
+# Token che ogni corsia deve lasciare nel bucket
+DEFAULT_RESERVES = {CRITICAL: 0, REFERENCE: 1, ANALYTICS: 2}
+
+# Stato condiviso: token disponibili e istante dell'ultimo aggiornamento
+_STATE = struct.Struct('<dd')
+
+# Attesa massima tra due controlli del bucket (il token può liberarsi prima
+# della stima se un altro processo non lo usa)
+MAX_POLL = 0.05
+
+# Tolleranza sugli arrotondamenti della ricarica: senza, un bucket a
+# 0.9999999999 token farebbe attese di pochi femtosecondi a vuoto
+EPSILON = 1e-9
+
+_lane = contextvars.ContextVar('airtable_lane', default=REFERENCE)
+
+
+def current_lane():
+    return _lane.get()
+
+
+@contextmanager
+def priority(lane):
+    """Esegue il blocco con le chiamate ad Airtable nella corsia ``lane``"""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def set_lane(lane):
+    """Imposta la corsia del contesto corrente; restituisce il token per ``reset_lane``"""
+    return _lane.set(lane)
+
+
+def reset_lane(token):
+    _lane.reset(token)
+
+
+class RateGovernor:
+    """Token bucket condiviso tra processi tramite un file bloccato con flock"""
+
+    def __init__(self, path, rate=5.0, burst=5, reserves=None, max_wait=30.0):
+        """
+        Args:
+            path: File dello stato condiviso (meglio su tmpfs, es. /dev/shm)
+            rate: Token aggiunti al secondo, cioè le richieste al secondo consentite
+            burst: Token massimi accumulabili
+            reserves: Token che ogni corsia deve lasciare nel bucket
+            max_wait: Dopo quanti secondi di attesa una chiamata parte comunque
+                (se ne occupa poi il retry sui 429)
+        """
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.reserves = dict(DEFAULT_RESERVES, **(reserves or {}))
+        self.max_wait = max_wait
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = None
+        self._pid = None
+        # flock è per file aperto, non per thread: tra i thread del processo serve anche un lock
+        self._lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {lane: {'acquired': 0, 'waited': 0, 'overruns': 0, 'waiting': 0,
+                              'total_wait': 0.0, 'max_wait': 0.0} for lane in LANES}
+
+    def _open(self):
+        # Un descrittore ereditato con fork condividerebbe il lock con il
+        # processo padre: ogni processo apre il file per conto suo
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _read(self):
+        data = os.pread(self._fd, _STATE.size, 0)
+        if len(data) < _STATE.size:
+            return [float(self.burst), time.time()]
+        return list(_STATE.unpack(data))
+
+    def _write(self, state):
+        os.pwrite(self._fd, _STATE.pack(*state), 0)
+
+    @contextmanager
+    def _shared_state(self):
+        """Stato del bucket aggiornato al momento attuale, riscritto all'uscita"""
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                now = time.time()
+                elapsed = max(0.0, now - state[1])
+                state[0] = min(float(self.burst), state[0] + elapsed * self.rate)
+                state[1] = now
+                yield state
+                self._write(state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _try_take(self, lane):
+        """Prende un token se la corsia può; altrimenti restituisce i secondi da attendere"""
+        with self._shared_state() as state:
+            needed = self.reserves[lane] + 1
+            if state[0] >= needed - EPSILON:
+                state[0] = max(0.0, state[0] - 1)
+                return 0.0
+            return (needed - state[0]) / self.rate
+
+    def acquire(self, lane=None):
+        """
+        Attende un token per la corsia indicata (di default quella del contesto).
+
+        Returns:
+            I secondi passati in attesa
+        """
+        lane = lane or current_lane()
+        if lane not in self.reserves:
+            lane = REFERENCE
+        start = time.monotonic()
+        delay = self._try_take(lane)
+        if delay == 0.0:
+            self._record(lane, 0.0)
+            return 0.0
+
+        self._update_stat(lane, 'waiting', 1)
+        try:
+            while delay > 0.0:
+                waited = time.monotonic() - start
+                if waited >= self.max_wait:
+                    logger.warning("[RATE] Corsia %s: attesa oltre %.0fs, la chiamata parte comunque",
+                                   lane, self.max_wait)
+                    self._update_stat(lane, 'overruns', 1)
+                    break
+                time.sleep(min(delay, MAX_POLL, self.max_wait - waited))
+                delay = self._try_take(lane)
+        finally:
+            self._update_stat(lane, 'waiting', -1)
+        waited = time.monotonic() - start
+        self._record(lane, waited)
+        return waited
+
+    def _update_stat(self, lane, name, delta):
+        with self._stats_lock:
+            self._stats[lane][name] += delta
+
+    def _record(self, lane, waited):
+        with self._stats_lock:
+            stats = self._stats[lane]
+            stats['acquired'] += 1
+            if waited > 0:
+                stats['waited'] += 1
+                stats['total_wait'] += waited
+                stats['max_wait'] = max(stats['max_wait'], waited)
+
+    def get_stats(self):
+        """Token disponibili e contatori per corsia di questo processo (``waiting`` è la coda attuale)"""
+        with self._shared_state() as state:
+            tokens = state[0]
+        with self._stats_lock:
+            lanes = {}
+            for lane, stats in self._stats.items():
+                stats = dict(stats)
+                stats['reserve'] = self.reserves[lane]
+                stats['avg_wait'] = stats['total_wait'] / stats['waited'] if stats['waited'] else 0.0
+                lanes[lane] = stats
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': tokens,
+            'lanes': lanes
+        }
@@ -0,0 +1,105 @@
+"""Formato dei file di registrazione delle letture dei sottobicchieri.
+
+Una registrazione è un file binario in sola aggiunta: un'intestazione e poi un
+blocco per ogni lotto di letture, nell'ordine di arrivo:
+
+    arrivo (double) | letture (uint32) | lunghezza device_id (uint8) | device_id | letture ``<dd``
+
+Le letture sono nel formato binario di ``/arduino_batch``. Il modulo è separato
+da ``replay`` perché l'applicazione deve solo scrivere le registrazioni, senza
+caricare la riproduzione.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from devices import BINARY_SAMPLE_SIZE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SAFESIP-REC1\n'
+_FRAME = struct.Struct('<dIB')
+_SAMPLE_DTYPE = np.dtype([('timestamp', '<f8'), ('grams', '<f8')])
+
+Frame = namedtuple('Frame', 'received_at device_id timestamps grams')
+
+
+class RecordingError(Exception):
+    """File che non è una registrazione valida"""
+
+
+class Recorder:
+    """Aggiunge lotti di letture a una registrazione, anche da più processi"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Ogni processo apre il proprio descrittore: con O_APPEND ogni blocco
+        # finisce intero in fondo al file anche se scrivono più worker
+        if self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.write(self._fd, MAGIC)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return self._fd
+
+    def append(self, device_id, timestamps, grams, received_at=None):
+        """Registra un lotto di letture arrivato in ``received_at`` (adesso se manca)"""
+        samples = np.empty(len(timestamps), _SAMPLE_DTYPE)
+        samples['timestamp'] = timestamps
+        samples['grams'] = grams
+        key = device_id.encode('utf-8')
+        header = _FRAME.pack(received_at if received_at is not None else time.time(), len(samples), len(key))
+        with self._lock:
+            os.write(self._open(), header + key + samples.tobytes())
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+            self._pid = None
+
+
+def read_recording(path):
+    """
+    I lotti della registrazione in ordine di arrivo, come ``Frame`` con
+    istanti e grammi in array NumPy. Un blocco finale incompleto (registrazione
+    interrotta a metà scrittura) viene ignorato.
+
+    Raises:
+        RecordingError: se il file non è una registrazione
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RecordingError(f'{path} non è una registrazione di letture')
+        while True:
+            header = f.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                return
+            received_at, count, key_size = _FRAME.unpack(header)
+            key = f.read(key_size)
+            body = f.read(count * BINARY_SAMPLE_SIZE)
+            if len(key) < key_size or len(body) < count * BINARY_SAMPLE_SIZE:
+                logger.warning("[REPLAY] Ultimo blocco di %s incompleto, ignorato", path)
+                return
+            samples = np.frombuffer(body, _SAMPLE_DTYPE)
+            yield Frame(received_at, key.decode('utf-8'), samples['timestamp'], samples['grams'])
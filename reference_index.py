@@ -0,0 +1,63 @@
+"""Indici in memoria sulle tabelle di riferimento Bar e Drinks.
+
+Gli indici vengono costruiti una sola volta quando la tabella viene
+(ri)caricata da Airtable e poi messi in cache al posto della lista grezza,
+così le ricerche per ID, per città e per bar diventano accessi O(1) a un
+dizionario invece di scansioni lineari. I record restituiti sono condivisi:
+chi li usa non deve modificarli.
+"""
+
+from collections import defaultdict
+
+
+def normalize_city(city):
+    """Normalizza il nome di una città per il confronto (spazi e maiuscole ignorati)"""
+    return (city or '').strip().casefold()
+
+
+class BarIndex:
+    """Bar indicizzati per ID e per città"""
+
+    def __init__(self, bars):
+        self.bars = bars
+        self.by_id = {}
+        self.by_city = defaultdict(list)
+        city_names = {}
+
+        for bar in bars:
+            self.by_id[bar['id']] = bar
+            city = bar.get('fields', {}).get('Città')
+            if city:
+                key = normalize_city(city)
+                self.by_city[key].append(bar)
+                city_names.setdefault(key, city)
+
+        self.cities = sorted(city_names.values())
+
+    def get(self, bar_id):
+        return self.by_id.get(bar_id)
+
+    def in_city(self, city):
+        """Bar della città indicata (confronto senza distinzione di maiuscole)"""
+        return self.by_city.get(normalize_city(city), [])
+
+
+class DrinkIndex:
+    """Drink indicizzati per ID e per bar collegato"""
+
+    def __init__(self, drinks):
+        self.drinks = drinks
+        self.by_id = {}
+        self.by_bar = defaultdict(list)
+
+        for drink in drinks:
+            self.by_id[drink['id']] = drink
+            for bar_id in drink.get('fields', {}).get('Bar', []):
+                self.by_bar[bar_id].append(drink)
+
+    def get(self, drink_id):
+        return self.by_id.get(drink_id)
+
+    def for_bar(self, bar_id):
+        """Drink collegati al bar indicato"""
+        return self.by_bar.get(bar_id, [])
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Registrazione e riproduzione delle letture dei sottobicchieri.
+
+Le registrazioni (formato in ``recording``) contengono, per ogni lotto
+arrivato all'applicazione, l'istante di arrivo, il dispositivo e le letture.
+Se INGEST_RECORD indica un file l'applicazione registra le letture accettate da
+``ingest_readings``, in ordine di tempo e senza i doppioni dei lotti
+reinviati: le stesse che arrivano al riconoscimento dei sorsi. ``export`` crea
+una registrazione dallo storico (``weight_store``).
+
+La riproduzione rispetta i tempi di arrivo (``speed`` 1), li accelera
+(``speed`` 60: un'ora in un minuto) o va più veloce possibile (``speed`` 0). Le
+letture possono andare a un'applicazione in esecuzione (``/arduino_batch``) o
+a una pipeline locale (``SipReplay``) con lo stesso filtro e lo stesso
+riconoscimento dei sorsi del server, che calcola anche il BAC dopo ogni sorso.
+Il riconoscimento dipende solo dagli istanti delle letture e il filtro dà lo
+stesso risultato qualunque sia la dimensione dei lotti: la stessa
+registrazione dà sempre gli stessi eventi, a qualunque velocità. Per questo in
+modalità veloce i lotti di un dispositivo vengono uniti fino a
+MAX_BATCH_SAMPLES letture.
+
+Uso:
+    python replay.py export --history history --device bar-1 --start 2026-10-16T18:00 --end 2026-10-17T06:00 notte.rec
+    python replay.py info notte.rec
+    python replay.py run notte.rec --speed 0 --report notte.json
+    python replay.py run notte.rec --speed 0 --expect notte.json
+    python replay.py run notte.rec --speed 10 --target http://localhost:5000
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pytz
+
+from algoritmo import calcola_bac_cumulativo
+from devices import DEFAULT_BUFFER_SIZE, MAX_BATCH_SAMPLES, DeviceRegistry
+from log_setup import configure_logging
+from recording import Recorder, read_recording
+from signal_filter import SignalFilter
+from sip_detector import SIP, SipEngine
+
+logger = logging.getLogger(__name__)
+
+# Come l'applicazione: gli orari dei sorsi per il BAC sono in ora locale
+TIMEZONE = pytz.timezone('Europe/Rome')
+
+
+def export_history(store, device_ids, start, end, path, batch=MAX_BATCH_SAMPLES):
+    """
+    Crea una registrazione dallo storico dei dispositivi tra ``start`` e ``end``
+    (istanti Unix), in lotti di ``batch`` letture ordinati per arrivo.
+    L'istante di arrivo di un lotto è quello della sua ultima lettura.
+
+    Returns:
+        Il numero di letture esportate
+    """
+    frames = []
+    for device_id in device_ids:
+        timestamps, grams = store.load(device_id, start, end)
+        for first in range(0, len(timestamps), batch):
+            chunk = slice(first, first + batch)
+            frames.append((timestamps[chunk][-1], device_id, timestamps[chunk], grams[chunk]))
+    frames.sort(key=lambda frame: (frame[0], frame[1]))
+
+    if os.path.exists(path):
+        os.remove(path)
+    recorder = Recorder(path)
+    try:
+        for received_at, device_id, timestamps, grams in frames:
+            recorder.append(device_id, timestamps, grams, received_at=received_at)
+    finally:
+        recorder.close()
+    return sum(len(frame[2]) for frame in frames)
+
+
+def summarize(path):
+    """Dispositivi, letture e intervallo di tempo di una registrazione"""
+    devices = {}
+    frames = 0
+    first = last = None
+    for frame in read_recording(path):
+        frames += 1
+        devices[frame.device_id] = devices.get(frame.device_id, 0) + len(frame.timestamps)
+        first = frame.received_at if first is None else min(first, frame.received_at)
+        last = frame.received_at if last is None else max(last, frame.received_at)
+    return {'frames': frames, 'readings': sum(devices.values()), 'devices': devices,
+            'start': first, 'end': last, 'duration': (last - first) if frames else 0.0}
+
+
+def bac_after_sips(sips, peso, genere, gradazione, stomaco):
+    """
+    BAC dopo l'ultimo dei ``sips`` (eventi SIP della stessa consumazione),
+    calcolato come in ``registra_sorso``: ogni sorso è una bevanda con i suoi
+    orari (HH:MM, ora locale)
+    """
+    lista_bevande = [{
+        'volume': round(sip.grams, 1),
+        'gradazione': gradazione,
+        'ora_inizio': datetime.fromtimestamp(sip.started_at, TIMEZONE).strftime('%H:%M'),
+        'ora_fine': datetime.fromtimestamp(sip.ended_at, TIMEZONE).strftime('%H:%M')
+    } for sip in sips]
+    return round(calcola_bac_cumulativo(peso, genere, lista_bevande, stomaco)['bac_finale'], 3)
+
+
+class SipReplay:
+    """
+    Pipeline locale come quella del server: buffer del dispositivo, filtro del
+    rumore e riconoscimento dei sorsi, con ogni dispositivo collegato a una
+    consumazione fin dalla prima lettura. Si usa come sink di ``replay``.
+    """
+
+    def __init__(self, drinker=None, filter_factory=SignalFilter, buffer_size=DEFAULT_BUFFER_SIZE, **options):
+        """
+        Args:
+            drinker: Dati per il BAC (``peso``, ``genere``, ``gradazione``,
+                ``stomaco``); senza, il BAC non viene calcolato
+            filter_factory: Crea il filtro di ogni dispositivo (None lo disattiva)
+            buffer_size: Letture nel buffer di ogni dispositivo, come DEVICE_BUFFER_SIZE del server
+            options: Parametri di ``SipDetector``
+        """
+        self.drinker = drinker
+        self.registry = DeviceRegistry(buffer_size)
+        self.engine = SipEngine(self.registry, self._on_event, filter_factory=filter_factory, **options)
+        self.events = []
+        self._sips = {}
+
+    def send(self, device_id, timestamps, grams):
+        if self.registry.consumazione_for(device_id) is None:
+            self.registry.bind(device_id, device_id)
+            self.engine.start(device_id, device_id)
+        cursor = self.registry.record_batch(device_id, timestamps, grams)[1]
+        self.engine.process(device_id)
+        return cursor
+
+    def _on_event(self, device_id, consumazione_id, event):
+        record = {'device_id': device_id, 'kind': event.kind, 'started_at': round(event.started_at, 3),
+                  'ended_at': round(event.ended_at, 3), 'grams': round(event.grams, 1)}
+        if event.kind == SIP and self.drinker is not None:
+            sips = self._sips.setdefault(device_id, [])
+            sips.append(event)
+            record['bac'] = bac_after_sips(sips, **self.drinker)
+        self.events.append(record)
+
+    def report(self):
+        """
+        Eventi riconosciuti e totali per dispositivo, da salvare come JSON e
+        confrontare. Gli eventi sono raggruppati per dispositivo: l'ordine tra
+        dispositivi diversi dipende da come sono stati uniti i lotti.
+        """
+        events = sorted(self.events, key=lambda event: event['device_id'])
+        totals = {}
+        for event in events:
+            device = totals.setdefault(event['device_id'], {'sips': 0, 'grams': 0.0, 'refills': 0})
+            if event['kind'] == SIP:
+                device['sips'] += 1
+                device['grams'] = round(device['grams'] + event['grams'], 1)
+                if 'bac' in event:
+                    device['bac'] = event['bac']
+            elif event['kind'] == 'rabbocco':
+                device['refills'] += 1
+        return {'events': events, 'devices': totals}
+
+
+def _accept(latest, frame):
+    """Le letture del lotto che il server terrebbe: ordinate e più recenti di ``latest``"""
+    timestamps, grams = frame.timestamps, frame.grams
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, grams = timestamps[order], grams[order]
+    if latest is not None:
+        newer = timestamps > latest
+        timestamps, grams = timestamps[newer], grams[newer]
+    return timestamps, grams
+
+
+def replay(frames, sink, speed=1.0, rebase=False, clock=time.monotonic, sleep=time.sleep):
+    """
+    Riproduce i lotti in ``sink`` (un oggetto con ``send(device_id, istanti,
+    grammi)``, come ``SipReplay`` o ``listener.HttpSink``).
+
+    Args:
+        frames: Lotti in ordine di arrivo (vedi ``read_recording``)
+        speed: 1 in tempo reale, N volte più veloce, 0 più veloce possibile
+        rebase: Sposta tutti gli istanti in modo che la registrazione inizi
+            adesso, per un'applicazione in esecuzione che scarta le letture
+            più vecchie dell'ultima ricevuta
+
+    Returns:
+        Statistiche della riproduzione (lotti, letture, secondi)
+    """
+    started = clock()
+    stats = {'frames': 0, 'readings': 0, 'sent': 0}
+    latest = {}
+    pending = {}
+    pending_count = {}
+    first = None
+    shift = 0.0
+
+    def flush(device_id):
+        chunks = pending.pop(device_id, None)
+        pending_count.pop(device_id, None)
+        if chunks:
+            timestamps = np.concatenate([chunk[0] for chunk in chunks])
+            grams = np.concatenate([chunk[1] for chunk in chunks])
+            sink.send(device_id, timestamps + shift, grams)
+            stats['sent'] += len(timestamps)
+
+    for frame in frames:
+        if first is None:
+            first = frame.received_at
+            if rebase:
+                shift = time.time() - first
+        if speed:
+            delay = (frame.received_at - first) / speed - (clock() - started)
+            if delay > 0:
+                sleep(delay)
+        stats['frames'] += 1
+        stats['readings'] += len(frame.timestamps)
+
+        timestamps, grams = _accept(latest.get(frame.device_id), frame)
+        if not len(timestamps):
+            continue
+        latest[frame.device_id] = timestamps[-1]
+        if speed:
+            sink.send(frame.device_id, timestamps + shift, grams)
+            stats['sent'] += len(timestamps)
+            continue
+        # Più veloce possibile: i lotti di un dispositivo si uniscono, senza
+        # superare MAX_BATCH_SAMPLES (il limite di /arduino_batch)
+        if pending_count.get(frame.device_id, 0) + len(timestamps) > MAX_BATCH_SAMPLES:
+            flush(frame.device_id)
+        pending.setdefault(frame.device_id, []).append((timestamps, grams))
+        pending_count[frame.device_id] = pending_count.get(frame.device_id, 0) + len(timestamps)
+
+    for device_id in list(pending):
+        flush(device_id)
+    stats['seconds'] = round(clock() - started, 3)
+    return stats
+
+
+def compare_reports(expected, actual):
+    """Differenze tra due report di ``SipReplay`` (lista vuota se coincidono)"""
+    differences = []
+    expected_events, actual_events = expected['events'], actual['events']
+    for index, (old, new) in enumerate(zip(expected_events, actual_events)):
+        if old != new:
+            differences.append(f'evento {index}: atteso {old}, ottenuto {new}')
+    if len(expected_events) != len(actual_events):
+        differences.append(f'eventi: attesi {len(expected_events)}, ottenuti {len(actual_events)}')
+    return differences
+
+
+def _timestamp(value):
+    """Data ISO (UTC se senza fuso) o istante Unix"""
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+
+def _run(args):
+    frames = read_recording(args.recording)
+    if args.target:
+        from listener import HttpSink
+        sink = HttpSink(args.target)
+    else:
+        drinker = None
+        if args.peso:
+            drinker = {'peso': args.peso, 'genere': args.genere, 'gradazione': args.gradazione,
+                       'stomaco': args.stomaco}
+        filter_factory = None
+        if not args.no_filter:
+            def filter_factory():
+                return SignalFilter(median_window=args.median_window, ema_alpha=args.ema_alpha,
+                                    outlier_k=args.outlier_k)
+        sink = SipReplay(drinker, filter_factory=filter_factory, buffer_size=args.buffer_size,
+                         min_sip=args.min_sip)
+
+    stats = replay(frames, sink, speed=args.speed, rebase=args.rebase)
+    logger.info("[REPLAY] %s lotti, %s letture in %s s", stats['frames'], stats['readings'], stats['seconds'])
+    if args.target:
+        return 0
+
+    report = sink.report()
+    for device_id, totals in sorted(report['devices'].items()):
+        logger.info("[REPLAY] %s: %s", device_id, totals)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.expect:
+        with open(args.expect) as f:
+            differences = compare_reports(json.load(f), report)
+        for difference in differences[:20]:
+            logger.error("[REPLAY] %s", difference)
+        if differences:
+            logger.error("[REPLAY] %s differenze rispetto a %s", len(differences), args.expect)
+            return 1
+        logger.info("[REPLAY] Eventi identici a %s", args.expect)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Registrazione e riproduzione delle letture dei sottobicchieri')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='Crea una registrazione dallo storico delle letture')
+    export.add_argument('output')
+    export.add_argument('--history', default='history', help='Cartella dello storico (WEIGHT_HISTORY_DIR)')
+    export.add_argument('--device', action='append', help='Dispositivo da esportare (ripetibile, default tutti)')
+    export.add_argument('--start', type=_timestamp, required=True, help='Data ISO o istante Unix')
+    export.add_argument('--end', type=_timestamp, required=True, help='Data ISO o istante Unix')
+
+    info = commands.add_parser('info', help='Descrive una registrazione')
+    info.add_argument('recording')
+
+    run = commands.add_parser('run', help='Riproduce una registrazione')
+    run.add_argument('recording')
+    run.add_argument('--speed', type=float, default=0.0,
+                     help='1 tempo reale, N volte più veloce, 0 più veloce possibile (default)')
+    run.add_argument('--target', default=None,
+                     help='URL dell\'applicazione a cui inviare le letture; senza, pipeline locale')
+    run.add_argument('--rebase', action='store_true', help='Sposta gli istanti in modo da iniziare adesso')
+    run.add_argument('--report', default=None, help='Salva gli eventi riconosciuti in un file JSON')
+    run.add_argument('--expect', default=None, help='Confronta gli eventi con un report salvato')
+    run.add_argument('--min-sip', type=float, default=float(os.environ.get('SIP_MIN_GRAMS', '5')))
+    run.add_argument('--buffer-size', type=int, default=int(os.environ.get('DEVICE_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)))
+    run.add_argument('--no-filter', action='store_true', help='Disattiva il filtro del rumore')
+    run.add_argument('--median-window', type=int, default=int(os.environ.get('SIGNAL_MEDIAN_WINDOW', '5')))
+    run.add_argument('--ema-alpha', type=float, default=float(os.environ.get('SIGNAL_EMA_ALPHA', '0.5')))
+    run.add_argument('--outlier-k', type=float, default=float(os.environ.get('SIGNAL_OUTLIER_K', '3')))
+    run.add_argument('--peso', type=float, default=None, help='Peso in kg del bevitore, per il BAC')
+    run.add_argument('--genere', default='uomo', choices=('uomo', 'donna'))
+    run.add_argument('--gradazione', type=float, default=0.12, help='Gradazione del drink (es. 0.12)')
+    run.add_argument('--stomaco', default='vuoto', choices=('vuoto', 'pieno'))
+
+    args = parser.parse_args(argv)
+    if args.command == 'run' and not args.no_filter:
+        try:
+            SignalFilter(median_window=args.median_window, ema_alpha=args.ema_alpha, outlier_k=args.outlier_k)
+        except ValueError as e:
+            parser.error(str(e))
+    configure_logging()
+    if args.command == 'export':
+        from weight_store import WeightStore
+        store = WeightStore(args.history)
+        exported = export_history(store, args.device or store.devices(), args.start, args.end, args.output)
+        logger.info("[REPLAY] Esportate %s letture in %s", exported, args.output)
+        return 0
+    if args.command == 'info':
+        print(json.dumps(summarize(args.recording), indent=1))
+        return 0
+    return _run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""Ultima lettura di ogni dispositivo, condivisa tra i processi (worker gunicorn).
+
+Una tabella di slot a dimensione fissa in un file mappato in memoria (meglio
+su tmpfs, es. /dev/shm). Ogni dispositivo occupa uno slot, trovato con un
+hash dell'ID e scansione lineare, e lo tiene per sempre:
+
+    seq (uint64) | istante (double) | grammi (double) | letture (uint64) | device_id (64 byte)
+
+Chi scrive prende un flock sul file (serve solo per occupare uno slot nuovo e
+per non mescolare due scritture); chi legge non prende lock. Ogni slot ha un
+seqlock: chi scrive porta ``seq`` a un valore dispari, aggiorna i campi e lo
+riporta pari; chi legge rilegge se ``seq`` è dispari o è cambiato durante la
+lettura. Gli slot sono allineati a 8 byte, e su x86 le letture e scritture di
+8 byte allineati non si spezzano.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+_SLOT = struct.Struct('<Qddq64s')
+_SEQ = struct.Struct('<Q')
+
+# Tentativi di lettura prima di arrendersi a uno slot che cambia di continuo
+MAX_READ_RETRIES = 100
+
+
+class SlotTableFull(Exception):
+    """Non ci sono più slot liberi per un nuovo dispositivo"""
+
+
+class SharedSlots:
+    """Tabella condivisa {device_id: (istante, grammi)} leggibile senza lock"""
+
+    def __init__(self, path, slots=4096):
+        """
+        Args:
+            path: File della tabella, creato se non esiste
+            slots: Dispositivi che la tabella può contenere
+        """
+        self.path = path
+        self.slots = slots
+        size = slots * _SLOT.size
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            # La mappatura condivisa resta valida (e condivisa) anche dopo fork
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Slot già trovati in questo processo: un dispositivo non cambia mai slot
+        self._index = {}
+
+    def _key(self, device_id):
+        return device_id.encode('utf-8')[:64].ljust(64, b'\0')
+
+    def _find(self, key, claim=False):
+        """Slot del dispositivo; con ``claim`` occupa il primo libero (solo sotto flock)"""
+        start = zlib.crc32(key) % self.slots
+        for probe in range(self.slots):
+            slot = (start + probe) % self.slots
+            offset = slot * _SLOT.size + 32
+            stored = self._map[offset:offset + 64]
+            if stored == key:
+                return slot
+            if stored[0] == 0:
+                if not claim:
+                    return None
+                self._map[offset:offset + 64] = key
+                return slot
+        if claim:
+            raise SlotTableFull(f'Tabella dei dispositivi piena ({self.slots} slot)')
+        return None
+
+    def _slot(self, device_id, claim=False):
+        slot = self._index.get(device_id)
+        if slot is None:
+            slot = self._find(self._key(device_id), claim)
+            if slot is not None:
+                self._index[device_id] = slot
+        return slot
+
+    def _writer_fd(self):
+        # flock è per file aperto: un descrittore ereditato con fork
+        # condividerebbe il lock con il padre
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        return self._fd
+
+    def write(self, device_id, timestamp, grams, readings=1):
+        """
+        Aggiorna l'ultima lettura del dispositivo, se ``timestamp`` è più
+        recente di quella salvata.
+
+        Returns:
+            True se la lettura è stata scritta
+
+        Raises:
+            SlotTableFull: se il dispositivo è nuovo e non ci sono slot liberi
+        """
+        with self._lock:
+            fd = self._writer_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                slot = self._slot(device_id, claim=True)
+                offset = slot * _SLOT.size
+                seq, old_timestamp, _, old_readings, key = _SLOT.unpack_from(self._map, offset)
+                if old_timestamp >= timestamp and old_readings:
+                    return False
+                _SEQ.pack_into(self._map, offset, seq + 1)
+                _SLOT.pack_into(self._map, offset, seq + 1, timestamp, grams, old_readings + readings, key)
+                _SEQ.pack_into(self._map, offset, seq + 2)
+                return True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def read(self, device_id):
+        """Ultima lettura (istante, grammi) del dispositivo, None se non ce ne sono"""
+        slot = self._slot(device_id)
+        if slot is None:
+            return None
+        offset = slot * _SLOT.size
+        for _ in range(MAX_READ_RETRIES):
+            seq, timestamp, grams, readings, _ = _SLOT.unpack_from(self._map, offset)
+            if seq % 2 == 0 and _SEQ.unpack_from(self._map, offset)[0] == seq:
+                return (timestamp, grams) if readings else None
+        return None
+
+    def get_stats(self):
+        """Slot occupati e capacità della tabella"""
+        used = sum(1 for slot in range(self.slots) if self._map[slot * _SLOT.size + 32] != 0)
+        return {'slots': self.slots, 'used': used}
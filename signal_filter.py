@@ -0,0 +1,112 @@
+"""Filtraggio del rumore delle celle di carico, a blocchi con NumPy.
+
+Le letture di una bilancia tipo HX711 oscillano di qualche grammo e ogni tanto
+hanno picchi isolati (un urto, un errore di conversione). Prima di arrivare al
+riconoscimento dei sorsi ogni blocco di letture ricevuto passa da tre stadi,
+ciascuno calcolato su tutto il blocco con operazioni vettoriali:
+
+1. scarto dei valori anomali (filtro di Hampel): una lettura che si allontana
+   dalla mediana mobile più di ``outlier_k`` deviazioni (stimate con la MAD)
+   viene sostituita dalla mediana
+2. mediana mobile su ``median_window`` letture
+3. media mobile esponenziale con coefficiente ``ema_alpha``
+
+I filtri sono causali: ogni valore dipende solo dalle letture precedenti, che
+il filtro si porta dietro da un blocco all'altro. Filtrare un flusso a blocchi
+dà quindi lo stesso risultato che filtrarlo tutto insieme, e nessuna lettura
+resta in attesa della successiva. Un gradino vero (bicchiere sollevato o
+appoggiato) arriva in uscita dopo circa ``median_window`` letture.
+"""
+
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Fattore che rende la MAD una stima della deviazione standard (rumore gaussiano)
+MAD_SCALE = 1.4826
+
+
+def _windows(history, values, window):
+    """Per ogni valore di ``values`` la finestra delle ``window`` letture che finisce lì"""
+    padded = np.concatenate((history, values))
+    missing = window - 1 - len(history)
+    if missing > 0:
+        # All'inizio del flusso non c'è storia: si ripete il primo valore
+        padded = np.concatenate((np.full(missing, padded[0]), padded))
+    return sliding_window_view(padded, window)
+
+
+class SignalFilter:
+    """Stato dei filtri di un dispositivo tra un blocco di letture e il successivo"""
+
+    def __init__(self, median_window=5, ema_alpha=0.5, outlier_k=3.0, outlier_min=3.0):
+        """
+        Args:
+            median_window: Letture della mediana mobile (1 la disattiva)
+            ema_alpha: Peso della lettura nuova nella media esponenziale (1 la disattiva)
+            outlier_k: Deviazioni oltre cui una lettura è anomala (0 disattiva lo scarto)
+            outlier_min: Scarto minimo in grammi per considerare anomala una lettura,
+                così non si scartano oscillazioni minime quando la bilancia è ferma
+
+        Raises:
+            ValueError: Se ``median_window`` è minore di 1 o ``ema_alpha`` non è in (0, 1]
+        """
+        if int(median_window) < 1:
+            raise ValueError(f"median_window deve essere almeno 1 (ricevuto {median_window})")
+        if not 0 < ema_alpha <= 1:
+            raise ValueError(f"ema_alpha deve essere compreso tra 0 (escluso) e 1 (ricevuto {ema_alpha})")
+        self.median_window = int(median_window)
+        self.ema_alpha = ema_alpha
+        self.outlier_k = outlier_k
+        self.outlier_min = outlier_min
+        # Le ultime letture grezze e ripulite, per le finestre del blocco successivo
+        self._raw = np.empty(0)
+        self._clean = np.empty(0)
+        self._ema = None
+
+    def _reject_outliers(self, values):
+        if self.outlier_k <= 0 or self.median_window == 1:
+            return values
+        windows = _windows(self._raw, values, self.median_window)
+        median = np.median(windows, axis=1)
+        mad = np.median(np.abs(windows - median[:, None]), axis=1) * MAD_SCALE
+        outliers = np.abs(values - median) > np.maximum(self.outlier_k * mad, self.outlier_min)
+        return np.where(outliers, median, values)
+
+    def _smooth(self, values):
+        """Media esponenziale in forma chiusa, a blocchi per non far esplodere le potenze"""
+        alpha = self.ema_alpha
+        if alpha >= 1:
+            self._ema = values[-1]
+            return values
+        decay = 1.0 - alpha
+        block = max(1, int(600 / -math.log(decay)))
+        result = np.empty_like(values)
+        previous = values[0] if self._ema is None else self._ema
+        for start in range(0, len(values), block):
+            chunk = values[start:start + block]
+            powers = decay ** np.arange(1, len(chunk) + 1)
+            # y_n = decay^n * (y_0 + alpha * sum_{k<=n} x_k / decay^k)
+            result[start:start + len(chunk)] = powers * (previous + alpha * np.cumsum(chunk / powers))
+            previous = result[start + len(chunk) - 1]
+        self._ema = previous
+        return result
+
+    def apply(self, grams):
+        """
+        Filtra un blocco di letture, in ordine di tempo.
+
+        Returns:
+            Un ``numpy.ndarray`` con i valori filtrati, lungo quanto ``grams``
+        """
+        values = np.asarray(grams, dtype=np.float64)
+        if not len(values):
+            return values
+        keep = self.median_window - 1
+        clean = self._reject_outliers(values)
+        smoothed = np.median(_windows(self._clean, clean, self.median_window), axis=1) if keep else clean
+        if keep:
+            self._raw = np.concatenate((self._raw, values))[-keep:]
+            self._clean = np.concatenate((self._clean, clean))[-keep:]
+        return self._smooth(smoothed)
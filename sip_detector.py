@@ -0,0 +1,292 @@
+"""Riconoscimento di sorsi e rabbocchi dalle letture di un sottobicchiere.
+
+Un ``SipDetector`` per dispositivo legge le pesate in ordine di tempo e tiene
+lo stato del bicchiere:
+
+- appoggiato: il peso è rimasto fermo (entro ``tolerance``) per almeno
+  ``settle_time`` secondi, ed è questo peso stabile che conta
+- sollevato: il peso è sceso sotto ``present_threshold`` (con isteresi, così
+  il rumore attorno alla soglia non genera eventi a raffica)
+- rimosso: sollevato da più di ``removed_after`` secondi
+
+Quando il bicchiere torna stabile il nuovo peso si confronta con quello
+stabile precedente: un calo di almeno ``min_sip`` grammi è un sorso, un
+aumento è un rabbocco. Così anche chi beve con la cannuccia senza sollevare il
+bicchiere viene contato. Tutto dipende solo dagli istanti delle letture, non
+dall'orologio: le stesse letture danno sempre gli stessi eventi.
+
+``feed_many`` elabora un blocco di letture: i tratti in cui non può succedere
+niente (bicchiere fermo, o assente e lontano dalla soglia) vengono assorbiti
+con operazioni NumPy sull'intero tratto, e solo le letture in cui lo stato può
+cambiare passano una alla volta da ``feed``. Il risultato è identico, anche
+nell'arrotondamento delle somme.
+
+``SipEngine`` tiene un detector per ogni dispositivo collegato a una
+consumazione e passa gli eventi a una callback; con un ``filter_factory``
+(vedi ``signal_filter``) le letture vengono ripulite dal rumore a blocchi prima
+di arrivare al detector.
+"""
+
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Tipi di evento
+PLACED = 'appoggiato'
+LIFTED = 'sollevato'
+SIP = 'sorso'
+REFILL = 'rabbocco'
+REMOVED = 'rimosso'
+
+# Stati del bicchiere
+ABSENT = 'assente'
+SETTLING = 'in_assestamento'
+RESTING = 'appoggiato'
+RAISED = 'sollevato'
+
+SipEvent = namedtuple('SipEvent', 'kind started_at ended_at grams')
+
+# Letture esaminate insieme da feed_many: si parte da poche e si raddoppia
+# finché il tratto resta tranquillo
+_MIN_SPAN = 16
+_MAX_SPAN = 4096
+
+
+class SipDetector:
+    """Macchina a stati sulle letture (istante, grammi) di un sottobicchiere"""
+
+    def __init__(self, present_threshold=20.0, hysteresis=5.0, tolerance=2.0,
+                 settle_time=0.7, min_sip=5.0, removed_after=120.0):
+        """
+        Args:
+            present_threshold: Sotto questo peso il bicchiere non è sul sottobicchiere
+            hysteresis: Grammi sopra la soglia necessari per considerarlo di nuovo appoggiato
+            tolerance: Oscillazione massima di un peso considerato fermo
+            settle_time: Secondi di peso fermo per considerarlo stabile (debounce)
+            min_sip: Variazione minima del peso stabile per un sorso o un rabbocco
+            removed_after: Secondi da sollevato dopo cui il bicchiere è rimosso
+        """
+        self.present_threshold = present_threshold
+        self.hysteresis = hysteresis
+        self.tolerance = tolerance
+        self.settle_time = settle_time
+        self.min_sip = min_sip
+        self.removed_after = removed_after
+
+        self.state = ABSENT
+        self.reference = None
+        self._present = False
+        self._lifted_at = None
+        self._moved_at = None
+        # Peso candidato a diventare stabile: primo istante, somma e numero di letture
+        self._since = None
+        self._sum = 0.0
+        self._count = 0
+        self._settled = False
+        self._trimmed = False
+        # Il peso stabile attuale ha fissato il riferimento: finché resta fermo lo affina
+        self._refining = False
+
+    def _reset_candidate(self, timestamp, grams):
+        self._since = timestamp
+        self._sum = grams
+        self._count = 1
+        self._settled = False
+        self._refining = False
+        self._trimmed = False
+
+    def feed(self, timestamp, grams):
+        """Elabora una lettura; restituisce la lista degli eventi (spesso vuota)"""
+        events = []
+        threshold = self.present_threshold if self._present else self.present_threshold + self.hysteresis
+        present = grams >= threshold
+
+        if self._present and not present:
+            self._present = False
+            self._since = None
+            if self.reference is not None:
+                self.state = RAISED
+                self._lifted_at = timestamp
+                if self._moved_at is None:
+                    self._moved_at = timestamp
+                events.append(SipEvent(LIFTED, timestamp, timestamp, 0.0))
+            else:
+                self.state = ABSENT
+        elif present and not self._present:
+            self._present = True
+            self.state = SETTLING
+            self._reset_candidate(timestamp, grams)
+        elif present:
+            mean = self._sum / self._count
+            if abs(grams - mean) > self.tolerance:
+                if self._settled and self._moved_at is None:
+                    self._moved_at = timestamp
+                self.state = SETTLING
+                self._reset_candidate(timestamp, grams)
+            elif not self._trimmed and timestamp - self._since >= self.settle_time / 2:
+                # La prima metà dell'assestamento risente ancora del movimento
+                # (e del ritardo dei filtri): la media riparte da qui
+                self._trimmed = True
+                self._sum = grams
+                self._count = 1
+            else:
+                self._sum += grams
+                self._count += 1
+                if self._refining:
+                    self.reference = self._sum / self._count
+                elif not self._settled and timestamp - self._since >= self.settle_time:
+                    self._settled = True
+                    self._settle(self._sum / self._count, timestamp, events)
+        elif self.state == RAISED and timestamp - self._lifted_at >= self.removed_after:
+            self.state = ABSENT
+            self.reference = None
+            self._moved_at = None
+            events.append(SipEvent(REMOVED, self._lifted_at, timestamp, 0.0))
+        return events
+
+    def feed_many(self, timestamps, grams):
+        """Come ``feed`` per un blocco di letture (array NumPy); restituisce tutti gli eventi"""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        grams = np.asarray(grams, dtype=np.float64)
+        events = []
+        index, total, span = 0, len(timestamps), _MIN_SPAN
+        while index < total:
+            end = min(total, index + span)
+            quiet = self._quiet(timestamps[index:end], grams[index:end])
+            index += quiet
+            if index == end:
+                span = min(span * 2, _MAX_SPAN)
+                continue
+            span = _MIN_SPAN
+            events.extend(self.feed(float(timestamps[index]), float(grams[index])))
+            index += 1
+        return events
+
+    def _quiet(self, timestamps, grams):
+        """
+        Assorbe le prime letture del blocco che non cambierebbero lo stato e
+        restituisce quante sono: la prima lettura non assorbita va a ``feed``
+        """
+        if not self._present:
+            entering = grams >= self.present_threshold + self.hysteresis
+            if self.state == RAISED:
+                entering |= timestamps - self._lifted_at >= self.removed_after
+            return int(np.argmax(entering)) if entering.any() else len(grams)
+
+        # Presente e fermo: ogni lettura si somma alla media, che va confrontata
+        # con quella prima della lettura (somme nello stesso ordine di feed)
+        sums = np.cumsum(np.concatenate(([self._sum], grams)))
+        means = sums[:-1] / (self._count + np.arange(len(grams)))
+        moving = (grams < self.present_threshold) | (np.abs(grams - means) > self.tolerance)
+        if not self._trimmed:
+            moving |= timestamps - self._since >= self.settle_time / 2
+        elif not self._settled and not self._refining:
+            moving |= timestamps - self._since >= self.settle_time
+        quiet = int(np.argmax(moving)) if moving.any() else len(grams)
+        if quiet:
+            self._sum = float(sums[quiet])
+            self._count += quiet
+            if self._refining:
+                self.reference = self._sum / self._count
+        return quiet
+
+    def _settle(self, weight, timestamp, events):
+        self.state = RESTING
+        if self.reference is None:
+            self.reference = weight
+            self._refining = True
+            events.append(SipEvent(PLACED, self._since, timestamp, weight))
+        else:
+            started_at = self._moved_at if self._moved_at is not None else self._since
+            change = self.reference - weight
+            if change >= self.min_sip:
+                events.append(SipEvent(SIP, started_at, self._since, change))
+                self.reference = weight
+                self._refining = True
+            elif -change >= self.min_sip:
+                events.append(SipEvent(REFILL, started_at, self._since, -change))
+                self.reference = weight
+                self._refining = True
+        self._lifted_at = None
+        self._moved_at = None
+
+
+class _Tracked:
+    __slots__ = ('consumazione_id', 'detector', 'filter', 'cursor', 'lock')
+
+    def __init__(self, consumazione_id, detector, signal_filter, cursor):
+        self.consumazione_id = consumazione_id
+        self.detector = detector
+        self.filter = signal_filter
+        self.cursor = cursor
+        self.lock = threading.Lock()
+
+
+class SipEngine:
+    """Un ``SipDetector`` per ogni dispositivo collegato a una consumazione"""
+
+    def __init__(self, registry, on_event, warmup=2.0, filter_factory=None, **options):
+        """
+        Args:
+            registry: ``DeviceRegistry`` da cui leggere le letture
+            on_event: Chiamata come ``on_event(device_id, consumazione_id, evento)``
+            warmup: Secondi di letture già ricevute da rileggere quando un
+                dispositivo viene collegato, per trovare subito il peso stabile
+            filter_factory: Crea il filtro di ogni dispositivo, un oggetto con
+                ``apply(grammi)`` che filtra un blocco di letture
+            options: Parametri di ``SipDetector``
+        """
+        self.registry = registry
+        self.on_event = on_event
+        self.warmup = warmup
+        self.filter_factory = filter_factory
+        self.options = options
+        self._tracked = {}
+        self._lock = threading.Lock()
+
+    def start(self, device_id, consumazione_id):
+        """
+        Inizia a seguire il dispositivo per la consumazione, da chiamare quando
+        viene collegato: conteranno le letture arrivate da qui in poi (più
+        quelle degli ultimi ``warmup`` secondi)
+        """
+        latest = self.registry.latest(device_id)
+        cursor = latest[0] - self.warmup if latest else None
+        signal_filter = self.filter_factory() if self.filter_factory else None
+        tracked = _Tracked(consumazione_id, SipDetector(**self.options), signal_filter, cursor)
+        with self._lock:
+            self._tracked[device_id] = tracked
+        return tracked
+
+    def _track(self, device_id, consumazione_id):
+        with self._lock:
+            tracked = self._tracked.get(device_id)
+        if tracked is None or tracked.consumazione_id != consumazione_id:
+            tracked = self.start(device_id, consumazione_id)
+        return tracked
+
+    def process(self, device_id):
+        """Passa al detector le letture nuove del dispositivo; restituisce gli eventi"""
+        consumazione_id = self.registry.consumazione_for(device_id)
+        if consumazione_id is None:
+            with self._lock:
+                self._tracked.pop(device_id, None)
+            return []
+        tracked = self._track(device_id, consumazione_id)
+        with tracked.lock:
+            timestamps, grams = self.registry.columns(device_id, since=tracked.cursor)
+            if not len(timestamps):
+                return []
+            if tracked.filter is not None:
+                grams = tracked.filter.apply(grams)
+            events = tracked.detector.feed_many(timestamps, grams)
+            tracked.cursor = float(timestamps[-1])
+        for event in events:
+            self.on_event(device_id, consumazione_id, event)
+        return events
+
+    def state(self, device_id):
+        """Stato del bicchiere sul dispositivo, None se non è seguito"""
+        tracked = self._tracked.get(device_id)
+        return tracked.detector.state if tracked else None
@@ -0,0 +1,125 @@
+"""Test dei retry di ``AirtableClient`` con una sessione HTTP finta"""
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import airtable_client
+from airtable_client import AirtableClient, request_not_sent
+
+
+def response(status, json_body=None, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = requests.compat.json.dumps(json_body or {}).encode()
+    resp.headers.update(headers or {})
+    return resp
+
+
+def connection_refused():
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, '/v0', reason))
+
+
+class FakeSession:
+    """Restituisce (o solleva) le risposte preparate, una per tentativo"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(method)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(airtable_client.time, 'sleep', slept.append)
+    return slept
+
+
+def client(*outcomes, **options):
+    airtable = AirtableClient('key', 'appTEST', **options)
+    airtable.session = FakeSession(*outcomes)
+    return airtable
+
+
+def test_get_retries_5xx(sleeps):
+    airtable = client(response(503), response(502), response(200, {'records': []}))
+    assert airtable.get('Sorsi').status_code == 200
+    assert airtable.session.calls == ['GET'] * 3
+    assert len(sleeps) == 2
+
+
+def test_get_retries_read_timeout(sleeps):
+    airtable = client(requests.ReadTimeout('lento'), response(200))
+    assert airtable.get('Sorsi').status_code == 200
+    assert airtable.session.calls == ['GET', 'GET']
+
+
+def test_get_gives_up_after_max_retries(sleeps):
+    airtable = client(*[response(500)] * 3, max_retries=2)
+    assert airtable.get('Sorsi').status_code == 500
+    assert len(airtable.session.calls) == 3
+
+
+@pytest.mark.parametrize('status', [500, 502, 503, 504])
+def test_post_does_not_retry_5xx(sleeps, status):
+    airtable = client(response(status), response(200))
+    assert airtable.post('Sorsi', {'records': []}).status_code == status
+    assert airtable.session.calls == ['POST']
+    assert sleeps == []
+
+
+def test_post_does_not_retry_read_timeout(sleeps):
+    airtable = client(requests.ReadTimeout('risposta persa'), response(200))
+    with pytest.raises(requests.ReadTimeout):
+        airtable.post('Sorsi', {'records': []})
+    assert airtable.session.calls == ['POST']
+
+
+def test_patch_does_not_retry_after_sending(sleeps):
+    airtable = client(requests.ConnectionError('connessione chiusa a metà'), response(200))
+    with pytest.raises(requests.ConnectionError):
+        airtable.patch('Consumazioni', 'rec1', {'fields': {}})
+    assert airtable.session.calls == ['PATCH']
+
+
+def test_post_retries_429_and_unsent_requests(sleeps):
+    airtable = client(response(429), requests.ConnectTimeout('nessuna connessione'), connection_refused(),
+                      response(200))
+    assert airtable.post('Sorsi', {'records': []}).status_code == 200
+    assert airtable.session.calls == ['POST'] * 4
+
+
+def test_retry_after_is_honoured(sleeps):
+    airtable = client(response(429, headers={'Retry-After': '2'}), response(200), backoff_max=8.0)
+    assert airtable.get('Sorsi').status_code == 200
+    assert sleeps == [2.0]
+
+
+def test_retry_after_is_capped(sleeps):
+    airtable = client(response(503, headers={'Retry-After': '120'}), response(200), backoff_max=8.0)
+    airtable.get('Sorsi')
+    assert sleeps == [8.0]
+
+
+def test_request_not_sent():
+    assert request_not_sent(requests.ConnectTimeout())
+    assert request_not_sent(connection_refused())
+    assert not request_not_sent(requests.ReadTimeout())
+    assert not request_not_sent(requests.ConnectionError('reset'))
+    assert not request_not_sent(ValueError())
+
+
+def test_stats_count_retries(sleeps):
+    airtable = client(response(503), response(200))
+    airtable.get('Sorsi')
+    (stats,) = airtable.get_stats()
+    assert (stats['table'], stats['method'], stats['calls'], stats['errors'], stats['retries']) == \
+        ('Sorsi', 'GET', 2, 1, 1)
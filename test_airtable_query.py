@@ -0,0 +1,84 @@
+"""Test della costruzione delle formule e dei parametri di query per Airtable"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import airtable_query as aq
+
+
+def test_escape_string():
+    assert aq.escape_string("l'aperitivo") == "l\\'aperitivo"
+    assert aq.escape_string('a\\b') == 'a\\\\b'
+    # Prima le barre, poi gli apici: l'apice escapato non viene raddoppiato
+    assert aq.escape_string("\\'") == "\\\\\\'"
+
+
+def test_literal():
+    assert aq.literal(True) == 'TRUE()'
+    assert aq.literal(False) == 'FALSE()'
+    assert aq.literal(3) == '3'
+    assert aq.literal(0.5) == '0.5'
+    assert aq.literal("o'neil") == "'o\\'neil'"
+
+
+def test_field_rejects_braces():
+    assert aq.field('Ora inizio') == '{Ora inizio}'
+    with pytest.raises(ValueError):
+        aq.field('a}b')
+
+
+def test_eq():
+    assert aq.eq('Email', "x'@y") == "{Email}='x\\'@y'"
+
+
+def test_linked_contains_is_delimited():
+    formula = aq.linked_contains('User Record ID', 'recA')
+    assert formula == "FIND(',' & 'recA' & ',', ',' & ARRAYJOIN({User Record ID}, ',') & ',')"
+
+
+def test_record_id_in():
+    assert aq.record_id_in([]) == 'FALSE()'
+    assert aq.record_id_in(['rec1']) == "RECORD_ID()='rec1'"
+    assert aq.record_id_in(['rec1', 'rec2']) == "OR(RECORD_ID()='rec1', RECORD_ID()='rec2')"
+
+
+def test_and_or_skip_empty_conditions():
+    assert aq.and_('A', None, '') == 'A'
+    assert aq.and_('A', 'B') == 'AND(A, B)'
+    assert aq.or_(None, 'B') == 'B'
+    assert aq.or_('A', 'B', 'C') == 'OR(A, B, C)'
+
+
+def test_modified_since_is_utc():
+    naive = datetime(2026, 10, 17, 18, 30, 5)
+    aware = datetime(2026, 10, 17, 20, 30, 5, tzinfo=timezone(timedelta(hours=2)))
+    expected = "IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('2026-10-17T18:30:05.000Z'))"
+    assert aq.modified_since(naive) == expected
+    assert aq.modified_since(aware) == expected
+
+
+def test_same_day():
+    assert aq.same_day('Ora inizio', '2026-10-17') == (
+        "DATETIME_FORMAT(SET_TIMEZONE({Ora inizio}, 'Europe/Rome'), 'YYYY-MM-DD')='2026-10-17'")
+
+
+def test_build_params():
+    params = aq.build_params(formula="{A}='x'", sort=['-Ora inizio', 'Name'], max_records=5,
+                             fields=['Volume (g)'])
+    assert params == {
+        'filterByFormula': "{A}='x'",
+        'sort[0][field]': 'Ora inizio', 'sort[0][direction]': 'desc',
+        'sort[1][field]': 'Name', 'sort[1][direction]': 'asc',
+        'maxRecords': 5,
+        'fields[]': ['Volume (g)'],
+    }
+    assert aq.build_params() == {}
+    assert aq.build_params(fields=[]) == {'fields[]': []}
+
+
+def test_project():
+    record = {'id': 'rec1', 'fields': {'A': 1, 'B': 2}}
+    assert aq.project(record, ['A']) == {'id': 'rec1', 'fields': {'A': 1}}
+    assert aq.project(record, None) is record
+    assert aq.project(None, ['A']) is None
@@ -0,0 +1,207 @@
+"""Test dell'applicazione Flask senza Airtable (variabili d'ambiente in conftest.py)"""
+
+import re
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import app as safesip
+from airtable_client import AirtableError
+from devices import MAX_BATCH_SAMPLES, encode_binary_batch
+
+
+class FakeTable:
+    """``iter_records`` su tabelle in memoria: capisce solo i filtri linked_contains"""
+
+    def __init__(self, tables, fields_available=True):
+        self.tables = tables
+        self.fields_available = fields_available
+        self.calls = []
+
+    def iter_records(self, table, params=None, page_size=100):
+        formula = (params or {}).get('filterByFormula')
+        self.calls.append((table, formula))
+        records = self.tables.get(table, [])
+        if formula:
+            if not self.fields_available:
+                raise AirtableError(SimpleNamespace(status_code=422, text='UNKNOWN_FIELD_NAME'))
+            for value, name in re.findall(r"FIND\(',' & '([^']*)' & ',', ',' & ARRAYJOIN\(\{([^}]*)\}", formula):
+                records = [record for record in records if value in record['fields'].get(name, [])]
+        return iter(records)
+
+
+def sorso(record_id, consumazione_id, id_field=True):
+    fields = {'Consumazioni Id': [consumazione_id]}
+    if id_field:
+        fields['Consumazione Record ID'] = [consumazione_id]
+    return {'id': record_id, 'fields': fields}
+
+
+@pytest.fixture
+def airtable(monkeypatch):
+    def install(tables, fields_available=True):
+        fake = FakeTable(tables, fields_available)
+        monkeypatch.setattr(safesip.airtable, 'iter_records', fake.iter_records)
+        monkeypatch.setattr(safesip, 'linked_filter_missing', set())
+        return fake
+    return install
+
+
+def test_load_linked_filters_on_record_id_field(airtable):
+    fake = airtable({'Sorsi': [sorso('s1', 'recC1'), sorso('s2', 'recC2')]})
+    records = safesip.load_linked('Sorsi', {'Consumazioni Id': 'recC1'})
+    assert [record['id'] for record in records] == ['s1']
+    assert fake.calls == [('Sorsi', "FIND(',' & 'recC1' & ',', ',' & ARRAYJOIN({Consumazione Record ID}, ',') & ',')")]
+
+
+def test_load_linked_empty_result_does_not_scan(airtable):
+    fake = airtable({'Sorsi': [sorso('s1', 'recC1')]})
+    for _ in range(3):
+        assert safesip.load_linked('Sorsi', {'Consumazioni Id': 'recNEW'}) == []
+    assert all(formula for _, formula in fake.calls)
+    assert len(fake.calls) == 3
+
+
+def test_load_linked_without_id_fields_filters_in_python(airtable):
+    fake = airtable({'Sorsi': [sorso('s1', 'recC1', id_field=False), sorso('s2', 'recC2', id_field=False)]},
+                    fields_available=False)
+    assert [record['id'] for record in safesip.load_linked('Sorsi', {'Consumazioni Id': 'recC2'})] == ['s2']
+    assert [record['id'] for record in safesip.load_linked('Sorsi', {'Consumazioni Id': 'recC1'})] == ['s1']
+    # Dopo il 422 la formula non viene più provata
+    assert [formula is not None for _, formula in fake.calls] == [True, False, False]
+
+
+def test_load_linked_other_errors_are_raised(airtable, monkeypatch):
+    airtable({})
+
+    def failing(table, params=None, page_size=100):
+        raise AirtableError(SimpleNamespace(status_code=503, text='down'))
+
+    monkeypatch.setattr(safesip.airtable, 'iter_records', failing)
+    with pytest.raises(AirtableError):
+        safesip.load_linked('Sorsi', {'Consumazioni Id': 'recC1'})
+    assert safesip.linked_filter_missing == set()
+
+
+def test_load_linked_checks_every_link(airtable):
+    airtable({'Consumazioni': [
+        {'id': 'c1', 'fields': {'User': ['u1'], 'Bar': ['b1'], 'User Record ID': ['u1'], 'Bar Record ID': ['b1']}},
+        {'id': 'c2', 'fields': {'User': ['u1'], 'Bar': ['b2'], 'User Record ID': ['u1'], 'Bar Record ID': ['b2']}},
+    ]})
+    records = safesip.load_linked('Consumazioni', {'User': 'u1', 'Bar': 'b2'})
+    assert [record['id'] for record in records] == ['c2']
+
+
+def test_fanout_threads_share_the_request_identity_map():
+    loads = []
+
+    def read(name):
+        return safesip.read_once(('Drinks', 'rec1'), lambda: loads.append(name) or {'id': 'rec1'})
+
+    with safesip.app.test_request_context('/'):
+        reads = safesip.request_reads()
+        first = read('parent')
+        results = safesip.fanout.run({'a': lambda: (safesip.request_reads(), read('a')),
+                                      'b': lambda: (safesip.request_reads(), read('b'))})
+    assert [result[0] for result in results.values()] == [reads, reads]
+    assert all(result[1] is first for result in results.values())
+    assert loads == ['parent']
+
+
+@pytest.fixture
+def logged_in():
+    client = safesip.app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = 'recU1'
+        session['last_activity'] = datetime.now(safesip.TIMEZONE).isoformat()
+    return client
+
+
+def test_bind_device_sets_the_device_to_read(logged_in):
+    with logged_in:
+        response = logged_in.post('/bind_device', json={'device_id': 'bar-7'})
+        assert response.get_json() == {'success': True, 'device_id': 'bar-7', 'consumazione_id': None}
+        assert safesip.bound_device_id() == 'bar-7'
+
+
+def test_bind_device_follows_the_active_consumption(logged_in):
+    with logged_in.session_transaction() as session:
+        session['active_consumazione_id'] = 'recBIND'
+        session['consumption_data'] = {'id': 'recBIND', 'device_id': 'vecchio'}
+    with logged_in:
+        logged_in.post('/bind_device', json={'device_id': 'bar-8'})
+        assert safesip.bound_device_id() == 'bar-8'
+    assert safesip.devices.consumazione_for('bar-8') == 'recBIND'
+    safesip.devices.unbind_consumazione('recBIND')
+
+
+@pytest.mark.parametrize('device_id', ['..', '../etc', 'a b', 'x' * 65])
+def test_bind_device_rejects_invalid_ids(logged_in, device_id):
+    response = logged_in.post('/bind_device', json={'device_id': device_id})
+    assert response.status_code == 400
+    with logged_in.session_transaction() as session:
+        assert 'device_id' not in session
+
+
+def test_arduino_batch_json_and_resend():
+    client = safesip.app.test_client()
+    samples = [[1000.0, 300.0], [1000.1, 299.5], [1000.2, 299.0]]
+    first = client.post('/arduino_batch', json={'device_id': 'batch-json', 'samples': samples}).get_json()
+    assert (first['received'], first['accepted'], first['cursor']) == (3, 3, 1000.2)
+
+    # Il dispositivo non ha ricevuto la risposta e reinvia il lotto con un campione in più
+    again = client.post('/arduino_batch?device=batch-json', json=samples + [[1000.3, 298.5]]).get_json()
+    assert (again['received'], again['accepted'], again['cursor']) == (4, 1, 1000.3)
+    assert [t for t, _ in safesip.devices.samples('batch-json')] == [1000.0, 1000.1, 1000.2, 1000.3]
+
+
+def test_arduino_batch_binary_out_of_order():
+    client = safesip.app.test_client()
+    body = encode_binary_batch([2000.2, 2000.0, 2000.1], [298.0, 300.0, 299.0])
+    response = client.post('/arduino_batch', data=body, content_type='application/octet-stream',
+                           headers={'X-Device-Id': 'batch-bin'})
+    assert response.get_json()['accepted'] == 3
+    assert safesip.devices.samples('batch-bin') == [(2000.0, 300.0), (2000.1, 299.0), (2000.2, 298.0)]
+
+
+def test_arduino_batch_rejects_bad_binary_length():
+    client = safesip.app.test_client()
+    body = encode_binary_batch([1.0], [1.0])[:-3]
+    response = client.post('/arduino_batch?device=batch-bad', data=body, content_type='application/octet-stream')
+    assert response.status_code == 400
+    assert 'multipli di 16' in response.get_json()['message']
+    assert safesip.devices.latest('batch-bad') is None
+
+
+def test_arduino_batch_rejects_too_many_samples():
+    client = safesip.app.test_client()
+    samples = [[float(i), 1.0] for i in range(MAX_BATCH_SAMPLES + 1)]
+    response = client.post('/arduino_batch', json={'device_id': 'batch-big', 'samples': samples})
+    assert response.status_code == 400
+    assert 'Troppi campioni' in response.get_json()['message']
+
+    # Oltre il limite sulla dimensione il corpo non viene nemmeno letto
+    body = b'\0' * (MAX_BATCH_SAMPLES * 16 * 4 + 16)
+    response = client.post('/arduino_batch?device=batch-big', data=body, content_type='application/octet-stream')
+    assert response.status_code == 413
+    assert safesip.devices.latest('batch-big') is None
+
+
+def test_sse_streams_are_capped_per_worker(logged_in, monkeypatch):
+    monkeypatch.setattr(safesip, 'SSE_MAX_STREAMS', 1)
+    monkeypatch.setattr(safesip, 'sse_streams', {'active': 0, 'rejected': 0})
+    first = logged_in.get('/stream_arduino_data')
+    assert first.status_code == 200
+
+    busy = logged_in.get('/stream_arduino_data')
+    assert busy.status_code == 503
+    assert busy.headers['Retry-After'] == '5'
+    assert busy.get_data(as_text=True) == 'retry: 5000\n\n'
+
+    # Chiuso il primo stream (anche senza averlo letto) il posto torna libero
+    first.close()
+    assert safesip.sse_streams == {'active': 0, 'rejected': 1}
+    again = logged_in.get('/stream_arduino_data')
+    assert again.status_code == 200
+    again.close()
@@ -0,0 +1,151 @@
+"""Test di ``TTLCache`` (scadenza, LRU, stale-while-revalidate) e ``IdentityMap``"""
+
+import threading
+
+import pytest
+
+import cache
+from cache import IdentityMap, TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def wait_refreshes(store):
+    for thread in threading.enumerate():
+        if thread.name == 'cache-refresh':
+            thread.join(timeout=5)
+    assert store.get_stats()['refreshing'] == 0
+
+
+def test_entries_expire(clock):
+    store = TTLCache(ttl=10)
+    store.set(('Drinks',), 'tutti')
+    clock[0] += 9.9
+    assert store.get(('Drinks',)) == 'tutti'
+    clock[0] += 0.1
+    assert store.get(('Drinks',), 'nessuno') == 'nessuno'
+    assert store.get_stats()['size'] == 0
+
+
+def test_least_recently_used_is_evicted(clock):
+    store = TTLCache(ttl=10, max_size=2)
+    store.set(('Bar', 'a'), 1)
+    store.set(('Bar', 'b'), 2)
+    store.get(('Bar', 'a'))
+    store.set(('Bar', 'c'), 3)
+    assert store.get(('Bar', 'b')) is None
+    assert store.get(('Bar', 'a')) == 1
+    assert store.get_stats()['evictions'] == 1
+
+
+def test_none_is_not_cached(clock):
+    store = TTLCache(ttl=10)
+    loads = []
+    for _ in range(2):
+        assert store.get_or_load(('Drinks', 'x'), lambda: loads.append(1)) is None
+    assert len(loads) == 2
+
+
+def test_stale_value_is_served_and_refreshed(clock):
+    stale = []
+    store = TTLCache(ttl=10, stale_ttl=60, on_stale=lambda key, age: stale.append((key, age)))
+    store.set(('Drinks',), 'vecchio')
+    clock[0] += 15
+
+    release = threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        release.wait(5)
+        return 'nuovo'
+
+    # Si risponde subito col valore vecchio; una sola ricarica per chiave
+    assert store.get_or_load(('Drinks',), loader) == 'vecchio'
+    assert store.get_or_load(('Drinks',), loader) == 'vecchio'
+    assert stale == [(('Drinks',), 15), (('Drinks',), 15)]
+    release.set()
+    wait_refreshes(store)
+
+    assert loads == [1]
+    assert store.get(('Drinks',)) == 'nuovo'
+    assert store.get_stats()['refreshes'] == 1
+
+
+def test_too_stale_value_is_reloaded_synchronously(clock):
+    store = TTLCache(ttl=10, stale_ttl=60)
+    store.set(('Drinks',), 'vecchio')
+    clock[0] += 70
+    assert store.get_or_load(('Drinks',), lambda: 'nuovo') == 'nuovo'
+    assert store.get_stats()['stale_hits'] == 0
+
+
+def test_get_serves_stale_only_on_request(clock):
+    store = TTLCache(ttl=10, stale_ttl=60)
+    store.set(('Bar',), 'vecchio')
+    clock[0] += 20
+    assert store.get(('Bar',)) is None
+    assert store.get(('Bar',), allow_stale=True) == 'vecchio'
+
+
+def test_failed_refresh_keeps_previous_value(clock):
+    store = TTLCache(ttl=10, stale_ttl=60)
+    store.set(('Drinks',), 'vecchio')
+    clock[0] += 15
+
+    def loader():
+        raise RuntimeError('Airtable non risponde')
+
+    assert store.get_or_load(('Drinks',), loader) == 'vecchio'
+    wait_refreshes(store)
+    assert store.get(('Drinks',), allow_stale=True) == 'vecchio'
+    assert store.get_stats()['refresh_errors'] == 1
+
+
+def test_invalidate_discards_refresh_started_before(clock):
+    store = TTLCache(ttl=10, stale_ttl=60)
+    store.set(('Drinks',), 'vecchio')
+    clock[0] += 15
+
+    started, release = threading.Event(), threading.Event()
+
+    def loader():
+        started.set()
+        release.wait(5)
+        return 'letto prima della scrittura'
+
+    assert store.get_or_load(('Drinks',), loader) == 'vecchio'
+    assert started.wait(5)
+    store.invalidate('Drinks')
+    release.set()
+    wait_refreshes(store)
+
+    # La ricarica è partita prima dell'invalidazione: il suo valore non entra in cache
+    assert store.get(('Drinks',), allow_stale=True) is None
+    assert store.get_or_load(('Drinks',), lambda: 'dopo la scrittura') == 'dopo la scrittura'
+
+
+def test_invalidate_by_table(clock):
+    store = TTLCache(ttl=10)
+    store.set(('Bar', 'a'), 1)
+    store.set(('Drinks', 'b'), 2)
+    store.invalidate('Bar')
+    assert store.get(('Bar', 'a')) is None
+    assert store.get(('Drinks', 'b')) == 2
+    store.invalidate()
+    assert store.get_stats()['size'] == 0
+
+
+def test_identity_map_loads_once():
+    reads = IdentityMap()
+    loads = []
+    first = reads.get_or_load(('Sorsi', 'c1'), lambda: loads.append(1) or ['s1'])
+    assert reads.get_or_load(('Sorsi', 'c1'), lambda: loads.append(1) or ['s2']) is first
+    reads.invalidate('Sorsi')
+    assert reads.get_or_load(('Sorsi', 'c1'), lambda: ['s3']) == ['s3']
+    assert (reads.hits, reads.misses, len(loads)) == (1, 2, 1)
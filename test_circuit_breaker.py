@@ -0,0 +1,105 @@
+"""Test degli stati del circuit breaker con un orologio finto"""
+
+import pytest
+import requests
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from test_airtable_client import client, response
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 30
+    assert breaker.get_stats()['rejected'] == 1
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 30
+    assert breaker.get_stats()['opened'] == 2
+
+
+def test_probe_without_outcome_expires(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    assert breaker.allow()
+    # Chi faceva la prova è morto senza riportare l'esito
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+@pytest.mark.parametrize('error', [requests.exceptions.ChunkedEncodingError('troncata'),
+                                   requests.TooManyRedirects('loop'),
+                                   requests.exceptions.InvalidJSONError('corpo non valido')])
+def test_client_reports_other_errors_to_the_breaker(clock, error):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    airtable = client(error, response(200), breaker=breaker)
+    with pytest.raises(type(error)):
+        airtable.get('Sorsi')
+    assert breaker.state == OPEN
+
+    clock[0] += 30
+    assert airtable.get('Sorsi').status_code == 200
+    assert breaker.state == CLOSED
+
+
+def test_client_reports_governor_errors_to_the_breaker(clock):
+    class BrokenGovernor:
+        def acquire(self):
+            raise OSError('file dei gettoni non leggibile')
+
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    airtable = client(response(200), breaker=breaker, governor=BrokenGovernor())
+    with pytest.raises(OSError):
+        airtable.get('Sorsi')
+    assert airtable.session.calls == []
+    assert breaker.state == OPEN
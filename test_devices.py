@@ -0,0 +1,83 @@
+"""Test della decodifica dei lotti e del registro dei dispositivi"""
+
+import numpy as np
+import pytest
+
+from devices import (BINARY_SAMPLE_SIZE, DEFAULT_DEVICE_ID, MAX_BATCH_SAMPLES, DeviceRegistry,
+                     decode_binary_batch, decode_json_batch, encode_binary_batch, normalize_device_id)
+
+
+def test_binary_round_trip():
+    body = encode_binary_batch([1.0, 2.0, 3.0], [100.0, 99.0, 98.5])
+    assert len(body) == 3 * BINARY_SAMPLE_SIZE
+    timestamps, grams = decode_binary_batch(body)
+    assert timestamps.tolist() == [1.0, 2.0, 3.0]
+    assert grams.tolist() == [100.0, 99.0, 98.5]
+
+
+@pytest.mark.parametrize('extra', [1, 8, 15])
+def test_binary_length_must_be_a_multiple_of_the_sample(extra):
+    body = encode_binary_batch([1.0], [100.0]) + b'\0' * extra
+    with pytest.raises(ValueError, match='multipli di 16'):
+        decode_binary_batch(body)
+
+
+def test_binary_rejects_non_finite_values():
+    with pytest.raises(ValueError, match='non numerici'):
+        decode_binary_batch(encode_binary_batch([1.0, 2.0], [100.0, np.nan]))
+
+
+def test_batches_are_capped():
+    timestamps = np.arange(MAX_BATCH_SAMPLES + 1, dtype=float)
+    with pytest.raises(ValueError, match='Troppi campioni'):
+        decode_binary_batch(encode_binary_batch(timestamps, timestamps))
+    with pytest.raises(ValueError, match='Troppi campioni'):
+        decode_json_batch([[t, 1.0] for t in timestamps.tolist()])
+    assert len(decode_json_batch([[t, 1.0] for t in timestamps[:-1].tolist()])[0]) == MAX_BATCH_SAMPLES
+
+
+@pytest.mark.parametrize('samples', [{'a': 1}, [[1.0]], [[1.0, 2.0, 3.0]], [['x', 2.0]], [1.0, 2.0],
+                                     [[1.0, 2.0], [3.0]]])
+def test_json_batch_must_be_pairs(samples):
+    with pytest.raises(ValueError):
+        decode_json_batch(samples)
+
+
+def test_empty_json_batch():
+    timestamps, grams = decode_json_batch([])
+    assert len(timestamps) == len(grams) == 0
+
+
+def test_normalize_device_id():
+    assert normalize_device_id(None) == DEFAULT_DEVICE_ID
+    assert normalize_device_id('  ') == DEFAULT_DEVICE_ID
+    assert normalize_device_id(' bar-1:cup_2 ') == 'bar-1:cup_2'
+    assert normalize_device_id('cup.v2') == 'cup.v2'
+    for invalid in ['a b', 'a/b', 'x' * 65, '.', '..', '...', '.hidden']:
+        with pytest.raises(ValueError):
+            normalize_device_id(invalid)
+
+
+def test_out_of_order_samples_are_sorted():
+    registry = DeviceRegistry()
+    assert registry.record_batch('cup', [3.0, 1.0, 2.0], [97.0, 99.0, 98.0]) == (3, 3.0)
+    assert registry.samples('cup') == [(1.0, 99.0), (2.0, 98.0), (3.0, 97.0)]
+
+
+def test_resent_batch_is_not_duplicated():
+    registry = DeviceRegistry()
+    assert registry.record_batch('cup', [1.0, 2.0, 3.0], [100.0, 99.0, 98.0]) == (3, 3.0)
+    # Lo stesso lotto reinviato, poi uno che si sovrappone in parte
+    assert registry.record_batch('cup', [1.0, 2.0, 3.0], [100.0, 99.0, 98.0]) == (0, 3.0)
+    assert registry.record_batch('cup', [2.0, 3.0, 4.0], [99.0, 98.0, 97.0]) == (1, 4.0)
+    assert [t for t, _ in registry.samples('cup')] == [1.0, 2.0, 3.0, 4.0]
+    # Un campione più vecchio dell'ultima lettura non torna indietro nel buffer
+    assert registry.record_batch('cup', [0.5], [101.0]) == (0, 4.0)
+
+
+def test_device_ids_most_recent_first():
+    registry = DeviceRegistry()
+    registry.record('a', 1.0)
+    registry.record('b', 1.0)
+    registry.record('a', 2.0)
+    assert registry.device_ids() == ['a', 'b']
@@ -0,0 +1,282 @@
+"""Test del journal write-behind con un client Airtable finto (senza thread di invio)"""
+
+import json
+import os
+import re
+
+import pytest
+import requests
+
+import journal
+from journal import WriteJournal, is_local_id
+
+
+def response(status, body=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(body or {}).encode()
+    return resp
+
+
+class FakeClient:
+    """
+    Tabelle in memoria con la stessa ``request``/``get_all`` di ``AirtableClient``.
+    ``outcomes`` decide l'esito dei POST/PATCH successivi: 'ok', un codice
+    HTTP, 'created+503' o 'created+timeout' (record creati ma risposta persa)
+    o un'eccezione da sollevare senza creare niente.
+    """
+
+    def __init__(self, invalid=()):
+        self.tables = {}
+        self.outcomes = []
+        self.calls = []
+        self.invalid = set(invalid)
+        self._next_id = 0
+
+    def _create(self, table, records):
+        saved = []
+        for record in records:
+            self._next_id += 1
+            saved.append({'id': f'rec{self._next_id}', 'fields': dict(record['fields'])})
+        self.tables.setdefault(table, []).extend(saved)
+        return saved
+
+    def request(self, method, table, json=None, **kwargs):
+        records = json['records']
+        self.calls.append((method, table, [dict(record) for record in records]))
+        outcome = self.outcomes.pop(0) if self.outcomes else 'ok'
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, int):
+            return response(outcome)
+        if any(record['fields'].get('Volume (g)') in self.invalid for record in records):
+            return response(422, {'error': 'INVALID_VALUE_FOR_COLUMN'})
+        if method == 'PATCH':
+            by_id = {record['id']: record for record in self.tables.get(table, [])}
+            for record in records:
+                by_id[record['id']]['fields'].update(record['fields'])
+            return response(200, {'records': [by_id[record['id']] for record in records]})
+        saved = self._create(table, records)
+        if outcome == 'created+503':
+            return response(503)
+        if outcome == 'created+timeout':
+            raise requests.ReadTimeout('risposta persa')
+        return response(200, {'records': saved})
+
+    def get_all(self, table, params=None):
+        self.calls.append(('GET', table, params.get('filterByFormula')))
+        wanted = re.findall(r"\{Journal ID\}='([^']*)'", params.get('filterByFormula', ''))
+        return [record for record in self.tables.get(table, []) if record['fields'].get('Journal ID') in wanted]
+
+    def posts(self):
+        return [call for call in self.calls if call[0] == 'POST']
+
+
+@pytest.fixture
+def client():
+    return FakeClient(invalid={-1})
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / 'journal')
+
+
+def flush_all(wal, limit=20):
+    """Svuota il journal come farebbe il thread, ignorando gli errori"""
+    for _ in range(limit):
+        if not wal.get_stats()['pending']:
+            return
+        try:
+            wal.flush()
+        except Exception:
+            pass
+
+
+def sorso_fields(consumazione_id, volume=20):
+    return {'Consumazioni Id': [consumazione_id], 'Volume (g)': volume}
+
+
+def test_create_is_confirmed_with_local_id_and_flushed(client, directory):
+    wal = WriteJournal(client, directory)
+    record = wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    assert is_local_id(record['id'])
+    assert [r['id'] for r in wal.pending_records('Sorsi', 'Consumazioni Id', 'recC1')] == [record['id']]
+
+    assert wal.flush() == 1
+    assert wal.resolve(record['id']) == client.tables['Sorsi'][0]['id']
+    assert wal.pending_records('Sorsi') == []
+    assert wal.get_stats()['flushed'] == 1
+
+
+def test_replay_after_restart(client, directory):
+    wal = WriteJournal(client, directory)
+    first = wal.append_create('Sorsi', sorso_fields('recC1', 10), key='recC1')
+    second = wal.append_create('Sorsi', sorso_fields('recC1', 15), key='recC1')
+    wal.append_update('Consumazioni', 'recC1', {'Completato': 'Completato'})
+    wal.close()
+
+    restarted = WriteJournal(client, directory)
+    assert restarted.path == wal.path
+    assert restarted.get_stats()['pending'] == 3
+    assert [r['id'] for r in restarted.pending_records('Sorsi')] == [first['id'], second['id']]
+
+    client.tables['Consumazioni'] = [{'id': 'recC1', 'fields': {}}]
+    flush_all(restarted)
+    assert [r['fields']['Volume (g)'] for r in client.tables['Sorsi']] == [10, 15]
+    assert client.tables['Consumazioni'][0]['fields'] == {'Completato': 'Completato'}
+    restarted.close()
+
+    # Le conferme sono nel file: al riavvio successivo non si reinvia niente
+    again = WriteJournal(client, directory)
+    assert again.get_stats()['pending'] == 0
+    assert again.resolve(first['id']) == client.tables['Sorsi'][0]['id']
+
+
+def test_truncated_last_line_is_ignored(client, directory):
+    wal = WriteJournal(client, directory)
+    wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    wal.close()
+    with open(wal.path, 'a', encoding='utf-8') as fh:
+        fh.write('{"seq": 2, "op": "cre')
+    assert WriteJournal(client, directory).get_stats()['pending'] == 1
+
+
+def test_next_batch_keeps_order_per_key(client, directory):
+    wal = WriteJournal(client, directory)
+    a = wal.append_create('Sorsi', sorso_fields('recC1', 1), key='recC1')
+    wal.append_update('Consumazioni', 'recC1', {'Completato': 'Completato'})
+    c = wal.append_create('Sorsi', sorso_fields('recC1', 3), key='recC1')
+    d = wal.append_create('Sorsi', sorso_fields('recC2', 4), key='recC2')
+
+    # L'aggiornamento di recC1 blocca il sorso successivo della stessa
+    # consumazione, non quello di recC2
+    assert [entry['id'] for entry in wal._next_batch()] == [a['id'], d['id']]
+
+    client.tables['Consumazioni'] = [{'id': 'recC1', 'fields': {}}]
+    wal.flush()
+    assert [(entry['op'], entry['id']) for entry in wal._next_batch()] == [('update', 'recC1')]
+    wal.flush()
+    assert [entry['id'] for entry in wal._next_batch()] == [c['id']]
+
+
+def test_batches_are_capped(client, directory):
+    wal = WriteJournal(client, directory)
+    for i in range(journal.BATCH_SIZE + 3):
+        wal.append_create('Sorsi', sorso_fields(f'recC{i}'), key=f'recC{i}')
+    assert len(wal._next_batch()) == journal.BATCH_SIZE
+
+
+def test_local_ids_are_aliased_before_sending(client, directory):
+    wal = WriteJournal(client, directory)
+    consumazione = wal.append_create('Consumazioni', {'User': ['recU1']})
+    sorso = wal.append_create('Sorsi', sorso_fields(consumazione['id']), key=consumazione['id'])
+    wal.append_update('Consumazioni', consumazione['id'], {'Peso (g)': 180})
+
+    # Il sorso e l'aggiornamento aspettano l'ID definitivo della consumazione
+    assert [entry['op'] for entry in wal._next_batch()] == ['create']
+    assert wal._next_batch()[0]['table'] == 'Consumazioni'
+    flush_all(wal)
+
+    real_id = client.tables['Consumazioni'][0]['id']
+    assert wal.resolve(consumazione['id']) == real_id
+    assert client.tables['Sorsi'][0]['fields']['Consumazioni Id'] == [real_id]
+    assert client.tables['Consumazioni'][0]['fields']['Peso (g)'] == 180
+    assert wal.resolve(sorso['id']) == client.tables['Sorsi'][0]['id']
+
+    # Le corrispondenze sopravvivono alla compattazione e al riavvio
+    wal._compact()
+    wal.close()
+    assert WriteJournal(client, directory).resolve(consumazione['id']) == real_id
+
+
+def test_invalid_record_is_rejected_after_max_attempts(client, directory, monkeypatch):
+    monkeypatch.setattr(journal, 'MAX_ATTEMPTS', 3)
+    wal = WriteJournal(client, directory)
+    good = wal.append_create('Sorsi', sorso_fields('recC1', 20), key='recC1')
+    bad = wal.append_create('Sorsi', sorso_fields('recC2', -1), key='recC2')
+
+    # Il blocco viene rifiutato, poi si riprova un record alla volta
+    with pytest.raises(RuntimeError):
+        wal.flush()
+    assert not is_local_id(wal.resolve(good['id']))
+    assert wal.get_stats()['pending'] == 1
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            wal.flush()
+    stats = wal.get_stats()
+    assert (stats['pending'], stats['dropped']) == (0, 1)
+    with open(os.path.join(directory, 'rejected.log'), encoding='utf-8') as fh:
+        rejected = [json.loads(line) for line in fh]
+    assert [entry['id'] for entry in rejected] == [bad['id']]
+    assert rejected[0]['attempts'] == 3
+
+
+@pytest.mark.parametrize('outcome', ['created+503', 'created+timeout'])
+def test_uncertain_create_is_not_reposted_without_id_field(client, directory, outcome):
+    wal = WriteJournal(client, directory)
+    wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    client.outcomes = [outcome]
+    with pytest.raises((RuntimeError, requests.ReadTimeout)):
+        wal.flush()
+
+    flush_all(wal)
+    assert len(client.posts()) == 1
+    assert len(client.tables['Sorsi']) == 1
+    assert wal.get_stats()['dropped'] == 1
+    with open(os.path.join(directory, 'rejected.log'), encoding='utf-8') as fh:
+        assert 'esito incerto' in json.loads(fh.readline())['reason']
+
+
+@pytest.mark.parametrize('outcome', ['created+503', 'created+timeout'])
+def test_uncertain_create_is_found_by_id_field(client, directory, outcome):
+    wal = WriteJournal(client, directory, id_field='Journal ID')
+    record = wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    client.outcomes = [outcome]
+    with pytest.raises((RuntimeError, requests.ReadTimeout)):
+        wal.flush()
+
+    assert wal.flush() == 1
+    assert len(client.posts()) == 1
+    assert len(client.tables['Sorsi']) == 1
+    assert client.tables['Sorsi'][0]['fields']['Journal ID'] == record['id']
+    assert wal.resolve(record['id']) == client.tables['Sorsi'][0]['id']
+
+
+def test_uncertain_create_not_on_airtable_is_reposted_once(client, directory):
+    wal = WriteJournal(client, directory, id_field='Journal ID')
+    wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    client.outcomes = [503]
+    with pytest.raises(RuntimeError):
+        wal.flush()
+    wal.close()
+
+    # Anche dopo un riavvio la scrittura resta da verificare prima del reinvio
+    restarted = WriteJournal(client, directory, id_field='Journal ID')
+    assert restarted.flush() == 1
+    assert [call[0] for call in client.calls] == ['POST', 'GET', 'POST']
+    assert len(client.tables['Sorsi']) == 1
+
+
+@pytest.mark.parametrize('outcome', [429, requests.ConnectTimeout('nessuna connessione')])
+def test_create_not_received_is_retried(client, directory, outcome):
+    wal = WriteJournal(client, directory)
+    wal.append_create('Sorsi', sorso_fields('recC1'), key='recC1')
+    client.outcomes = [outcome]
+    with pytest.raises((RuntimeError, requests.ConnectTimeout)):
+        wal.flush()
+    assert wal.flush() == 1
+    assert len(client.posts()) == 2
+    assert wal.get_stats()['dropped'] == 0
+
+
+def test_updates_are_retried_after_5xx(client, directory):
+    client.tables['Consumazioni'] = [{'id': 'recC1', 'fields': {}}]
+    wal = WriteJournal(client, directory)
+    wal.append_update('Consumazioni', 'recC1', {'Completato': 'Completato'})
+    client.outcomes = [503]
+    with pytest.raises(RuntimeError):
+        wal.flush()
+    assert wal.flush() == 1
+    assert client.tables['Consumazioni'][0]['fields'] == {'Completato': 'Completato'}
@@ -0,0 +1,143 @@
+"""Test del ricevitore UDP/TCP con un registro dei dispositivi nello stesso processo"""
+
+import asyncio
+
+import pytest
+
+import listener
+from devices import MAX_BATCH_SAMPLES, DeviceRegistry
+from listener import ReadingListener, RegistrySink, parse_line, simulate
+
+SIM_DEVICES = ('sim-0', 'sim-1', 'sim-2')
+
+
+class FlakySink(RegistrySink):
+    """Come ``RegistrySink``, ma gli invii con indice in ``failing`` falliscono"""
+
+    def __init__(self, registry, failing=(0,), after_write=False):
+        super().__init__(registry)
+        self.failing = set(failing)
+        # Il lotto arriva al registro ma la risposta si perde (come un timeout)
+        self.after_write = after_write
+        self.calls = []
+
+    def send(self, device_id, timestamps, grams):
+        self.calls.append((device_id, len(timestamps)))
+        if len(self.calls) - 1 in self.failing:
+            if self.after_write:
+                super().send(device_id, timestamps, grams)
+            raise ConnectionError('applicazione non raggiungibile')
+        return super().send(device_id, timestamps, grams)
+
+
+def lines(device_id, readings):
+    return ''.join(f'{device_id} {grams} {timestamp}\n' for timestamp, grams in readings).encode('ascii')
+
+
+async def _simulate(transport):
+    registry = DeviceRegistry()
+    reader = ReadingListener(RegistrySink(registry), flush_interval=0.05)
+    ports = {'udp_port': 0} if transport == 'udp' else {'tcp_port': 0}
+    addresses = await reader.start('127.0.0.1', **ports)
+    port = addresses[transport][1]
+    target = {'udp_port': port} if transport == 'udp' else {'tcp_port': port}
+    sent = await simulate('127.0.0.1', devices=len(SIM_DEVICES), rate=40, duration=0.5, seed=7, **target)
+    # Lascia arrivare gli ultimi datagrammi/righe prima di chiudere
+    for _ in range(50):
+        if reader.stats['received'] >= sent:
+            break
+        await asyncio.sleep(0.02)
+    await reader.stop()
+    return registry, reader.stats, sent
+
+
+@pytest.mark.parametrize('transport', ['udp', 'tcp'])
+def test_simulate_reaches_registry(transport):
+    registry, stats, sent = asyncio.run(_simulate(transport))
+
+    assert sent > 0 and sent % len(SIM_DEVICES) == 0
+    assert stats['received'] == sent
+    assert stats['sent'] == sent
+    assert stats['invalid'] == stats['send_errors'] == stats['dropped'] == 0
+    assert registry.get_stats()['readings'] == sent
+    for device_id in SIM_DEVICES:
+        samples = registry.samples(device_id)
+        assert len(samples) == sent // len(SIM_DEVICES)
+        timestamps = [timestamp for timestamp, _ in samples]
+        assert timestamps == sorted(timestamps)
+        assert all(0 <= grams < 400 for _, grams in samples)
+
+
+def test_parse_line():
+    assert parse_line('123.5', now=10.0) == ('default', 10.0, 123.5)
+    assert parse_line('bar-1 80', now=10.0) == ('bar-1', 10.0, 80.0)
+    assert parse_line('bar-1 80 5.25', now=10.0) == ('bar-1', 5.25, 80.0)
+    for line in ('a b c d', 'bar-1 x', 'bad/id 10'):
+        with pytest.raises(ValueError):
+            parse_line(line, now=10.0)
+
+
+def test_invalid_lines_are_counted():
+    reader = ReadingListener(RegistrySink(DeviceRegistry()))
+    reader.feed(b'bar-1 10 1\n\nbar-1 nope\n1 2 3 4\nbar-1 11 2\n')
+    assert reader.stats['received'] == 2
+    assert reader.stats['invalid'] == 2
+    assert reader.pending() == 2
+
+
+def test_failed_send_requeues_before_newer_readings():
+    registry = DeviceRegistry()
+    sink = FlakySink(registry)
+    reader = ReadingListener(sink)
+
+    reader.feed(lines('cup', [(1, 100), (2, 99), (3, 98)]))
+    asyncio.run(reader.flush())
+    assert reader.stats['send_errors'] == 1
+    assert reader.stats['sent'] == 0
+    assert registry.samples('cup') == []
+
+    reader.feed(lines('cup', [(4, 97), (5, 96)]))
+    assert list(reader._pending['cup'][0]) == [1, 2, 3, 4, 5]
+
+    asyncio.run(reader.flush())
+    assert reader.stats['sent'] == 5
+    assert registry.samples('cup') == [(1.0, 100.0), (2.0, 99.0), (3.0, 98.0), (4.0, 97.0), (5.0, 96.0)]
+    assert reader.pending() == 0
+
+
+def test_resent_batch_is_deduplicated_by_the_registry():
+    registry = DeviceRegistry()
+    reader = ReadingListener(FlakySink(registry, after_write=True))
+
+    reader.feed(lines('cup', [(1, 100), (2, 99)]))
+    asyncio.run(reader.flush())
+    reader.feed(lines('cup', [(3, 98)]))
+    asyncio.run(reader.flush())
+
+    assert registry.samples('cup') == [(1.0, 100.0), (2.0, 99.0), (3.0, 98.0)]
+    assert registry.get_stats()['readings'] == 3
+
+
+def test_requeue_keeps_only_unsent_chunks():
+    registry = DeviceRegistry()
+    total = MAX_BATCH_SAMPLES + 10
+    sink = FlakySink(registry, failing=(1,))
+    reader = ReadingListener(sink)
+    reader.feed(lines('cup', [(i, 100) for i in range(total)]))
+    asyncio.run(reader.flush())
+    assert sink.calls == [('cup', MAX_BATCH_SAMPLES), ('cup', 10)]
+    assert reader.stats['sent'] == MAX_BATCH_SAMPLES
+    assert list(reader._pending['cup'][0]) == list(range(MAX_BATCH_SAMPLES, total))
+    assert len(registry.samples('cup')) == MAX_BATCH_SAMPLES
+
+
+def test_requeue_drops_oldest_beyond_max_pending(monkeypatch):
+    monkeypatch.setattr(listener, 'MAX_PENDING', 4)
+    reader = ReadingListener(FlakySink(DeviceRegistry(), failing=(0, 1)))
+    reader.feed(lines('cup', [(i, 100) for i in range(3)]))
+    asyncio.run(reader.flush())
+    reader.feed(lines('cup', [(i, 100) for i in range(3, 6)]))
+    asyncio.run(reader.flush())
+
+    assert reader.stats['dropped'] == 2
+    assert list(reader._pending['cup'][0]) == [2, 3, 4, 5]
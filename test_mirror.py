@@ -0,0 +1,176 @@
+"""Test del mirror locale su SQLite in memoria, con un client Airtable finto"""
+
+import pytest
+from flask import Flask
+
+import mirror
+from models import Consumazione, SyncState, db
+
+
+class FakeAirtable:
+    """Tabelle in memoria con la stessa interfaccia di lettura di ``AirtableClient``"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.calls = []
+
+    def _select(self, table, params):
+        params = params or {}
+        self.calls.append((table, params.get('filterByFormula')))
+        records = self.tables.get(table, [])
+        if params.get('filterByFormula'):
+            # Il filtro sulla data di modifica: restituisce solo i record marcati
+            records = [record for record in records if record.get('modified')]
+        return [{'id': record['id'], 'createdTime': record.get('createdTime'), 'fields': record['fields']}
+                for record in records]
+
+    def get_all(self, table, params=None):
+        return self._select(table, params)
+
+    def iter_pages(self, table, params=None):
+        yield self._select(table, params)
+
+    def iter_records(self, table, params=None):
+        return iter(self._select(table, params))
+
+
+def record(record_id, created='2026-10-16T20:00:00.000Z', modified=False, **fields):
+    return {'id': record_id, 'createdTime': created, 'modified': modified, 'fields': fields}
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def airtable():
+    return FakeAirtable({
+        'Bar': [record('recBar1', Name='Bar Uno', Città='Torino'), record('recBar2', Name='Bar Due')],
+        'Users': [record('recU1', Email='a@example.com', Peso=70, Password='segreta'),
+                  record('recU2', Email='b@example.com', Peso=60)],
+        'Drinks': [record('recD1', Name='Spritz', Gradazione=0.11, Bar=['recBar1', 'recBar2']),
+                   record('recD2', Name='Negroni', Gradazione=0.24, Bar=['recBar1'])],
+        'Consumazioni': [
+            record('recC1', '2026-10-16T20:00:00.000Z', User=['recU1'], Drink=['recD1'], Bar=['recBar1']),
+            record('recC2', '2026-10-16T21:00:00.000Z', User=['recU1'], Drink=['recD2'], Bar=['recBar1']),
+            record('recC3', '2026-10-16T22:00:00.000Z', User=['recU2'], Drink=['recD1'], Bar=['recBar2']),
+        ],
+        'Sorsi': [
+            record('recS1', **{'Consumazioni Id': ['recC1'], 'BAC Temporaneo': 0.2, 'Email': 'a@example.com',
+                                'Ora inizio': '2026-10-16T20:05:00.000Z'}),
+            record('recS2', **{'Consumazioni Id': ['recC1'], 'BAC Temporaneo': 0.6, 'Email': 'a@example.com',
+                                'Ora inizio': '2026-10-16T20:10:00.000Z'}),
+            record('recS3', **{'Consumazioni Id': ['recC2'], 'BAC Temporaneo': 0.7, 'Email': 'a@example.com',
+                                'Ora inizio': '2026-10-16T21:10:00.000Z'}),
+            record('recS4', **{'Consumazioni Id': ['recC3'], 'Email': 'b@example.com',
+                                'Ora inizio': '2026-10-16T22:10:00.000Z'}),
+        ],
+        'GameData': [
+            record('recG1', User=['recU1'], Points=10, Level=1, **{'Last Updated': '2026-10-15T10:00:00.000Z'}),
+            record('recG2', User=['recU1'], Points=30, Level=2, **{'Last Updated': '2026-10-16T10:00:00.000Z'}),
+            record('recG3', User=['recU2'], Points=20, Level=1, **{'Last Updated': '2026-10-16T10:00:00.000Z'}),
+        ],
+    })
+
+
+def test_first_sync_loads_everything(app, airtable):
+    results = mirror.sync_all(airtable)
+
+    assert {table: result['mode'] for table, result in results.items()} == dict.fromkeys(results, 'full')
+    assert results['Consumazioni']['upserted'] == 3
+    assert db.session.get(SyncState, 'Sorsi').watermark is not None
+    user = mirror.get_record('Users', 'recU1')
+    assert user['fields']['Email'] == 'a@example.com'
+    assert 'Password' not in user['fields']
+
+
+def test_incremental_sync_upserts_modified_records(app, airtable):
+    mirror.sync_all(airtable)
+    airtable.calls.clear()
+    consumazioni = airtable.tables['Consumazioni']
+    consumazioni[0] = record('recC1', '2026-10-16T20:00:00.000Z', User=['recU2'], Drink=['recD1'], Bar=['recBar1'], modified=True)
+    consumazioni.append(record('recC4', '2026-10-16T23:00:00.000Z', User=['recU2'], Drink=['recD2'], Bar=['recBar2'], modified=True))
+
+    result = mirror.sync_table(airtable, 'Consumazioni', reconcile=False)
+
+    assert result == {'mode': 'incremental', 'upserted': 2, 'deleted': 0}
+    (table, formula), = airtable.calls
+    assert table == 'Consumazioni' and 'LAST_MODIFIED_TIME()' in formula
+    assert db.session.get(Consumazione, 'recC1').user_id == 'recU2'
+    assert [c['id'] for c in mirror.get_user_consumazioni(user_id='recU2')] == ['recC1', 'recC3', 'recC4']
+
+
+def test_reconcile_deletes_missing_records(app, airtable):
+    mirror.sync_all(airtable)
+    del airtable.tables['Sorsi'][0]
+
+    assert mirror.sync_table(airtable, 'Sorsi', reconcile=False)['deleted'] == 0
+    assert mirror.get_record('Sorsi', 'recS1') is not None
+
+    assert mirror.sync_table(airtable, 'Sorsi', reconcile=True)['deleted'] == 1
+    assert mirror.get_record('Sorsi', 'recS1') is None
+    assert db.session.get(SyncState, 'Sorsi').reconciled_at is not None
+
+
+def test_refresh_replaces_drink_bars(app, airtable):
+    mirror.refresh_all(airtable)
+    airtable.tables['Drinks'][0] = record('recD1', Name='Spritz', Bar=['recBar2'])
+    airtable.tables['Drinks'].pop()
+
+    mirror.refresh_table(airtable, 'Drinks')
+
+    assert mirror.get_record('Drinks', 'recD2') is None
+    assert mirror.get_record('Drinks', 'recD1')['fields']['Bar'] == ['recBar2']
+
+
+def test_sorsi_queries(app, airtable):
+    mirror.refresh_all(airtable)
+
+    assert [s['id'] for s in mirror.get_sorsi_by_consumazione('recC1')] == ['recS1', 'recS2']
+    grouped = mirror.get_sorsi_by_consumazioni(['recC1', 'recC3'])
+    assert {key: len(value) for key, value in grouped.items()} == {'recC1': 2, 'recC3': 1}
+    day = mirror.get_sorsi_giornalieri('a@example.com', mirror.datetime(2026, 10, 16, 20, 6),
+                                       mirror.datetime(2026, 10, 17))
+    assert [s['id'] for s in day] == ['recS2', 'recS3']
+
+
+def test_world_stats(app, airtable):
+    mirror.refresh_all(airtable)
+
+    stats = mirror.world_stats('recU1')
+
+    assert stats['classifica'][0] == {'nome': 'a@example.com', 'conteggio': 2}
+    assert stats['drink_popolari'][0] == {'nome': 'Spritz', 'conteggio': 2}
+    assert (stats['totale_consumazioni'], stats['totale_sorsi'], stats['num_bar']) == (3, 4, 2)
+    assert stats['num_consumazioni_utente'] == 2
+    assert stats['tasso_medio_utente'] == pytest.approx(0.5)
+    assert stats['perc_esiti_positivi_utente'] == pytest.approx(200 / 3)
+    assert stats['drink_preferito_utente'] in ('Spritz', 'Negroni')
+
+
+def test_bar_stats(app, airtable):
+    mirror.refresh_all(airtable)
+
+    stats = mirror.bar_stats('recBar1', [(0, 0.5), (0.5, float('inf'))])
+
+    assert stats['totale_consumazioni'] == 2
+    assert stats['totale_sorsi'] == 3
+    assert stats['tasso_medio'] == pytest.approx(0.5)
+    assert stats['bac_data'] == [1, 2]
+    assert stats['drink_stats']['Spritz'] == {'consumazioni': 1, 'sorsi': 2, 'tasso_medio': pytest.approx(0.4),
+                                              'positivi': 1}
+
+
+def test_leaderboard_uses_latest_game_data(app, airtable):
+    mirror.refresh_all(airtable)
+
+    rows = mirror.leaderboard()
+
+    assert [(game['id'], user['id']) for game, user in rows] == [('recG2', 'recU1'), ('recG3', 'recU2')]
@@ -0,0 +1,121 @@
+"""Test del token bucket condiviso: ricarica, riserve delle corsie, attesa massima e più processi"""
+
+import multiprocessing
+import time
+
+import pytest
+
+import rate_governor
+from rate_governor import ANALYTICS, CRITICAL, REFERENCE, RateGovernor, priority
+
+
+class FakeClock:
+    """Sostituisce il modulo ``time`` di rate_governor: ``sleep`` fa solo avanzare l'orologio"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_governor, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'bucket')
+
+
+def test_burst_then_refill_rate(clock, path):
+    governor = RateGovernor(path, rate=5.0, burst=5)
+    for _ in range(5):
+        assert governor.acquire(CRITICAL) == 0.0
+    # Bucket vuoto: un token ogni 1/rate secondi
+    assert governor.acquire(CRITICAL) == pytest.approx(0.2)
+    start = clock.now
+    for _ in range(10):
+        governor.acquire(CRITICAL)
+    assert clock.now - start == pytest.approx(2.0)
+    assert governor.get_stats()['lanes'][CRITICAL]['acquired'] == 16
+
+
+def test_tokens_never_exceed_burst(clock, path):
+    governor = RateGovernor(path, rate=5.0, burst=3)
+    governor.acquire(CRITICAL)
+    clock.now += 3600
+    assert governor.get_stats()['tokens'] == 3
+
+
+def test_analytics_cannot_take_the_critical_reserve(clock, path):
+    governor = RateGovernor(path, rate=1.0, burst=5)
+    # ANALYTICS deve lasciare 2 token: ne prende 3 senza attendere, poi aspetta
+    for _ in range(3):
+        assert governor.acquire(ANALYTICS) == 0.0
+    assert governor.get_stats()['tokens'] == 2
+    # Le corsie più importanti trovano ancora la loro riserva
+    assert governor.acquire(REFERENCE) == 0.0
+    assert governor.acquire(CRITICAL) == 0.0
+    assert governor.get_stats()['tokens'] == 0
+
+    # Con il bucket vuoto ANALYTICS aspetta finché non ci sono 3 token
+    assert governor.acquire(ANALYTICS) == pytest.approx(3.0)
+    assert governor.get_stats()['tokens'] == pytest.approx(2.0)
+
+
+def test_lane_comes_from_context(clock, path):
+    governor = RateGovernor(path, rate=1.0, burst=3)
+    governor.acquire(CRITICAL)
+    with priority(ANALYTICS):
+        assert governor.acquire() == pytest.approx(1.0)
+    assert governor.get_stats()['lanes'][ANALYTICS]['waited'] == 1
+    # Una corsia sconosciuta viene trattata come REFERENCE
+    governor.acquire('sconosciuta')
+    assert governor.get_stats()['lanes'][REFERENCE]['acquired'] == 1
+
+
+def test_max_wait_lets_the_call_through(clock, path):
+    governor = RateGovernor(path, rate=0.01, burst=1, max_wait=30.0)
+    governor.acquire(CRITICAL)
+    waited = governor.acquire(CRITICAL)
+    assert waited == pytest.approx(30.0)
+    # Si controlla il bucket al più ogni MAX_POLL secondi, senza superare max_wait
+    assert max(clock.slept) <= rate_governor.MAX_POLL
+    stats = governor.get_stats()['lanes'][CRITICAL]
+    assert (stats['overruns'], stats['waiting']) == (1, 0)
+
+
+def _take(path, count, results):
+    governor = RateGovernor(path, rate=50.0, burst=1)
+    for _ in range(count):
+        governor.acquire(CRITICAL)
+    results.put(time.monotonic())
+
+
+def test_processes_share_one_bucket(path):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    RateGovernor(path, rate=50.0, burst=1).acquire(CRITICAL)
+    start = time.monotonic()
+    workers = [context.Process(target=_take, args=(path, 10, results)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    finished = [results.get(timeout=10) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=10)
+        assert worker.exitcode == 0
+
+    # 20 token a 50 al secondo: con bucket separati basterebbero 0,2 secondi
+    assert max(finished) - start >= 0.38
@@ -0,0 +1,116 @@
+"""Test della registrazione e della riproduzione delle letture.
+
+``testdata/coaster.rec`` è una registrazione di un minuto di due sottobicchieri
+(con rumore, picchi e due lotti ritrasmessi); ``testdata/coaster.json`` è il
+report atteso. Se si cambia di proposito il riconoscimento dei sorsi si
+rigenera con ``python replay.py run testdata/coaster.rec`` e le opzioni di
+``EXPECT_ARGS``, più ``--report testdata/coaster.json``.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+import replay
+from recording import MAGIC, Recorder, RecordingError, read_recording
+from replay import SipReplay, compare_reports
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+RECORDING = os.path.join(TESTDATA, 'coaster.rec')
+EXPECTED = os.path.join(TESTDATA, 'coaster.json')
+
+# Opzioni esplicite: il risultato non deve dipendere dalle variabili d'ambiente
+EXPECT_ARGS = ['--speed', '0', '--min-sip', '5', '--buffer-size', '4096', '--median-window', '5',
+               '--ema-alpha', '0.5', '--outlier-k', '3', '--peso', '70', '--genere', 'uomo',
+               '--gradazione', '0.12', '--stomaco', 'vuoto']
+DRINKER = {'peso': 70, 'genere': 'uomo', 'gradazione': 0.12, 'stomaco': 'vuoto'}
+
+
+def test_recording_round_trip(tmp_path):
+    path = str(tmp_path / 'sub' / 'test.rec')
+    recorder = Recorder(path)
+    recorder.append('cup', [1.0, 2.0], [100.0, 99.5], received_at=10.0)
+    recorder.append('glass', np.array([3.0]), np.array([50.0]), received_at=11.0)
+    recorder.close()
+    # Riaprendo si aggiunge in fondo senza riscrivere l'intestazione
+    Recorder(path).append('cup', [4.0], [98.0], received_at=12.0)
+
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+    frames = list(read_recording(path))
+    assert [(frame.received_at, frame.device_id) for frame in frames] == [(10.0, 'cup'), (11.0, 'glass'), (12.0, 'cup')]
+    assert frames[0].timestamps.tolist() == [1.0, 2.0]
+    assert frames[0].grams.tolist() == [100.0, 99.5]
+    assert frames[2].grams.tolist() == [98.0]
+
+
+def test_truncated_recording(tmp_path):
+    path = str(tmp_path / 'cut.rec')
+    recorder = Recorder(path)
+    recorder.append('cup', [1.0, 2.0], [100.0, 99.5], received_at=10.0)
+    recorder.append('cup', [3.0, 4.0], [99.0, 98.5], received_at=11.0)
+    recorder.close()
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 5)
+    assert [frame.received_at for frame in read_recording(path)] == [10.0]
+
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path / 'other.rec'
+    path.write_bytes(b'qualcos altro')
+    with pytest.raises(RecordingError):
+        list(read_recording(str(path)))
+
+
+def test_checked_in_recording_matches_expected_report():
+    assert replay.main(['run', RECORDING, '--expect', EXPECTED] + EXPECT_ARGS) == 0
+
+
+def test_report_differences_are_detected(tmp_path):
+    with open(EXPECTED) as f:
+        expected = json.load(f)
+    expected['events'][0]['grams'] += 1
+    changed = tmp_path / 'changed.json'
+    changed.write_text(json.dumps(expected))
+    assert replay.main(['run', RECORDING, '--expect', str(changed)] + EXPECT_ARGS) == 1
+
+
+def test_same_events_at_any_speed():
+    with open(EXPECTED) as f:
+        expected = json.load(f)
+
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    # In tempo reale i lotti arrivano uno alla volta, con un orologio finto
+    sink = SipReplay(DRINKER, min_sip=5)
+    stats = replay.replay(read_recording(RECORDING), sink, speed=1, clock=lambda: now[0], sleep=sleep)
+    assert stats['frames'] == 138
+    assert stats['sent'] < stats['readings']
+    assert compare_reports(expected, sink.report()) == []
+    assert now[0] == pytest.approx(55.5)
+
+
+def test_summary():
+    summary = replay.summarize(RECORDING)
+    assert summary['frames'] == 138
+    assert summary['devices'] == {'bar-1': 570, 'bar-2': 467}
+    assert summary['duration'] == pytest.approx(55.5)
+
+
+def test_export_history(tmp_path):
+    from weight_store import WeightStore
+
+    store = WeightStore(str(tmp_path / 'history'))
+    timestamps = 1792180800.0 + np.arange(0, 100, 0.1)
+    store.append('cup', timestamps, np.full(len(timestamps), 200.0))
+    path = str(tmp_path / 'export.rec')
+
+    assert replay.export_history(store, ['cup'], timestamps[0], timestamps[-1] + 1, path, batch=300) == 1000
+    frames = list(read_recording(path))
+    assert [len(frame.timestamps) for frame in frames] == [300, 300, 300, 100]
+    assert frames[0].received_at == pytest.approx(frames[0].timestamps[-1])
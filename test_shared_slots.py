@@ -0,0 +1,71 @@
+"""Test della tabella condivisa delle ultime letture"""
+
+import os
+
+import pytest
+
+from shared_slots import SharedSlots, SlotTableFull
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'slots')
+
+
+def test_round_trip(path):
+    slots = SharedSlots(path, slots=16)
+    assert slots.read('cup') is None
+    assert slots.write('cup', 100.0, 250.5)
+    assert slots.write('glass', 101.0, 80.0, readings=10)
+    assert slots.read('cup') == (100.0, 250.5)
+    assert slots.read('glass') == (101.0, 80.0)
+    assert slots.get_stats() == {'slots': 16, 'used': 2}
+
+
+def test_only_newer_readings_are_written(path):
+    slots = SharedSlots(path, slots=16)
+    assert slots.write('cup', 100.0, 250.0)
+    assert not slots.write('cup', 100.0, 1.0)
+    assert not slots.write('cup', 99.0, 1.0)
+    assert slots.write('cup', 100.5, 240.0)
+    assert slots.read('cup') == (100.5, 240.0)
+
+
+def test_full_table(path):
+    slots = SharedSlots(path, slots=2)
+    slots.write('a', 1.0, 1.0)
+    slots.write('b', 1.0, 2.0)
+    with pytest.raises(SlotTableFull):
+        slots.write('c', 1.0, 3.0)
+    # I dispositivi che hanno già uno slot continuano a funzionare
+    assert slots.write('a', 2.0, 4.0)
+    assert slots.read('a') == (2.0, 4.0)
+    assert slots.read('c') is None
+
+
+def test_other_instance_sees_writes(path):
+    writer, reader = SharedSlots(path, slots=16), SharedSlots(path, slots=16)
+    assert reader.read('cup') is None
+    writer.write('cup', 100.0, 250.0)
+    assert reader.read('cup') == (100.0, 250.0)
+    writer.write('cup', 101.0, 240.0)
+    assert reader.read('cup') == (101.0, 240.0)
+
+
+def test_readings_from_a_forked_worker(path):
+    slots = SharedSlots(path, slots=16)
+    slots.write('cup', 100.0, 250.0)
+    pid = os.fork()
+    if pid == 0:
+        # Il figlio (come un altro worker) scrive con il proprio flock
+        try:
+            for i in range(1, 101):
+                slots.write('cup', 100.0 + i, 250.0 - i)
+            slots.write('glass', 5.0, 50.0)
+        finally:
+            os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert slots.read('cup') == (200.0, 150.0)
+    assert slots.read('glass') == (5.0, 50.0)
+    assert slots.write('cup', 201.0, 149.0)
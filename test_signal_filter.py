@@ -0,0 +1,71 @@
+"""Test del filtro del rumore: stesso risultato a blocchi e parametri validati"""
+
+import numpy as np
+import pytest
+
+from signal_filter import SignalFilter
+
+
+def noisy_signal(n=3000, seed=5):
+    rng = np.random.default_rng(seed)
+    steps = np.repeat(rng.uniform(50, 350, n // 100), 100)[:n]
+    grams = steps + rng.normal(0, 0.5, n)
+    spikes = rng.choice(n, n // 200, replace=False)
+    grams[spikes] += rng.uniform(-80, 80, len(spikes))
+    return grams
+
+
+def apply_in_chunks(signal_filter, grams, sizes):
+    out, start, i = [], 0, 0
+    while start < len(grams):
+        size = sizes[i % len(sizes)]
+        out.append(signal_filter.apply(grams[start:start + size]))
+        start += size
+        i += 1
+    return np.concatenate(out)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'median_window': 1},
+    {'ema_alpha': 1.0},
+    {'median_window': 9, 'ema_alpha': 0.05, 'outlier_k': 0},
+    {'median_window': 3, 'ema_alpha': 1e-4},
+])
+@pytest.mark.parametrize('sizes', [[1], [7, 1, 3], [250], [1000, 2, 1998]])
+def test_chunk_invariance(options, sizes):
+    grams = noisy_signal()
+    whole = SignalFilter(**options).apply(grams)
+    chunked = apply_in_chunks(SignalFilter(**options), grams, sizes)
+    np.testing.assert_allclose(chunked, whole, rtol=1e-9, atol=1e-9)
+
+
+def test_spikes_are_removed():
+    grams = np.full(200, 150.0)
+    grams[[50, 120, 121]] = [300.0, 0.0, 400.0]
+    filtered = SignalFilter(ema_alpha=1.0).apply(grams)
+    np.testing.assert_allclose(filtered, 150.0)
+
+
+def test_step_passes_through():
+    grams = np.concatenate((np.full(50, 300.0), np.full(50, 280.0)))
+    filtered = SignalFilter().apply(grams)
+    assert filtered[0] == 300.0
+    assert abs(filtered[-1] - 280.0) < 1e-6
+
+
+def test_empty_block():
+    signal_filter = SignalFilter()
+    assert len(signal_filter.apply([])) == 0
+    assert signal_filter.apply([100.0])[0] == 100.0
+
+
+@pytest.mark.parametrize('options', [
+    {'ema_alpha': 0},
+    {'ema_alpha': -0.5},
+    {'ema_alpha': 1.5},
+    {'median_window': 0},
+])
+def test_invalid_parameters(options):
+    with pytest.raises(ValueError):
+        SignalFilter(**options)
@@ -0,0 +1,135 @@
+"""Test del riconoscimento di sorsi e rabbocchi, lettura per lettura e a blocchi"""
+
+import random
+
+import numpy as np
+import pytest
+
+from devices import DeviceRegistry
+from signal_filter import SignalFilter
+from sip_detector import LIFTED, PLACED, REFILL, REMOVED, RESTING, SIP, SipDetector, SipEngine
+
+RATE = 20  # letture al secondo
+
+
+def segment(start, seconds, grams, noise=0.0, rng=None):
+    """Letture costanti (più rumore) per ``seconds`` secondi da ``start``"""
+    timestamps = start + np.arange(int(seconds * RATE)) / RATE
+    values = np.full(len(timestamps), float(grams))
+    if noise:
+        values += np.array([rng.gauss(0, noise) for _ in timestamps])
+    return timestamps, values
+
+
+def session(parts, noise=0.0, seed=1):
+    """Concatena tratti (secondi, grammi): 0 grammi è il bicchiere sollevato"""
+    rng = random.Random(seed)
+    t, timestamps, grams = 1000.0, [], []
+    for seconds, weight in parts:
+        ts, gs = segment(t, seconds, weight, noise, rng)
+        timestamps.append(ts)
+        grams.append(gs)
+        t += seconds
+    return np.concatenate(timestamps), np.concatenate(grams)
+
+
+def feed_all(detector, timestamps, grams):
+    events = []
+    for timestamp, value in zip(timestamps.tolist(), grams.tolist()):
+        events.extend(detector.feed(timestamp, value))
+    return events
+
+
+def kinds(events):
+    return [event.kind for event in events]
+
+
+def test_sip_and_refill():
+    timestamps, grams = session([(3, 300), (4, 0), (3, 285), (2, 0), (3, 330)])
+    detector = SipDetector()
+    events = feed_all(detector, timestamps, grams)
+
+    assert kinds(events) == [PLACED, LIFTED, SIP, LIFTED, REFILL]
+    placed, _, sip, _, refill = events
+    assert placed.grams == pytest.approx(300)
+    assert sip.grams == pytest.approx(15)
+    # Il sorso inizia quando il bicchiere viene sollevato e finisce quando torna
+    assert sip.started_at == pytest.approx(1003.0)
+    assert sip.ended_at == pytest.approx(1007.0)
+    assert refill.grams == pytest.approx(45)
+    assert detector.state == RESTING
+    assert detector.reference == pytest.approx(330)
+
+
+def test_sip_with_straw_without_lifting():
+    timestamps, grams = session([(3, 300), (3, 292)])
+    events = feed_all(SipDetector(), timestamps, grams)
+    assert kinds(events) == [PLACED, SIP]
+    assert events[1].grams == pytest.approx(8)
+
+
+def test_small_changes_and_noise_are_ignored():
+    timestamps, grams = session([(3, 300), (2, 0), (3, 297), (3, 298)], noise=0.4)
+    events = feed_all(SipDetector(min_sip=5), timestamps, grams)
+    assert kinds(events) == [PLACED, LIFTED]
+
+
+def test_removed_after_timeout():
+    timestamps, grams = session([(3, 300), (15, 0), (3, 200)])
+    events = feed_all(SipDetector(removed_after=10), timestamps, grams)
+    assert kinds(events) == [PLACED, LIFTED, REMOVED, PLACED]
+    assert events[-1].grams == pytest.approx(200)
+
+
+def random_session(seconds, seed):
+    rng = random.Random(seed)
+    parts, weight = [], 320.0
+    while sum(length for length, _ in parts) < seconds:
+        parts.append((rng.uniform(5, 60), weight))
+        if rng.random() < 0.7:
+            parts.append((rng.uniform(1, 20), 0.5))
+        weight = weight - rng.uniform(3, 25) if rng.random() < 0.85 else weight + rng.uniform(10, 80)
+    timestamps, grams = session(parts, noise=0.8, seed=seed)
+    return timestamps, SignalFilter().apply(grams)
+
+
+@pytest.mark.parametrize('options', [{}, {'removed_after': 8.0}, {'settle_time': 0.3, 'tolerance': 1.0}])
+def test_feed_many_matches_feed(options):
+    timestamps, grams = random_session(1800, seed=11)
+    one_by_one = SipDetector(**options)
+    expected = feed_all(one_by_one, timestamps, grams)
+    assert SIP in kinds(expected)
+
+    rng = random.Random(2)
+    blocks = SipDetector(**options)
+    events, start = [], 0
+    while start < len(timestamps):
+        size = rng.choice([1, 5, 64, 3000])
+        events.extend(blocks.feed_many(timestamps[start:start + size], grams[start:start + size]))
+        start += size
+
+    assert events == expected
+    assert blocks.state == one_by_one.state
+    assert blocks.reference == one_by_one.reference
+
+
+def test_engine_follows_bound_device():
+    registry = DeviceRegistry()
+    received = []
+    engine = SipEngine(registry, lambda device_id, consumazione_id, event: received.append(
+        (device_id, consumazione_id, event.kind)), filter_factory=SignalFilter)
+    timestamps, grams = session([(3, 300), (3, 0), (3, 280)])
+
+    # Senza collegamento le letture non vengono seguite
+    registry.record_batch('cup', timestamps[:10], grams[:10])
+    assert engine.process('cup') == []
+    assert engine.state('cup') is None
+
+    registry.bind('cup', 'rec1')
+    for start in range(10, len(timestamps), 25):
+        registry.record_batch('cup', timestamps[start:start + 25], grams[start:start + 25])
+        engine.process('cup')
+
+    assert [kind for _, _, kind in received] == [PLACED, LIFTED, SIP]
+    assert {(device_id, consumazione_id) for device_id, consumazione_id, _ in received} == {('cup', 'rec1')}
+    assert engine.state('cup') == RESTING
@@ -0,0 +1,102 @@
+"""Test dello storico colonnare: scrittura, rilettura, riepiloghi e pulizia"""
+
+import os
+from datetime import date
+
+import numpy as np
+import pytest
+
+from weight_store import GRAMS_SCALE, WeightStore, day_start
+
+DAY = date(2026, 10, 16)
+MIDNIGHT = day_start(DAY)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return WeightStore(str(tmp_path))
+
+
+def test_round_trip(store):
+    timestamps = MIDNIGHT + 3600 + np.arange(1000) * 0.05
+    grams = 150 + np.sin(np.arange(1000)) * 20
+
+    assert store.append('cup', timestamps, grams) == 1000
+    loaded_ts, loaded_grams = store.load('cup', MIDNIGHT, MIDNIGHT + 86400)
+
+    # Precisione dei file: millisecondi e decimi di grammo
+    np.testing.assert_allclose(loaded_ts, timestamps, atol=5e-4)
+    np.testing.assert_allclose(loaded_grams, grams, atol=0.5 / GRAMS_SCALE)
+    assert os.path.getsize(os.path.join(store.directory, 'cup', '2026-10-16.g')) == 2000
+
+
+def test_duplicates_and_unsorted_batches(store):
+    timestamps = MIDNIGHT + np.array([3.0, 1.0, 2.0])
+    assert store.append('cup', timestamps, [30, 10, 20]) == 3
+    # Un lotto reinviato aggiunge solo le letture nuove
+    assert store.append('cup', MIDNIGHT + np.array([2.0, 3.0, 4.0]), [20, 30, 40]) == 1
+    assert store.append('cup', [], []) == 0
+
+    loaded_ts, loaded_grams = store.load('cup', MIDNIGHT, MIDNIGHT + 10)
+    np.testing.assert_allclose(loaded_ts - MIDNIGHT, [1, 2, 3, 4])
+    np.testing.assert_allclose(loaded_grams, [10, 20, 30, 40])
+
+
+def test_read_is_a_view_split_by_day(store):
+    timestamps = MIDNIGHT - 100 + np.arange(400) * 0.5
+    store.append('cup', timestamps, np.full(400, 200.0))
+
+    assert store.days('cup') == [date(2026, 10, 15), DAY]
+    parts = store.read('cup', MIDNIGHT - 10, MIDNIGHT + 10)
+    assert [part.day for part in parts] == [date(2026, 10, 15), DAY]
+    assert [len(part) for part in parts] == [20, 20]
+    assert not parts[1].ms.flags.owndata
+    np.testing.assert_allclose(parts[1].timestamps()[:2] - MIDNIGHT, [0.0, 0.5])
+
+
+def test_grams_are_clipped(store):
+    store.append('cup', MIDNIGHT + np.array([1.0, 2.0]), [5000.0, -5000.0])
+    _, grams = store.load('cup', MIDNIGHT, MIDNIGHT + 10)
+    np.testing.assert_allclose(grams, [3276.7, -3276.8])
+
+
+def test_rollup_and_prune(store):
+    timestamps = MIDNIGHT + np.arange(0, 180, 0.5)
+    grams = np.arange(len(timestamps), dtype=float)
+    store.append('cup', timestamps, grams)
+
+    assert store.read_rollup('cup', DAY, 60) is None
+    assert store.rollup('cup', DAY, 60) == 3
+    rows = store.read_rollup('cup', DAY, 60)
+    assert rows['bucket'].tolist() == [0, 1, 2]
+    assert rows['count'].tolist() == [120, 120, 120]
+    assert rows['min'].tolist() == [0, 120, 240]
+    assert rows['max'].tolist() == [119, 239, 359]
+    assert rows['last'].tolist() == [119, 239, 359]
+    np.testing.assert_allclose(rows['mean'], [59.5, 179.5, 299.5])
+
+    assert store.prune(date(2026, 10, 17)) == 1
+    assert store.days('cup') == []
+    assert store.read_rollup('cup', DAY, 60) is not None
+    assert store.rollup_all([60]) == 0
+
+
+def test_separate_instances_share_files(tmp_path):
+    # Come due worker: ognuno con i propri descrittori sugli stessi file
+    first, second = WeightStore(str(tmp_path)), WeightStore(str(tmp_path))
+    first.append('cup', MIDNIGHT + np.array([1.0, 2.0]), [1, 2])
+    assert second.append('cup', MIDNIGHT + np.array([2.0, 3.0]), [2, 3]) == 1
+    timestamps, _ = first.load('cup', MIDNIGHT, MIDNIGHT + 10)
+    np.testing.assert_allclose(timestamps - MIDNIGHT, [1, 2, 3])
+    assert first.devices() == ['cup']
+
+
+@pytest.mark.parametrize('device_id', ['.', '..', '../fuori', 'a/b', '/tmp/x'])
+def test_device_ids_cannot_leave_the_directory(tmp_path, device_id):
+    store = WeightStore(str(tmp_path / 'history'))
+    with pytest.raises(ValueError):
+        store.append(device_id, np.array([MIDNIGHT + 1.0]), np.array([100.0]))
+    with pytest.raises(ValueError):
+        store.read_day(device_id, DAY)
+    assert os.listdir(tmp_path) == ['history']
+    assert os.listdir(tmp_path / 'history') == []
@@ -0,0 +1,314 @@
+"""Storico delle letture dei sottobicchieri in file colonnari mappati in memoria.
+
+Per ogni dispositivo e giorno (UTC) ci sono due file in sola aggiunta:
+
+- ``<giorno>.t``: un contatore di 8 byte seguito dagli istanti, in
+  millisecondi dall'inizio del giorno (``uint32``)
+- ``<giorno>.g``: i pesi in decimi di grammo (``int16``, fino a ±3276,7 g)
+
+cioè 6 byte per lettura. Le scritture avvengono con ``pwrite`` sotto un flock,
+così più worker possono aggiungere letture allo stesso file; il contatore
+viene aggiornato per ultimo, quindi chi legge vede sempre un prefisso
+completo. Le letture mappano i file e restituiscono viste NumPy senza copiare
+i dati.
+
+I riepiloghi (``rollup``) riducono un giorno a un bucket ogni ``resolution``
+secondi con minimo, massimo, media, ultimo valore e numero di letture; si
+salvano accanto ai dati grezzi, che si possono poi eliminare (``prune``).
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+_COUNT = struct.Struct('<Q')
+
+TIME_DTYPE = np.dtype('<u4')
+GRAMS_DTYPE = np.dtype('<i2')
+# Il peso è salvato in decimi di grammo
+GRAMS_SCALE = 10
+
+DAY_SECONDS = 86400
+
+ROLLUP_DTYPE = np.dtype([
+    ('bucket', '<u4'), ('count', '<u4'),
+    ('min', '<f4'), ('max', '<f4'), ('mean', '<f4'), ('last', '<f4')
+])
+
+# File di scrittura tenuti aperti contemporaneamente
+MAX_OPEN_FILES = 64
+
+
+def day_start(day):
+    """Istante Unix della mezzanotte UTC di ``day``"""
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+
+def _map(path, offset, dtype):
+    """Vista in sola lettura sul file a partire da ``offset``, vuota se il file non c'è"""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return np.empty(0, dtype), size
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return np.empty(0, dtype), 0
+    # La vista tiene viva la mappatura finché serve
+    return np.frombuffer(mapped, dtype, (size - offset) // dtype.itemsize, offset), size
+
+
+class DayColumns:
+    """Letture di un dispositivo in un giorno: viste in sola lettura sui file mappati"""
+
+    __slots__ = ('day', 'start', 'ms', 'decigrams')
+
+    def __init__(self, day, ms, decigrams):
+        self.day = day
+        self.start = day_start(day)
+        self.ms = ms
+        self.decigrams = decigrams
+
+    def __len__(self):
+        return len(self.ms)
+
+    def slice(self, start=None, end=None):
+        """Le letture con istante in [start, end), sempre come viste sugli stessi file"""
+        first = 0 if start is None else np.searchsorted(self.ms, max(0.0, (start - self.start) * 1000), 'left')
+        last = len(self.ms) if end is None else np.searchsorted(self.ms, max(0.0, (end - self.start) * 1000), 'left')
+        return DayColumns(self.day, self.ms[first:last], self.decigrams[first:last])
+
+    def timestamps(self):
+        """Istanti Unix in secondi (copia)"""
+        return self.start + self.ms / 1000.0
+
+    def grams(self):
+        """Pesi in grammi (copia)"""
+        return self.decigrams / GRAMS_SCALE
+
+
+class _Writer:
+    """Descrittori aperti per aggiungere letture a un dispositivo/giorno"""
+
+    def __init__(self, path):
+        self.time_fd = os.open(path + '.t', os.O_RDWR | os.O_CREAT, 0o644)
+        self.grams_fd = os.open(path + '.g', os.O_RDWR | os.O_CREAT, 0o644)
+
+    def close(self):
+        os.close(self.time_fd)
+        os.close(self.grams_fd)
+
+
+class WeightStore:
+    """Storico per dispositivo e giorno in ``directory/<device_id>/<AAAA-MM-GG>.{t,g}``"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._root = os.path.realpath(directory)
+        self._writers = OrderedDict()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _device_dir(self, device_id):
+        """Cartella del dispositivo; ValueError se l'ID porterebbe fuori da ``directory``"""
+        path = os.path.join(self.directory, device_id)
+        if os.path.dirname(os.path.realpath(path)) != self._root:
+            raise ValueError(f'ID dispositivo non valido per lo storico: {device_id!r}')
+        return path
+
+    def _path(self, device_id, day):
+        return os.path.join(self._device_dir(device_id), day.isoformat())
+
+    def _writer(self, device_id, day):
+        # I descrittori ereditati con fork condividerebbero i flock con il padre
+        if self._pid != os.getpid():
+            self._writers.clear()
+            self._pid = os.getpid()
+        key = (device_id, day)
+        writer = self._writers.get(key)
+        if writer is None:
+            os.makedirs(self._device_dir(device_id), exist_ok=True)
+            writer = self._writers[key] = _Writer(self._path(device_id, day))
+            if len(self._writers) > MAX_OPEN_FILES:
+                self._writers.popitem(last=False)[1].close()
+        else:
+            self._writers.move_to_end(key)
+        return writer
+
+    def append(self, device_id, timestamps, grams):
+        """
+        Aggiunge letture (istanti Unix, grammi). Quelle non più recenti
+        dell'ultima salvata per il dispositivo in quel giorno vengono scartate,
+        così i file restano ordinati per tempo.
+
+        Returns:
+            Il numero di letture salvate
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        grams = np.asarray(grams, dtype=np.float64)
+        if not len(timestamps):
+            return 0
+        if np.any(np.diff(timestamps) < 0):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, grams = timestamps[order], grams[order]
+
+        days = (timestamps // DAY_SECONDS).astype(np.int64)
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        saved = 0
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(days)]):
+            day = date(1970, 1, 1) + timedelta(days=int(days[start]))
+            ms = np.round((timestamps[start:end] - day_start(day)) * 1000).astype(TIME_DTYPE)
+            decigrams = np.clip(np.round(grams[start:end] * GRAMS_SCALE), -32768, 32767).astype(GRAMS_DTYPE)
+            saved += self._append_day(device_id, day, ms, decigrams)
+        return saved
+
+    def _append_day(self, device_id, day, ms, decigrams):
+        with self._lock:
+            writer = self._writer(device_id, day)
+            fcntl.flock(writer.time_fd, fcntl.LOCK_EX)
+            try:
+                header = os.pread(writer.time_fd, _COUNT.size, 0)
+                count = _COUNT.unpack(header)[0] if len(header) == _COUNT.size else 0
+                if count:
+                    offset = _COUNT.size + (count - 1) * TIME_DTYPE.itemsize
+                    last = np.frombuffer(os.pread(writer.time_fd, TIME_DTYPE.itemsize, offset), TIME_DTYPE)[0]
+                    newer = ms > last
+                    if not newer.all():
+                        ms, decigrams = ms[newer], decigrams[newer]
+                if not len(ms):
+                    return 0
+                os.pwrite(writer.time_fd, ms.tobytes(), _COUNT.size + count * TIME_DTYPE.itemsize)
+                os.pwrite(writer.grams_fd, decigrams.tobytes(), count * GRAMS_DTYPE.itemsize)
+                # Il contatore per ultimo: chi legge non vede mai letture a metà
+                os.pwrite(writer.time_fd, _COUNT.pack(count + len(ms)), 0)
+                return len(ms)
+            finally:
+                fcntl.flock(writer.time_fd, fcntl.LOCK_UN)
+
+    def read_day(self, device_id, day):
+        """``DayColumns`` di un giorno, vuoto se non ci sono letture"""
+        path = self._path(device_id, day)
+        ms, _ = _map(path + '.t', _COUNT.size, TIME_DTYPE)
+        decigrams, _ = _map(path + '.g', 0, GRAMS_DTYPE)
+        try:
+            with open(path + '.t', 'rb') as f:
+                header = f.read(_COUNT.size)
+            count = _COUNT.unpack(header)[0] if len(header) == _COUNT.size else 0
+        except FileNotFoundError:
+            count = 0
+        count = min(count, len(ms), len(decigrams))
+        return DayColumns(day, ms[:count], decigrams[:count])
+
+    def read(self, device_id, start, end):
+        """
+        Letture in [start, end) come lista di ``DayColumns``, una per giorno,
+        senza copiare i dati
+        """
+        result = []
+        day, last_day = day_of(start), day_of(end)
+        while day <= last_day:
+            columns = self.read_day(device_id, day).slice(start, end)
+            if len(columns):
+                result.append(columns)
+            day += timedelta(days=1)
+        return result
+
+    def load(self, device_id, start, end):
+        """Come ``read``, ma unisce i giorni in due array (istanti, grammi)"""
+        parts = self.read(device_id, start, end)
+        if not parts:
+            return np.empty(0), np.empty(0)
+        return (np.concatenate([part.timestamps() for part in parts]),
+                np.concatenate([part.grams() for part in parts]))
+
+    def devices(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
+
+    def days(self, device_id):
+        """Giorni con letture grezze del dispositivo"""
+        try:
+            names = os.listdir(self._device_dir(device_id))
+        except FileNotFoundError:
+            return []
+        return sorted(date.fromisoformat(name[:-2]) for name in names if name.endswith('.t'))
+
+    def rollup(self, device_id, day, resolution):
+        """
+        Riassume un giorno in bucket da ``resolution`` secondi e lo salva
+        (``<giorno>.r<resolution>.npy``), riscrivendo un eventuale riepilogo precedente.
+
+        Returns:
+            Il numero di bucket
+        """
+        columns = self.read_day(device_id, day)
+        if not len(columns):
+            return 0
+        grams = columns.grams()
+        buckets = columns.ms // (resolution * 1000)
+        bounds = np.flatnonzero(np.diff(buckets)) + 1
+        starts = np.r_[0, bounds]
+        counts = np.diff(np.r_[starts, len(grams)])
+
+        rows = np.empty(len(starts), ROLLUP_DTYPE)
+        rows['bucket'] = buckets[starts]
+        rows['count'] = counts
+        rows['min'] = np.minimum.reduceat(grams, starts)
+        rows['max'] = np.maximum.reduceat(grams, starts)
+        rows['mean'] = np.add.reduceat(grams, starts) / counts
+        rows['last'] = grams[np.r_[bounds - 1, len(grams) - 1]]
+
+        path = f'{self._path(device_id, day)}.r{resolution}.npy'
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, rows)
+        os.replace(temp, path)
+        return len(rows)
+
+    def read_rollup(self, device_id, day, resolution):
+        """Riepilogo di un giorno (mappato, senza copia), None se non è stato calcolato"""
+        try:
+            return np.load(f'{self._path(device_id, day)}.r{resolution}.npy', mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def rollup_all(self, resolutions, since=None):
+        """Calcola i riepiloghi di tutti i dispositivi per i giorni da ``since`` in poi"""
+        done = 0
+        for device_id in self.devices():
+            for day in self.days(device_id):
+                if since is None or day >= since:
+                    for resolution in resolutions:
+                        self.rollup(device_id, day, resolution)
+                    done += 1
+        return done
+
+    def prune(self, before):
+        """Elimina i dati grezzi dei giorni precedenti a ``before`` (i riepiloghi restano)"""
+        removed = 0
+        for device_id in self.devices():
+            for day in self.days(device_id):
+                if day < before:
+                    path = self._path(device_id, day)
+                    with self._lock:
+                        writer = self._writers.pop((device_id, day), None)
+                        if writer is not None:
+                            writer.close()
+                    for suffix in ('.t', '.g'):
+                        try:
+                            os.remove(path + suffix)
+                        except FileNotFoundError:
+                            pass
+                    removed += 1
+        return removed